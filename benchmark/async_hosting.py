@@ -0,0 +1,165 @@
+"""
+一个进程中托管大量单合约策略: AsyncConsumer 与每个策略一个 Consumer 监听线程的对比
+
+python -m benchmark.async_hosting --host 122.207.108.56 --port 12479 --db 15 --strategies 300 --transport stream
+
+每个合约一个 StopLossStrategy(不加载历史k线, 下单接口使用 benchmark/stubs.py 的替身), 订阅自己合约的分片
+(channel:code), 两种方式都通过 on_market 把解码后的行情交给策略. 生产者用 publish_market 发布minutes分钟的
+全市场行情, 统计每分钟从发布到所有策略都处理完这根k线的延迟, 以及之后idle秒没有消息时进程占用的cpu时间和线程数.
+测试在 --db 指定的库中进行, 结束时向每个分片发布EXIT, 消费者删除自己的消息队列或消费者组
+"""
+import argparse
+import asyncio
+import contextlib
+import io
+import threading
+import time
+import numpy as np
+import pandas as pd
+import redis
+import redis.asyncio
+from mq.async_consumer import AsyncConsumer
+from mq.codec import decode_message
+from mq.consumer import Consumer
+from mq.producer import Producer
+from mq.shard import shard_channel
+from benchmark.stubs import install_order_stub
+from benchmark.synthetic import make_market
+
+CHANNEL = "bench"
+
+
+class ThreadConsumer(Consumer):
+    """每个策略一个 Consumer, 收到的消息解码后交给策略的 on_market, 与 AsyncConsumer 相同"""
+
+    def __init__(self, strategy, conn, transport):
+        super().__init__(CHANNEL, conn=conn, transport=transport)
+        self.set_client_id(f"bench-{strategy.code}")
+        self.strategy = strategy
+
+    def process_message(self, message):
+        self.strategy.on_market(decode_message(message))
+
+
+def publish(args, producer, data, strategies):
+    """发布minutes分钟的行情, 返回每分钟的延迟(毫秒), 以所有策略的k线数量都增加为处理完成"""
+    latency = []
+    start = pd.Timestamp(data["trade_date"].iloc[0])
+    for minute in range(args.minutes):
+        data["close"] += 1
+        data["trade_date"] = (start + pd.Timedelta(minutes=minute)).strftime("%Y-%m-%d %H:%M:%S")
+        sent = time.time()
+        producer.publish_market(CHANNEL, data, codec=args.codec, shard=True)
+        while min(s.bars for s in strategies) <= minute:
+            time.sleep(0.001)
+        latency.append((time.time() - sent) * 1000)
+    return np.array(latency)
+
+
+def idle_cpu(seconds):
+    """seconds秒内进程占用的cpu时间占比"""
+    begin_cpu, begin = time.process_time(), time.perf_counter()
+    time.sleep(seconds)
+    return (time.process_time() - begin_cpu) / (time.perf_counter() - begin)
+
+
+def run_async(args, producer, data, strategies):
+    consumer = AsyncConsumer("bench-async", transport=args.transport)
+    for strategy in strategies:
+        consumer.attach(strategy, CHANNEL, codes=[strategy.code])
+
+    def serve():
+        async def main():
+            consumer.conn = redis.asyncio.Redis(host=args.host, port=args.port, db=args.db)
+            await consumer.run()
+
+        asyncio.run(main())
+
+    thread = threading.Thread(target=serve, daemon=True)
+    thread.start()
+    wait_ready(args, producer, "bench-async", len(strategies))
+    latency = publish(args, producer, data, strategies)
+    cpu = idle_cpu(args.idle)
+    threads = threading.active_count()
+    stop(args, producer, strategies)
+    thread.join(timeout=30)
+    return latency, cpu, threads
+
+
+def run_threads(args, producer, data, strategies):
+    threads = []
+    for strategy in strategies:
+        conn = redis.Redis(host=args.host, port=args.port, db=args.db)
+        consumer = ThreadConsumer(strategy, conn, args.transport)
+        threads += consumer.subscribe(CHANNEL, codes=[strategy.code], block=False)
+    wait_ready(args, producer, "bench-", len(strategies))
+    latency = publish(args, producer, data, strategies)
+    cpu = idle_cpu(args.idle)
+    count = threading.active_count()
+    stop(args, producer, strategies)
+    for thread in threads:
+        thread.join(timeout=30)
+    return latency, cpu, count
+
+
+def wait_ready(args, producer, prefix, count):
+    """等待所有消费者完成注册"""
+    conn = redis.Redis(host=args.host, port=args.port, db=args.db, decode_responses=True)
+    while True:
+        if args.transport == "stream":
+            keys = conn.keys(f"STREAM/{CHANNEL}:*")
+            ready = sum(
+                1 for key in keys for group in conn.xinfo_groups(key) if group["name"].startswith(prefix)
+            )
+        else:
+            ready = sum(1 for key in conn.smembers("PERSITS_SUB") if key.startswith(prefix))
+        if ready >= count:
+            return
+        time.sleep(0.05)
+
+
+def stop(args, producer, strategies):
+    for strategy in strategies:
+        producer.publish(shard_channel(CHANNEL, strategy.code), "EXIT")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", type=int, default=6379)
+    parser.add_argument("--db", type=int, default=15)
+    parser.add_argument("--strategies", type=int, default=300)
+    parser.add_argument("--transport", default="stream", choices=["list", "stream"])
+    parser.add_argument("--codec", default="binary", choices=["json", "binary"])
+    parser.add_argument("--minutes", type=int, default=20)
+    parser.add_argument("--idle", type=float, default=5)
+    parser.add_argument("--modes", nargs="+", default=["async", "threads"], choices=["async", "threads"])
+    args = parser.parse_args()
+
+    conn = redis.Redis(host=args.host, port=args.port, db=args.db, decode_responses=True)
+    producer = Producer(conn, transport=args.transport)
+    print(f"strategies: {args.strategies} transport: {args.transport} codec: {args.codec}")
+    print(f"{'mode':>8s} {'p50':>10s} {'max':>10s} {'idle cpu':>9s} {'threads':>8s}")
+    install_order_stub()
+    from strategy.stop_loss import StopLossStrategy
+
+    for mode in args.modes:
+        data = make_market(args.strategies)
+        # 原始的list消费者和策略每条消息都会print, 不输出
+        with contextlib.redirect_stdout(io.StringIO()):
+            strategies = [
+                StopLossStrategy(code, code, warm_start_bars=0) for code in data.index
+            ]
+            run = run_async if mode == "async" else run_threads
+            latency, cpu, threads = run(args, producer, data, strategies)
+        print(
+            f"{mode:>8s} {np.percentile(latency, 50):8.2f}ms {latency.max():8.2f}ms "
+            f"{cpu * 100:8.1f}% {threads:8d}"
+        )
+    conn.delete("PERSITS_SUB", "MESSAGE_TXID", f"STREAM/{CHANNEL}")
+    for key in conn.keys(f"STREAM/{CHANNEL}:*"):
+        conn.delete(key)
+
+
+if __name__ == "__main__":
+    main()
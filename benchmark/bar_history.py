@@ -0,0 +1,85 @@
+"""
+读取一个合约最近N根分钟k线: 从以分钟时间为key的全市场消息集合中逐分钟读取并解码, 与按合约的有序集合
+(util/bar_cache.py)一次读取的耗时对比, 并校验两者结果相同
+
+python -m benchmark.bar_history --host 122.207.108.56 --port 12479 --db 15 --contracts 80 --minutes 240 --count 60 240
+
+在 --db 指定的库中写入 --minutes 分钟的合成行情, 结束后删除
+"""
+import argparse
+import time
+import numpy as np
+import pandas as pd
+import redis
+from mq.codec import decode_message, encode_message, to_frame
+from util.bar_cache import FIELDS, bar_key, last_bars, write_bars
+from benchmark.synthetic import make_market
+
+
+def blob_history(conn, minute_keys: list, code: str, count: int) -> pd.DataFrame:
+    """原始方式: 从最新的分钟往前读取count个全市场消息集合, 解码后取出一个合约"""
+    pipe = conn.pipeline(transaction=False)
+    for key in minute_keys[-count:]:
+        pipe.smembers(key)
+    rows = []
+    for messages in pipe.execute():
+        for message in messages:
+            frame = to_frame(decode_message(message))
+            if code in frame.index:
+                rows.append(frame.loc[code])
+    data = pd.DataFrame(rows).reset_index(drop=True)
+    data["trade_date"] = pd.to_datetime(data["trade_date"])
+    return data[["trade_date"] + FIELDS]
+
+
+def per_call(func, repeat):
+    begin = time.perf_counter()
+    for _ in range(repeat):
+        result = func()
+    return (time.perf_counter() - begin) / repeat * 1000, result
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", type=int, default=6379)
+    parser.add_argument("--db", type=int, default=15)
+    parser.add_argument("--contracts", type=int, default=80)
+    parser.add_argument("--minutes", type=int, default=240)
+    parser.add_argument("--count", type=int, nargs="+", default=[60, 240])
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    conn = redis.Redis(host=args.host, port=args.port, db=args.db, decode_responses=True)
+    start = pd.Timestamp("2022-05-18 09:00:00")
+    minute_keys = []
+    codes = None
+    try:
+        pipe = conn.pipeline(transaction=False)
+        for i in range(args.minutes):
+            trade_date = str(start + pd.Timedelta(minutes=i))
+            data = make_market(args.contracts, seed=i, trade_date=trade_date)
+            codes = list(data.index)
+            pipe.sadd(trade_date, encode_message(data, "json"))
+            write_bars(pipe, data)
+            minute_keys.append(trade_date)
+        pipe.execute()
+        code = codes[0]
+        print(f"contracts: {args.contracts} minutes: {args.minutes} code: {code}")
+        print(f"{'count':>6s} {'blob':>10s} {'zset':>10s} {'speedup':>8s}")
+        for count in args.count:
+            blob, expected = per_call(lambda: blob_history(conn, minute_keys, code, count), args.repeat)
+            zset, result = per_call(lambda: last_bars(conn, code, count), args.repeat)
+            assert len(result) == len(expected) == min(count, args.minutes)
+            assert (result["trade_date"].values == expected["trade_date"].values).all()
+            assert np.allclose(result[FIELDS].values, expected[FIELDS].values.astype(float), equal_nan=True)
+            print(f"{count:6d} {blob:8.2f}ms {zset:8.2f}ms {blob / zset:7.1f}x")
+    finally:
+        if minute_keys:
+            conn.delete(*minute_keys)
+        if codes:
+            conn.delete(*[bar_key(code) for code in codes])
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,82 @@
+"""
+重连后处理积压消息的耗时
+
+python -m benchmark.drain_backlog --host 122.207.108.56 --port 12479 --db 15 --backlog 1000 10000
+
+向一个订阅者的消息队列(bench/bench)写入backlog条消息, 分别用原始的逐条 LINDEX + LPOP 和
+Consumer.clear_msg 的批量 LRANGE + LTRIM 处理完, 对比耗时并校验两者处理的消息和顺序相同.
+测试在 --db 指定的库中进行, 结束后删除消息队列
+"""
+import argparse
+import time
+import redis
+from mq.config import mq_config
+from mq.consumer import Consumer
+
+CLIENT_ID = "bench"
+CHANNEL = "bench"
+
+
+class RecordConsumer(Consumer):
+    def __init__(self, conn):
+        super().__init__(CHANNEL, conn=conn, transport="list")
+        self.set_client_id(CLIENT_ID)
+        self.received = []
+
+    def process_message(self, message):
+        self.received.append(message)
+
+
+def legacy_clear_msg(conn, consumer, channel):
+    """原始的 Consumer.clear_msg, 每条消息 LINDEX 和 LPOP 两次往返"""
+    channel_key = f"{consumer.client_id}/{channel}"
+    while True:
+        lm = conn.lindex(channel_key, 0)
+        if lm is None:
+            break
+        li = int(lm.index("/"))
+        lmessage = lm[(li + 1) :]
+        consumer.process_message(lmessage)
+        conn.lpop(channel_key)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", type=int, default=6379)
+    parser.add_argument("--db", type=int, default=15)
+    parser.add_argument("--backlog", type=int, nargs="+", default=[1000, 10000])
+    args = parser.parse_args()
+
+    conn = redis.Redis(host=args.host, port=args.port, db=args.db, decode_responses=True)
+    channel_key = f"{CLIENT_ID}/{CHANNEL}"
+    print(f"LIST_BATCH: {mq_config['LIST_BATCH']}")
+    print(f"{'backlog':>8s} {'legacy':>10s} {'batched':>10s} {'speedup':>8s}")
+    for backlog in args.backlog:
+        contents = [f"{txid}/message {txid}" for txid in range(1, backlog + 1)]
+        elapsed = {}
+        received = {}
+        try:
+            for name in ["legacy", "batched"]:
+                conn.delete(channel_key)
+                conn.rpush(channel_key, *contents)
+                consumer = RecordConsumer(conn)
+                begin = time.perf_counter()
+                if name == "legacy":
+                    legacy_clear_msg(conn, consumer, CHANNEL)
+                else:
+                    consumer.clear_msg(CHANNEL)
+                elapsed[name] = time.perf_counter() - begin
+                received[name] = consumer.received
+                assert conn.llen(channel_key) == 0
+        finally:
+            conn.delete(channel_key)
+        assert received["legacy"] == received["batched"] == [c[c.index("/") + 1 :] for c in contents]
+        print(
+            f"{backlog:8d} {elapsed['legacy']:9.3f}s {elapsed['batched']:9.3f}s "
+            f"{elapsed['legacy'] / elapsed['batched']:7.1f}x"
+        )
+
+
+if __name__ == "__main__":
+    main()
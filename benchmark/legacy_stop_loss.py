@@ -0,0 +1,719 @@
+"""
+止损值的原始实现, 作为一致性校验的参照
+
++ LegacyStopLoss: StopLossIndicator改为StopLossEngine之前逐根k线往前扫描的写法, 价格同样保存在Series中
++ LegacyStopLossStrategy: StopLossStrategy.cal_stop_loss的原始写法
+
+止损值缺失用NaN表示(原实现用None, 在回调条件的往前扫描中比较None会抛出TypeError),
+只用于benchmark, 复杂度为O(n*period)到O(n^2), 不要在生产代码中使用
+"""
+import logging
+import numpy as np
+import pandas as pd
+
+
+class LegacyStopLoss:
+    """
+    Args:
+        open_, close, high, low: 价格序列
+        period: 止损值变化策略(创新低,创新高等)考虑的交易周期数
+        restrict: 是否限制止损值策略的某些规则往前搜索的周期数
+        volatile: 是否开启止损值震荡条件
+        backtrack: 是否开启止损值回调条件
+    """
+
+    def __init__(
+        self,
+        open_,
+        close,
+        high,
+        low,
+        period: int = 6,
+        restrict: bool = True,
+        volatile: bool = True,
+        backtrack: bool = False,
+    ) -> None:
+        self.open = pd.Series(open_).astype("float").reset_index(drop=True)
+        self.close = pd.Series(close).astype("float").reset_index(drop=True)
+        self.high = pd.Series(high).astype("float").reset_index(drop=True)
+        self.low = pd.Series(low).astype("float").reset_index(drop=True)
+        self.stop_loss = [0 for _ in range(len(self.close))]
+        self.period = period
+        self.restrict = restrict
+        self.volatile = volatile
+        self.backtrack = backtrack
+
+    def begin_new_lowest(self, cur):
+        if cur < self.period - 1:
+            return False
+        cur_low = self.low[cur]
+        start = cur - self.period + 1
+        if start < 0:
+            start = 0
+        lowest = self.low[start : cur + 1].min()
+        cur_low = self.low[cur]
+        if cur_low == lowest:
+            return True
+        return False
+
+    def value_of_begin(self, cur):
+        rank = 0
+        cur_high = self.high[cur]
+        pivot = cur_high
+        for i in range(cur - 1, -1, -1):
+            if pivot < self.high[i]:
+                rank += 1
+                pivot = self.high[i]
+                if rank == 2:
+                    return self.high[i]
+        return pivot
+
+    def below_stop_loss(self, cur: int) -> bool:
+        """
+        判断今日和昨日k线是否在止损线之下
+        1. 当日收盘价低于昨日止损线
+        2. 昨日收盘价低于昨日止损线
+        3. 昨日开盘价和收盘价等于止损值时, 往前搜索
+        """
+        cur_open = self.open[cur]
+        cur_close = self.close[cur]
+        last_stop = self.stop_loss[cur - 1]
+        if cur_close > last_stop:
+            return False
+        if cur_close < last_stop:
+            return True
+        if cur_close == last_stop:
+            if cur_open < cur_close:
+                return True
+            elif cur_open > cur_close:
+                return False
+        for i in range(cur - 1, -1, -1):
+            cur_close = self.close[i]
+            cur_stop = self.stop_loss[i]
+            if cur_stop != cur_stop:
+                return False
+            if cur_close == cur_open == cur_stop:
+                continue
+            if cur_close < cur_stop:
+                return True
+            if cur_close == cur_stop and cur_open < cur_close:
+                return True
+            else:
+                return False
+        return False
+
+    def above_stop_loss(self, cur: int) -> bool:
+        """
+        判断今日和昨日k线是否在止损线之上
+        1. 当日收盘价高于昨日止损线
+        2. 昨日收盘价高于昨日止损线
+        3. 昨日开盘价和收盘价等于止损值时, 往前搜索
+        """
+        cur_open = self.open[cur]
+        cur_close = self.close[cur]
+        last_stop = self.stop_loss[cur - 1]
+        if cur_close < last_stop:
+            return False
+        if cur_close > last_stop:
+            return True
+        if cur_close == last_stop:
+            if cur_open > cur_close:
+                return True
+            elif cur_open < cur_close:
+                return False
+        for i in range(cur - 1, -1, -1):
+            cur_close = self.close[i]
+            cur_stop = self.stop_loss[i]
+            if cur_stop != cur_stop:
+                return False
+            if cur_close == cur_open == cur_stop:
+                continue
+            if cur_close > cur_stop:
+                return True
+            if cur_close == cur_stop and cur_open > cur_close:
+                return True
+            else:
+                return False
+        return False
+
+    def new_lowest(self, cur):
+        """判断是否出现创新低的情况,返回bool类型"""
+        start = cur - self.period + 1
+        if start < 0:
+            start = 0
+        lowest = self.low[start : cur + 1].min()
+        cur_low = self.low[cur]
+        if cur_low == lowest:
+            return True
+        else:
+            return False
+
+    def value_of_new_lowest(self, cur):
+        """当出现创新低的情况时, 返回止损点的值"""
+        rank = 0
+        last_stop = self.stop_loss[cur - 1]
+        cur_high = self.high[cur]
+        pivot = cur_high
+        # if cur_close != last_stop:
+        end = -1
+        if self.restrict:
+            end = cur - 2 * (self.period) + 1
+            if end < -1:
+                end = -1
+        for i in range(cur - 1, end, -1):
+            # TODO: 往前查询的范围还需要确定
+            # 止损值取比当前最高价高的第二连续最高价
+            if pivot < self.high[i]:
+                rank += 1
+                pivot = self.high[i]
+                if rank == 2:
+                    return self.high[i]
+        return last_stop
+
+    def new_highest(self, cur):
+        """判断是否出现创新高的情况, 返回bool类型"""
+        start = cur - self.period + 1
+        if start < 0:
+            start = 0
+        highest = self.high[start : cur + 1].max()
+        cur_high = self.high[cur]
+        if cur_high == highest:
+            return True
+        else:
+            return False
+
+    def value_of_new_highest(self, cur):
+        """当出现创新高的情况时, 返回止损点的值"""
+        rank = 0
+        cur_low = self.low[cur]
+        last_stop = self.stop_loss[cur - 1]
+        pivot = cur_low
+        # if cur_close != last_stop:
+        end = -1
+        if self.restrict:
+            end = cur - 2 * (self.period) + 1
+            if end < -1:
+                end = -1
+        for i in range(cur - 1, end, -1):
+            # TODO: 止损值寻找范围还需确定
+            # 止损值取比当前最低价低的第二连续最低价
+            if pivot > self.low[i]:
+                rank += 1
+                pivot = self.low[i]
+                if rank == 2:
+                    return self.low[i]
+        return last_stop
+
+    def rise_above_stop_loss(self, cur):
+        """
+        判断是否涨破止损线, 返回bool类型
+        """
+        assert cur > 0
+        cur_close = self.close[cur]
+        last_stop = self.stop_loss[cur - 1]
+        if last_stop != last_stop:
+            return False
+        last_close = self.close[cur - 1]
+        last_open = self.open[cur - 1]
+        if cur_close > last_stop:
+            if last_close < last_stop:
+                return True
+            elif last_close == last_stop:
+                if last_open < last_close:
+                    return True
+                elif last_open == last_close:
+                    for i in range(cur - 2, -1, -1):
+                        pre_stop = self.stop_loss[i]
+                        if pre_stop != pre_stop:
+                            return False
+                        pre_close = self.close[i]
+                        pre_open = self.open[i]
+                        if pre_close < pre_stop:
+                            return True
+                        elif pre_close == pre_stop:
+                            if pre_open < pre_close:
+                                return True
+                            elif pre_open == pre_close:
+                                continue
+                            else:
+                                return False
+                        else:
+                            return False
+        return False
+
+    def fall_below_stop_loss(self, cur):
+        """
+        判断是否跌破止损线,返回bool类型
+        """
+        assert cur > 0
+        cur_close = self.close[cur]
+        last_stop = self.stop_loss[cur - 1]
+        if last_stop != last_stop:
+            return False
+        last_open = self.open[cur - 1]
+        last_close = self.close[cur - 1]
+        if cur_close < last_stop:
+            if last_close > last_stop:
+                return True
+            elif last_close == last_stop:
+                if last_open > last_close:
+                    return True
+                elif last_open == last_close:
+                    for i in range(cur - 2, -1, -1):
+                        pre_stop = self.stop_loss[i]
+                        if pre_stop != pre_stop:
+                            return False
+                        pre_close = self.close[i]
+                        pre_open = self.open[i]
+                        if pre_close > pre_stop:
+                            return True
+                        elif pre_close == pre_stop:
+                            if pre_open == pre_close:
+                                continue
+                            elif pre_open > pre_close:
+                                return True
+                            else:
+                                return False
+                        else:
+                            return False
+        return False
+
+    def index_of_last_rise_above(self, cur):
+        for i in range(cur - 1, 1, -1):
+            if not self.above_stop_loss(i):
+                return i
+        return -1
+
+    def index_of_last_fall_below(self, cur):
+        for i in range(cur - 1, 1, -1):
+            if not self.below_stop_loss(i):
+                return i
+        return -1
+
+    def value_of_fall_below(self, cur):
+        rank = 0
+        cur_high = self.high[cur]
+        pivot = cur_high
+        end = -1
+        if self.restrict:
+            end = cur - 2 * (self.period) + 1
+            end = max(end, -1)
+        for i in range(cur - 1, end, -1):
+            if pivot < self.high[i]:
+                rank += 1
+                pivot = self.high[i]
+                if rank == 2:
+                    return self.high[i]
+        return pivot
+
+    def value_of_rise_above(self, cur):
+        """
+        返回涨破条件下的止损值
+        """
+        rank = 0
+        cur_low = self.low[cur]
+        pivot = cur_low
+        end = -1
+        if self.restrict:
+            end = cur - 2 * (self.period) + 1
+            end = max(end, -1)
+        for i in range(cur - 1, end, -1):
+            if pivot > self.low[i]:
+                rank += 1
+                pivot = self.low[i]
+                if rank == 2:
+                    return self.low[i]
+        return pivot
+
+    def predict_stop_loss(self, start) -> list:
+        """
+        Args:
+            start(int): 计算止损值的初始位置
+        Retures:
+            stop_loss(list): 止损值, 缺失为NaN
+        """
+        try:
+            for i in range(start, len(self.close)):
+                if i < self.period - 1:
+                    self.stop_loss[i] = float("nan")
+                    continue
+                if self.stop_loss[i - 1] != self.stop_loss[i - 1]:
+                    value = self.value_of_begin(i) if self.new_lowest(i) else float("nan")
+                elif self.fall_below_stop_loss(i) and not self.new_highest(i):
+                    # 跌破且没有创新高
+                    if self.volatile and i > 1 and self.rise_above_stop_loss(i - 1):
+                        # 震荡: 昨日涨破, 今日跌破, 出现震荡, 止损值取昨日的前一天
+                        value = self.stop_loss[i - 1 - 1]
+                    elif self.backtrack and self.new_highest(i - 1):
+                        # 回调: 昨日创新高, 取上一次涨破日的前一天的止损值
+                        index = self.index_of_last_rise_above(i)
+                        if index != -1:
+                            value = self.stop_loss[index - 1]
+                    else:
+                        value = self.value_of_fall_below(i)
+                elif self.rise_above_stop_loss(i) and not self.new_lowest(i):
+                    # 涨破且没有创新低
+                    if self.volatile and i > 1 and self.fall_below_stop_loss(i - 1):
+                        # 震荡: 昨日跌破, 今日涨破, 出现震荡, 止损值取昨日的前一天
+                        value = self.stop_loss[i - 1 - 1]
+                    elif self.backtrack and self.new_lowest(i - 1):
+                        # 回调: 昨日创新低, 取上一次跌破日的前一天的止损值
+                        index = self.index_of_last_fall_below(i)
+                        if index != -1:
+                            value = self.stop_loss[index - 1]
+                    else:
+                        value = self.value_of_rise_above(i)
+                elif self.fall_below_stop_loss(i) and self.new_highest(i):
+                    # 跌破且创新高
+                    value = self.value_of_new_highest(i)
+                elif self.rise_above_stop_loss(i) and self.new_lowest(i):
+                    # 涨破且创新低
+                    value = self.value_of_new_lowest(i)
+                elif self.above_stop_loss(i) and self.new_highest(i):
+                    # 止损线之上且创新高
+                    value = self.value_of_new_highest(i)
+                elif self.below_stop_loss(i) and self.new_lowest(i):
+                    # 止损线之下且创新低
+                    value = self.value_of_new_lowest(i)
+                else:
+                    # 不符合上述条件取前一天的止损值
+                    value = self.stop_loss[i - 1]
+                self.stop_loss[i] = value
+            return self.stop_loss
+        except Exception as e:
+            logging.exception(e)
+            raise e
+
+
+class LegacyStopLossStrategy:
+    """
+    StopLossStrategy改为StopLossEngine之前的cal_stop_loss, 逐根k线加入, 规则与LegacyStopLoss相同但写法不同,
+    且前period根k线没有止损值(LegacyStopLoss为前period-1根)
+    Args:
+        period: 止损值变化策略(创新低,创新高等)考虑的交易周期数
+        restrict: 是否限制止损值策略的某些规则往前搜索的周期数
+        volatile: 是否开启止损值震荡条件
+        backtrack: 是否开启止损值回调条件
+    """
+
+    def __init__(
+        self,
+        period: int = 6,
+        restrict: bool = False,
+        volatile: bool = False,
+        backtrack: bool = False,
+    ) -> None:
+        self.stop_loss = []
+        self.close_ = []
+        self.open_ = []
+        self.high = []
+        self.low = []
+        self.period = period
+        self.restrict = restrict
+        self.volatile = volatile
+        self.backtrack = backtrack
+
+    def value_of_begin(self, cur):
+        rank = 0
+        cur_high = self.high[cur]
+        pivot = cur_high
+        for i in range(cur - 1, -1, -1):
+            if pivot < self.high[i]:
+                rank += 1
+                pivot = self.high[i]
+                if rank == 2:
+                    return self.high[i]
+        return pivot
+
+    def below_stop_loss(self, cur: int) -> bool:
+        """
+        判断今日和昨日k线是否在止损线之下
+        1. 当日收盘价低于昨日止损线
+        2. 昨日收盘价低于昨日止损线
+        3. 昨日开盘价和收盘价等于止损值时, 往前搜索
+        """
+        cur_open = self.open_[cur]
+        cur_close = self.close_[cur]
+        last_stop = self.stop_loss[cur - 1]
+        if cur_close > last_stop:
+            return False
+        if cur_close < last_stop:
+            return True
+        if cur_close == last_stop:
+            if cur_open < cur_close:
+                return True
+            elif cur_open > cur_close:
+                return False
+        for i in range(cur - 1, -1, -1):
+            cur_close = self.close_[i]
+            cur_stop = self.stop_loss[i]
+            if cur_stop != cur_stop:
+                return False
+            if cur_close == cur_open == cur_stop:
+                continue
+            if cur_close < cur_stop:
+                return True
+            return cur_close == cur_stop and cur_open < cur_close
+        return False
+
+    def above_stop_loss(self, cur: int) -> bool:
+        """
+        判断今日和昨日k线是否在止损线之上
+        1. 当日收盘价高于昨日止损线
+        2. 昨日收盘价高于昨日止损线
+        3. 昨日开盘价和收盘价等于止损值时, 往前搜索
+        """
+        cur_open = self.open_[cur]
+        cur_close = self.close_[cur]
+        last_stop = self.stop_loss[cur - 1]
+        if cur_close < last_stop:
+            return False
+        if cur_close > last_stop:
+            return True
+        if cur_close == last_stop:
+            if cur_open > cur_close:
+                return True
+            elif cur_open < cur_close:
+                return False
+        for i in range(cur - 1, -1, -1):
+            cur_close = self.close_[i]
+            cur_stop = self.stop_loss[i]
+            if cur_stop != cur_stop:
+                return False
+            if cur_close == cur_open == cur_stop:
+                continue
+            if cur_close > cur_stop:
+                return True
+            return cur_close == cur_stop and cur_open > cur_close
+        return False
+
+    def new_lowest(self, cur):
+        """判断是否出现创新低的情况,返回bool类型"""
+        start = max(cur - self.period + 1, 0)
+        lowest = np.min(self.low[start : cur + 1])
+        cur_low = self.low[cur]
+        return cur_low == lowest
+
+    def value_of_new_lowest(self, cur):
+        """当出现创新低的情况时, 返回止损点的值"""
+        rank = 0
+        last_stop = self.stop_loss[cur - 1]
+        cur_high = self.high[cur]
+        pivot = cur_high
+        end = max(cur - 2 * (self.period) + 1, -1) if self.restrict else -1
+        for i in range(cur - 1, end, -1):
+            # 止损值取比当前最高价高的第二连续最高价
+            if pivot < self.high[i]:
+                rank += 1
+                pivot = self.high[i]
+                if rank == 2:
+                    return self.high[i]
+        return last_stop
+
+    def new_highest(self, cur):
+        """判断是否出现创新高的情况, 返回bool类型"""
+        start = max(cur - self.period + 1, 0)
+        highest = np.max(self.high[start : cur + 1])
+        cur_high = self.high[cur]
+        return cur_high == highest
+
+    def value_of_new_highest(self, cur):
+        """当出现创新高的情况时, 返回止损点的值"""
+        rank = 0
+        cur_low = self.low[cur]
+        last_stop = self.stop_loss[cur - 1]
+        pivot = cur_low
+        end = max(cur - 2 * (self.period) + 1, -1) if self.restrict else -1
+        for i in range(cur - 1, end, -1):
+            # 止损值取比当前最低价低的第二连续最低价
+            if pivot > self.low[i]:
+                rank += 1
+                pivot = self.low[i]
+                if rank == 2:
+                    return self.low[i]
+        return last_stop
+
+    def rise_above_stop_loss(self, cur):
+        """
+        判断是否涨破止损线, 返回bool类型
+        """
+        assert cur > 0
+        cur_close = self.close_[cur]
+        last_stop = self.stop_loss[cur - 1]
+        if last_stop != last_stop:
+            return False
+        last_close = self.close_[cur - 1]
+        last_open = self.open_[cur - 1]
+        if cur_close > last_stop:
+            if (
+                last_close >= last_stop
+                and last_close == last_stop
+                and last_open < last_close
+                or last_close < last_stop
+            ):
+                return True
+            elif last_close == last_stop and last_open == last_close:
+                for i in range(cur - 2, -1, -1):
+                    pre_stop = self.stop_loss[i]
+                    if pre_stop != pre_stop:
+                        return False
+                    pre_close = self.close_[i]
+                    pre_open = self.open_[i]
+                    if (
+                        pre_close >= pre_stop
+                        and pre_close == pre_stop
+                        and pre_open < pre_close
+                        or pre_close < pre_stop
+                    ):
+                        return True
+                    elif pre_close == pre_stop and pre_open == pre_close:
+                        continue
+                    else:
+                        return False
+        return False
+
+    def fall_below_stop_loss(self, cur):
+        """
+        判断是否跌破止损线,返回bool类型
+        """
+        assert cur > 0
+        cur_close = self.close_[cur]
+        last_stop = self.stop_loss[cur - 1]
+        if last_stop != last_stop:
+            return False
+        last_open = self.open_[cur - 1]
+        last_close = self.close_[cur - 1]
+        if cur_close < last_stop:
+            if (
+                last_close <= last_stop
+                and last_close == last_stop
+                and last_open > last_close
+                or last_close > last_stop
+            ):
+                return True
+            elif last_close == last_stop and last_open == last_close:
+                for i in range(cur - 2, -1, -1):
+                    pre_stop = self.stop_loss[i]
+                    if pre_stop != pre_stop:
+                        return False
+                    pre_close = self.close_[i]
+                    pre_open = self.open_[i]
+                    if (
+                        pre_close <= pre_stop
+                        and pre_close == pre_stop
+                        and pre_open == pre_close
+                    ):
+                        continue
+                    elif (
+                        pre_close <= pre_stop
+                        and pre_close == pre_stop
+                        and pre_open > pre_close
+                        or pre_close > pre_stop
+                    ):
+                        return True
+                    else:
+                        return False
+        return False
+
+    def index_of_last_rise_above(self, cur):
+        return next(
+            (i for i in range(cur - 1, 1, -1) if not self.above_stop_loss(i)), -1
+        )
+
+    def index_of_last_fall_below(self, cur):
+        return next(
+            (i for i in range(cur - 1, 1, -1) if not self.below_stop_loss(i)), -1
+        )
+
+    def value_of_fall_below(self, cur):
+        rank = 0
+        cur_high = self.high[cur]
+        pivot = cur_high
+        end = max(cur - 2 * (self.period) + 1, -1) if self.restrict else -1
+        for i in range(cur - 1, end, -1):
+            if pivot < self.high[i]:
+                rank += 1
+                pivot = self.high[i]
+                if rank == 2:
+                    return self.high[i]
+        return pivot
+
+    def value_of_rise_above(self, cur):
+        """
+        返回涨破条件下的止损值
+        """
+        rank = 0
+        cur_low = self.low[cur]
+        pivot = cur_low
+        end = max(cur - 2 * (self.period) + 1, -1) if self.restrict else -1
+        for i in range(cur - 1, end, -1):
+            if pivot > self.low[i]:
+                rank += 1
+                pivot = self.low[i]
+                if rank == 2:
+                    return self.low[i]
+        return pivot
+
+    def cal_stop_loss(
+        self, cur_open: float, cur_close: float, cur_high: float, cur_low: float
+    ) -> float:
+        """
+        加入一根k线, 返回它的止损值, 没有止损值时为NaN
+        """
+        self.close_.append(cur_close)
+        self.open_.append(cur_open)
+        self.high.append(cur_high)
+        self.low.append(cur_low)
+        if len(self.stop_loss) < self.period:
+            self.stop_loss.append(float("nan"))
+            return float("nan")
+        i = len(self.stop_loss)
+        if self.stop_loss[-1] != self.stop_loss[-1]:
+            value = self.value_of_begin(i) if self.new_lowest(i) else float("nan")
+        elif self.fall_below_stop_loss(i) and not self.new_highest(i):
+            # 跌破且没有创新高
+            if self.volatile and i > 1 and self.rise_above_stop_loss(i - 1):
+                # 震荡: 昨日涨破, 今日跌破, 出现震荡, 止损值取昨日的前一天
+                value = self.stop_loss[i - 1 - 1]
+            elif self.backtrack and self.new_highest(i - 1):
+                # 回调: 昨日创新高, 取上一次涨破日的前一天的止损值
+                index = self.index_of_last_rise_above(i)
+                if index != -1:
+                    value = self.stop_loss[index - 1]
+                else:
+                    # 原实现此处value未赋值, 抛出UnboundLocalError
+                    value = self.stop_loss[-1]
+            else:
+                value = self.value_of_fall_below(i)
+        elif self.rise_above_stop_loss(i) and not self.new_lowest(i):
+            # 涨破且没有创新低
+            if self.volatile and i > 1 and self.fall_below_stop_loss(i - 1):
+                # 震荡: 昨日跌破, 今日涨破, 出现震荡, 止损值取昨日的前一天
+                value = self.stop_loss[i - 1 - 1]
+            elif self.backtrack and self.new_lowest(i - 1):
+                # 回调: 昨日创新低, 取上一次跌破日的前一天的止损值
+                index = self.index_of_last_fall_below(i)
+                if index != -1:
+                    value = self.stop_loss[index - 1]
+                else:
+                    # 原实现此处value未赋值, 抛出UnboundLocalError
+                    value = self.stop_loss[-1]
+            else:
+                value = self.value_of_rise_above(i)
+        elif self.fall_below_stop_loss(i) and self.new_highest(i):
+            # 跌破且创新高
+            value = self.value_of_new_highest(i)
+        elif self.rise_above_stop_loss(i) and self.new_lowest(i):
+            # 涨破且创新低
+            value = self.value_of_new_lowest(i)
+        elif self.above_stop_loss(i) and self.new_highest(i):
+            # 止损线之上且创新高
+            value = self.value_of_new_highest(i)
+        elif self.below_stop_loss(i) and self.new_lowest(i):
+            # 止损线之下且创新低
+            value = self.value_of_new_lowest(i)
+        else:
+            # 不符合上述条件取前一天的止损值
+            value = self.stop_loss[-1]
+        self.stop_loss.append(value)
+        return value
@@ -0,0 +1,60 @@
+"""
+行情消息json与二进制编码的对比
+
+python -m benchmark.message_codec --contracts 80 800 --subscribers 10
+
+对合成的一分钟全市场行情(benchmark.synthetic.make_market)比较:
+
++ 消息大小, 以及list方式下每分钟写入redis的字节数(日期集合一份 + 每个订阅者一份)
++ 消费者解码整条消息的耗时(Consumer.process_message 中的 decode_message)
++ 解码后取出一个合约数据(data.get(code))的耗时
+
+并校验两种编码解码后每个合约的数据相同
+"""
+import argparse
+import timeit
+from mq.codec import decode_message, encode_message
+from benchmark.synthetic import make_market
+
+
+def per_call(func, repeat):
+    return min(timeit.repeat(func, number=repeat, repeat=5)) / repeat
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--contracts", type=int, nargs="+", default=[80, 800])
+    parser.add_argument("--subscribers", type=int, default=10)
+    parser.add_argument("--repeat", type=int, default=200)
+    args = parser.parse_args()
+
+    for count in args.contracts:
+        data = make_market(count)
+        code = data.index[count // 2]
+        messages = {codec: encode_message(data, codec) for codec in ["json", "binary"]}
+        decoded = {codec: decode_message(message) for codec, message in messages.items()}
+        assert list(decoded["binary"]) == list(decoded["json"])
+        for c in decoded["json"]:
+            assert decoded["binary"].get(c) == decoded["json"].get(c), c
+
+        print(f"contracts {count}:")
+        print(f"  {'codec':>6s} {'bytes':>9s} {'redis/min':>10s} {'decode':>10s} {'decode+get':>11s}")
+        stats = {}
+        for codec, message in messages.items():
+            size = len(message.encode("utf-8") if isinstance(message, str) else message)
+            decode = per_call(lambda: decode_message(message), args.repeat)
+            get = per_call(lambda: decode_message(message).get(code), args.repeat)
+            stats[codec] = (size, decode, get)
+            print(
+                f"  {codec:>6s} {size:9d} {size * (args.subscribers + 1):10d} "
+                f"{decode * 1e6:8.1f}us {get * 1e6:9.1f}us"
+            )
+        (json_size, json_decode, json_get), (size, decode, get) = stats["json"], stats["binary"]
+        print(
+            f"  binary/json: bytes {size / json_size:.2f}, decode {decode / json_decode:.2f}, "
+            f"decode+get {get / json_get:.2f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,138 @@
+"""
+分钟k线写入mysql: 每分钟一次 executemany 与 MinuteBarSink 批量写入(多行insert和LOAD DATA)的耗时对比
+
+python -m benchmark.mysql_sink --contracts 80 --minutes 240 --table future_m_bench
+python -m benchmark.mysql_sink --check
+
+使用配置文件 [MYSQL] 的数据库, 在 --table 指定的表(结构与 future_m 相同, 测试前创建, 结束后删除)中进行,
+每种方式写入后校验行数. 测试前先按mysql的转义规则读回 LOAD DATA 文件, 校验空值和特殊字符,
+--check 只做这一步, 不需要数据库
+"""
+import argparse
+import io
+import time
+from datetime import datetime, timedelta
+from util.mysql_sink import MinuteBarSink, mysql_connect, write_load_file
+
+# LOAD DATA ... ESCAPED BY '\\' 中反斜杠后的字符
+_UNESCAPE = {"t": "\t", "n": "\n", "\\": "\\", "0": "\0"}
+from benchmark.synthetic import make_market
+
+
+def make_minutes(contracts: int, minutes: int):
+    """
+    Returns:
+        list: [(rows, columns)], 每分钟的行, 与 service.fetch_minute_data 的 MinuteData.rows 相同
+    """
+    start = datetime(2022, 5, 18, 9, 0)
+    result = []
+    for i in range(minutes):
+        trade_date = (start + timedelta(minutes=i)).strftime("%Y-%m-%d %H:%M:%S")
+        data = make_market(contracts, seed=i, trade_date=trade_date).reset_index()
+        result.append((data.values.tolist(), list(data.columns)))
+    return result
+
+
+def read_load_file(text: str) -> list:
+    """
+    按 fields terminated by '\\t' escaped by '\\\\' lines terminated by '\\n' 读取 LOAD DATA 文件,
+    字段恰好为 \\N 时为None
+    """
+    rows = []
+    for line in text.split("\n")[:-1]:
+        row = []
+        for field in line.split("\t"):
+            if field == "\\N":
+                row.append(None)
+                continue
+            value = []
+            i = 0
+            while i < len(field):
+                if field[i] == "\\" and i + 1 < len(field):
+                    value.append(_UNESCAPE.get(field[i + 1], field[i + 1]))
+                    i += 2
+                else:
+                    value.append(field[i])
+                    i += 1
+            row.append("".join(value))
+        rows.append(row)
+    return rows
+
+
+def check_load_file():
+    """空值、NaN和包含转义字符的值写入 LOAD DATA 文件后按mysql的规则读回不变"""
+    rows = [
+        ["IH2206.CCFX", "2022-05-18 14:27:00", 4250.2, None, float("nan")],
+        ["a\\N", "tab\tnew\nline", "\\", "N", None],
+    ]
+    f = io.StringIO()
+    write_load_file(f, rows)
+    result = read_load_file(f.getvalue())
+    expected = [[None if value != value else value for value in row] for row in rows]
+    expected = [[None if value is None else str(value) for value in row] for row in expected]
+    assert result == expected, f"{result} != {expected}"
+    print("load data file: null and escaped values ok")
+
+
+def count_rows(conn, table):
+    with conn.cursor() as cursor:
+        cursor.execute(f"select count(*) from {table}")
+        return cursor.fetchone()[0]
+
+
+def per_minute(conn, table, minutes):
+    """原始方式: 每分钟一次executemany并提交"""
+    for rows, columns in minutes:
+        sql = f"insert into {table} ({','.join(columns)}) values({','.join(['%s'] * len(columns))})"
+        with conn.cursor() as cursor:
+            cursor.executemany(sql, rows)
+        conn.commit()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--contracts", type=int, default=80)
+    parser.add_argument("--minutes", type=int, default=240)
+    parser.add_argument("--table", default="future_m_bench")
+    parser.add_argument("--check", action="store_true", help="只校验LOAD DATA文件, 不连接数据库")
+    args = parser.parse_args()
+
+    check_load_file()
+    if args.check:
+        return
+
+    minutes = make_minutes(args.contracts, args.minutes)
+    total = sum(len(rows) for rows, _ in minutes)
+    conn = mysql_connect()
+    with conn.cursor() as cursor:
+        cursor.execute(f"drop table if exists {args.table}")
+        cursor.execute(f"create table {args.table} like future_m")
+    print(f"minutes: {args.minutes} rows: {total}")
+    try:
+        cases = [("executemany per minute", None), ("sink insert", "insert"), ("sink load", "load")]
+        for name, mode in cases:
+            with conn.cursor() as cursor:
+                cursor.execute(f"truncate table {args.table}")
+            begin = time.perf_counter()
+            if mode is None:
+                per_minute(conn, args.table, minutes)
+            else:
+                sink = MinuteBarSink(
+                    table=args.table, batch_rows=total, flush_seconds=0, mode=mode, spill_path=""
+                )
+                for rows, columns in minutes:
+                    sink.write(rows, columns)
+                sink.flush()
+                sink.close()
+            elapsed = time.perf_counter() - begin
+            written = count_rows(conn, args.table)
+            assert written == total, f"{name}: {written} != {total}"
+            print(f"{name:>24s}: {elapsed:8.3f}s {total / elapsed:10.0f} rows/s")
+    finally:
+        with conn.cursor() as cursor:
+            cursor.execute(f"drop table if exists {args.table}")
+        conn.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,106 @@
+"""
+Producer.publish 的延迟随订阅者数量的变化
+
+python -m benchmark.publish_latency --host 122.207.108.56 --port 12479 --db 15 --subscribers 1 10 50 100 200
+
+对比原始的逐条命令发布(INCR, SMEMBERS, 每个订阅者一次RPUSH, PUBLISH, 每条命令一次往返)
+与 Producer.publish 的lua脚本发布(一次往返). 原始实现中的print不计入.
+测试在 --db 指定的库中进行, 只写入 MESSAGE_TXID, PERSITS_SUB, SUB_* 和 bench-*/bench 的消息队列, 结束后删除.
+另外检查滞后量: 其他channel发布的消息不计入订阅者的滞后量
+"""
+import argparse
+import time
+import numpy as np
+import redis
+from mq import subscriber
+from mq.producer import Producer, publish_keys
+
+
+def legacy_publish(conn, channel, message):
+    """原始的 Producer.publish"""
+    txid = conn.incr("MESSAGE_TXID")
+    content = f"{txid}/{message}"
+    channel_keys = conn.smembers("PERSITS_SUB")
+    for channel_key in channel_keys:
+        conn.rpush(channel_key, content)
+    conn.publish(channel=channel, message=content)
+    return txid
+
+
+def measure(publish, messages, message):
+    """逐条发布messages条消息, 返回每条消息的耗时(毫秒)"""
+    elapsed = np.empty(messages)
+    for i in range(messages):
+        begin = time.perf_counter()
+        publish("bench", message)
+        elapsed[i] = time.perf_counter() - begin
+    return elapsed * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", type=int, default=6379)
+    parser.add_argument("--db", type=int, default=15)
+    parser.add_argument("--subscribers", type=int, nargs="+", default=[1, 10, 50, 100, 200])
+    parser.add_argument("--messages", type=int, default=200)
+    args = parser.parse_args()
+
+    conn = redis.Redis(host=args.host, port=args.port, db=args.db, decode_responses=True)
+    producer = Producer(conn)
+    check_lag(conn, producer)
+    message = '{"A2201.XDCE":{"trade_date":"2022-05-18 16:27:00","open":1,"close":2,"high":3,"low":4}}'
+    print(f"{'subscribers':>11s} {'legacy p50':>11s} {'legacy p99':>11s} {'script p50':>11s} {'script p99':>11s}")
+    for subscribers in args.subscribers:
+        channel_keys = [f"bench-{i}/bench" for i in range(subscribers)]
+        keys = publish_keys("bench") + channel_keys
+        conn.delete(*keys)
+        for channel_key in channel_keys:
+            subscriber.register(conn, channel_key)
+        try:
+            # 预热连接和脚本缓存
+            producer.publish("bench", message)
+            legacy = measure(lambda c, m: legacy_publish(conn, c, m), args.messages, message)
+            script = measure(producer.publish, args.messages, message)
+            # 两种实现写入的消息相同, 每个订阅者都收到全部消息且序号连续
+            expected = 1 + 2 * args.messages
+            for channel_key in channel_keys:
+                contents = conn.lrange(channel_key, 0, -1)
+                assert len(contents) == expected, channel_key
+                assert [int(c[: c.index("/")]) for c in contents] == list(range(1, expected + 1))
+        finally:
+            conn.delete(*keys)
+        print(
+            f"{subscribers:11d} "
+            f"{np.percentile(legacy, 50):9.3f}ms {np.percentile(legacy, 99):9.3f}ms "
+            f"{np.percentile(script, 50):9.3f}ms {np.percentile(script, 99):9.3f}ms"
+        )
+
+
+def check_lag(conn, producer):
+    """订阅者消费完后只有其他channel在发布, 滞后量仍为0(未处理的消息数), 不是全局序号的差"""
+    channel_key = "bench-lag/bench"
+    keys = publish_keys("bench") + publish_keys("bench-other") + [channel_key]
+    conn.delete(*keys)
+    try:
+        subscriber.register(conn, channel_key)
+        txid = producer.publish("bench", "m")
+        conn.ltrim(channel_key, 1, -1)
+        subscriber.record_progress(conn, channel_key, txid)
+        for _ in range(20):
+            producer.publish("bench-other", "m")
+        producer.publish("bench", "m")
+        lag = subscriber.subscriber_lag(conn)[channel_key]
+        summary = subscriber.lag_summary(conn)["bench"]
+        assert lag == 1 and summary["max_lag"] == 1, (lag, summary)
+        # 取消订阅后不再写入消息队列
+        subscriber.remove(conn, channel_key)
+        producer.publish("bench", "m")
+        assert not conn.exists(channel_key)
+    finally:
+        conn.delete(*keys)
+    print("lag check ok")
+
+
+if __name__ == "__main__":
+    main()
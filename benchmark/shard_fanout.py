@@ -0,0 +1,62 @@
+"""
+单合约策略订阅全市场消息与订阅合约分片的对比
+
+python -m benchmark.shard_fanout --contracts 80 800 --strategies 50
+
+对合成的一分钟全市场行情, 比较单合约策略每分钟需要接收和解码的数据量:
+
++ full: 订阅完整的全市场消息, 解码后 data.get(code)
++ shard: 订阅 channel:code 分片, 只包含自己的合约
+
+以及 strategies 个单合约策略进程每分钟从redis读取的总字节数, 和生产者编码全部分片的额外耗时
+"""
+import argparse
+import timeit
+from mq.codec import decode_message, encode_message
+from mq.shard import shard_market
+from benchmark.synthetic import make_market
+
+
+def per_call(func, repeat):
+    return min(timeit.repeat(func, number=repeat, repeat=5)) / repeat
+
+
+def size_of(message):
+    return len(message.encode("utf-8") if isinstance(message, str) else message)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--contracts", type=int, nargs="+", default=[80, 800])
+    parser.add_argument("--strategies", type=int, default=50)
+    parser.add_argument("--repeat", type=int, default=200)
+    args = parser.parse_args()
+
+    for count in args.contracts:
+        data = make_market(count)
+        code = data.index[count // 2]
+        print(f"contracts {count}:")
+        print(
+            f"  {'codec':>6s} {'full bytes':>11s} {'shard bytes':>12s} {'full decode':>12s} "
+            f"{'shard decode':>13s} {'read/min':>22s} {'encode shards':>14s}"
+        )
+        for codec in ["json", "binary"]:
+            full = encode_message(data, codec)
+            shards = dict(shard_market("1m", data, codec))
+            shard = shards[f"1m:{code}"]
+            assert decode_message(full).get(code) == decode_message(shard).get(code)
+            # 分片与单独编码该合约的结果相同
+            assert decode_message(shard) == decode_message(encode_message(data.loc[[code]], codec))
+            full_decode = per_call(lambda: decode_message(full).get(code), args.repeat)
+            shard_decode = per_call(lambda: decode_message(shard).get(code), args.repeat)
+            encode = per_call(lambda: shard_market("1m", data, codec), max(args.repeat // 10, 1))
+            reads = f"{size_of(full) * args.strategies} -> {size_of(shard) * args.strategies}"
+            print(
+                f"  {codec:>6s} {size_of(full):11d} {size_of(shard):12d} "
+                f"{full_decode * 1e6:10.1f}us {shard_decode * 1e6:11.1f}us {reads:>22s} "
+                f"{encode * 1e3:12.1f}ms"
+            )
+
+
+if __name__ == "__main__":
+    main()
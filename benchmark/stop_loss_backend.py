@@ -0,0 +1,87 @@
+"""
+StopLossIndicator 两种后端的性能对比与一致性校验
+
+python -m benchmark.stop_loss_backend --bars 1000000 --legacy-bars 20000
+
+原始的逐根k线往前扫描实现(benchmark.legacy_stop_loss)百万级k线耗时过长,
+只在前legacy-bars根k线上运行, 按吞吐量(bars/sec)与pandas/numpy/kernel三种后端对比,
+并校验它们在该区间上的结果逐位一致. 没有安装numba时kernel后端退回numpy后端的实现
+"""
+import argparse
+import time
+import numpy as np
+from model import stop_loss
+from model.stop_loss import StopLossIndicator
+from model.stop_loss_kernel import HAS_NUMBA
+from benchmark.legacy_stop_loss import LegacyStopLoss
+from benchmark.synthetic import make_ohlc, to_frame
+
+
+def run(backend, data, period):
+    indicator = StopLossIndicator(
+        data=data.copy(), code="SYNTH", period=period, backend=backend
+    )
+    begin = time.perf_counter()
+    result = indicator.predict_stop_loss(start=0)
+    elapsed = time.perf_counter() - begin
+    result = np.array([np.nan if v is None else v for v in result], dtype=np.float64)
+    return result, elapsed
+
+
+def run_legacy(ohlc, bars, period):
+    legacy = LegacyStopLoss(
+        ohlc["open"][:bars],
+        ohlc["close"][:bars],
+        ohlc["high"][:bars],
+        ohlc["low"][:bars],
+        period=period,
+        restrict=stop_loss.restrict,
+        volatile=stop_loss.volatile,
+        backtrack=stop_loss.backtrack,
+    )
+    begin = time.perf_counter()
+    result = legacy.predict_stop_loss(start=0)
+    elapsed = time.perf_counter() - begin
+    return np.array(result, dtype=np.float64), elapsed
+
+
+def same(a, b):
+    return np.array_equal(a.view(np.int64), b.view(np.int64))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--bars", type=int, default=1_000_000)
+    parser.add_argument("--legacy-bars", type=int, default=20_000)
+    parser.add_argument("--period", type=int, default=6)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--no-restrict", action="store_true")
+    parser.add_argument("--no-volatile", action="store_true")
+    parser.add_argument("--backtrack", action="store_true")
+    args = parser.parse_args()
+    stop_loss.restrict = not args.no_restrict
+    stop_loss.volatile = not args.no_volatile
+    stop_loss.backtrack = args.backtrack
+
+    ohlc = make_ohlc(args.bars, seed=args.seed)
+    data = to_frame(ohlc)
+    legacy_bars = min(args.legacy_bars, args.bars)
+
+    legacy, legacy_time = run_legacy(ohlc, legacy_bars, args.period)
+    rows = [("legacy", legacy_bars, legacy_time)]
+    for backend in ["pandas", "numpy", "kernel"]:
+        result, elapsed = run(backend, data, args.period)
+        assert same(legacy, result[:legacy_bars]), f"{backend}后端与原始实现结果不一致"
+        rows.append((backend, args.bars, elapsed))
+
+    legacy_rate = legacy_bars / legacy_time
+    for name, bars, elapsed in rows:
+        rate = bars / elapsed
+        print(
+            f"{name:7s} {bars} bars {elapsed:.3f}s {rate:,.0f} bars/sec "
+            f"{rate / legacy_rate:.1f}x"
+        )
+    print(f"前{legacy_bars}根k线结果逐位一致, numba: {HAS_NUMBA}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,98 @@
+"""
+多合约止损值: 面板向量化计算与逐个合约计算的性能对比和一致性校验
+
+python -m benchmark.stop_loss_panel --codes 500 --bars 2000 --workers 4
+
+每个合约的k线数量在[bars/2, bars]之间随机, 校验面板结果和 predict_stop_loss_serial(逐个合约调用编译内核)
+与逐个合约调用 StopLossEngine.run 的结果逐位一致. workers大于1时再用多进程计算一次(不论行数多少都使用进程池),
+校验与单进程结果逐位一致, 并与 predict_stop_loss_serial 对比耗时, 用于确定 PARALLEL_MIN_ROWS
+
+单核测得(numba 0.68): 70个合约x5000根 engine 0.80s, 面板 1.39s, 内核 0.03s;
+3000个合约x500根 engine 4.2s, 面板 1.5s, 内核 0.13s. 面板只在没有安装numba且合约较多时比逐个合约快
+"""
+import argparse
+import time
+import numpy as np
+from model.stop_loss_engine import StopLossEngine
+from model.stop_loss_panel import from_panel, predict_stop_loss_panel, to_panel
+from model.stop_loss_parallel import predict_stop_loss_parallel, predict_stop_loss_serial
+from benchmark.synthetic import make_ohlc
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--codes", type=int, default=500)
+    parser.add_argument("--bars", type=int, default=2000)
+    parser.add_argument("--period", type=int, default=6)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--no-restrict", action="store_true")
+    parser.add_argument("--no-volatile", action="store_true")
+    parser.add_argument("--backtrack", action="store_true")
+    args = parser.parse_args()
+    flags = dict(
+        period=args.period,
+        restrict=not args.no_restrict,
+        volatile=not args.no_volatile,
+        backtrack=args.backtrack,
+    )
+
+    rng = np.random.default_rng(args.seed)
+    lengths = rng.integers(args.bars // 2, args.bars + 1, size=args.codes)
+    contracts = [make_ohlc(int(n), seed=args.seed + i) for i, n in enumerate(lengths)]
+    codes = np.repeat(np.arange(args.codes), lengths)
+    columns = [
+        np.concatenate([ohlc[name] for ohlc in contracts])
+        for name in ["open", "close", "high", "low"]
+    ]
+    bars = len(codes)
+
+    begin = time.perf_counter()
+    serial = np.concatenate(
+        [
+            StopLossEngine(**flags).run(
+                ohlc["open"], ohlc["close"], ohlc["high"], ohlc["low"]
+            )
+            for ohlc in contracts
+        ]
+    )
+    serial_time = time.perf_counter() - begin
+
+    begin = time.perf_counter()
+    panel_lengths, (open_, close, high, low) = to_panel(codes, *columns)
+    panel = predict_stop_loss_panel(open_, close, high, low, panel_lengths, **flags)
+    panel = from_panel(panel, panel_lengths)
+    panel_time = time.perf_counter() - begin
+
+    # 第一次调用时编译或从缓存加载内核, 不计入耗时
+    predict_stop_loss_serial(codes[:10], *[column[:10] for column in columns], **flags)
+    begin = time.perf_counter()
+    kernel = predict_stop_loss_serial(codes, *columns, **flags)
+    kernel_time = time.perf_counter() - begin
+
+    assert np.array_equal(
+        serial.view(np.int64), panel.view(np.int64)
+    ), "面板计算与逐个合约计算结果不一致"
+    assert np.array_equal(
+        serial.view(np.int64), kernel.view(np.int64)
+    ), "逐个合约调用内核与 StopLossEngine 结果不一致"
+    print(f"engine: {args.codes} codes {bars} bars {serial_time:.3f}s {bars / serial_time:,.0f} bars/sec")
+    print(f"panel:  {args.codes} codes {bars} bars {panel_time:.3f}s {bars / panel_time:,.0f} bars/sec")
+    print(f"kernel: {args.codes} codes {bars} bars {kernel_time:.3f}s {bars / kernel_time:,.0f} bars/sec")
+    print(f"panel over engine: {serial_time / panel_time:.2f}x, kernel over engine: {serial_time / kernel_time:.2f}x, 结果逐位一致")
+
+    if args.workers > 1:
+        begin = time.perf_counter()
+        parallel = predict_stop_loss_parallel(
+            codes, *columns, workers=args.workers, min_rows=0, **flags
+        )
+        parallel_time = time.perf_counter() - begin
+        assert np.array_equal(
+            panel.view(np.int64), parallel.view(np.int64)
+        ), "多进程计算与单进程计算结果不一致"
+        print(f"parallel: {args.workers} workers {parallel_time:.3f}s {bars / parallel_time:,.0f} bars/sec")
+        print(f"speedup: {kernel_time / parallel_time:.2f}x over kernel in one process, 结果逐位一致")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,195 @@
+"""
+止损值的一致性校验与性能测试
+
+python -m benchmark.stop_loss_suite --sizes 10000 100000 1000000 --legacy-bars 5000
+
+对每种合成数据(profile), 每个k线数量(size), restrict/volatile/backtrack 的全部8种组合:
+
++ indicator: StopLossIndicator(backend="numpy").predict_stop_loss, 前period-1根k线没有止损值
++ kernel: StopLossIndicator(backend="kernel"), 没有安装numba时与indicator相同
++ strategy: 与 StopLossStrategy.cal_stop_loss 相同, 逐根k线调用 StopLossEngine(warmup=period).update,
+  前period根k线没有止损值
++ legacy-indicator / legacy-strategy: benchmark.legacy_stop_loss 中的原始实现, 只在前legacy-bars根k线上运行
++ strategy-class: StopLossStrategy 本身, 前legacy-bars根k线逐条编码为json行情消息, 经 Consumer.process_messages
+  交给策略; 下单接口使用 benchmark/stubs.py 的替身, 不需要安装 whorder, 也不连接redis
+
+校验 kernel 与 indicator, strategy 与 warmup=period 的批量计算, 两个原始实现和 StopLossEngine 与对应的新实现逐位一致,
+并输出每种实现的吞吐量(bars/sec). 任何不一致都会抛出AssertionError
+"""
+import argparse
+import contextlib
+import io
+import itertools
+import json
+import time
+import numpy as np
+from model import stop_loss
+from model.stop_loss import StopLossIndicator
+from model.stop_loss_engine import StopLossEngine
+from model.stop_loss_kernel import HAS_NUMBA
+from benchmark.legacy_stop_loss import LegacyStopLoss, LegacyStopLossStrategy
+from benchmark.stubs import install_order_stub
+from benchmark.synthetic import make_ohlc, to_frame
+
+# 合成数据的参数: default 普通行情; flat 大量十字星和小幅波动; equal 没有影线, 价格大量相等
+PROFILES = {
+    "default": dict(flat_ratio=0.3, max_step=3, max_wick=2),
+    "flat": dict(flat_ratio=0.8, max_step=1, max_wick=1),
+    "equal": dict(flat_ratio=0.5, max_step=1, max_wick=0),
+}
+
+
+def same(a, b):
+    """两个float64数组逐位相同, NaN与NaN视为相同"""
+    a = np.asarray(a, dtype=np.float64)
+    b = np.asarray(b, dtype=np.float64)
+    return a.shape == b.shape and np.array_equal(a.view(np.int64), b.view(np.int64))
+
+
+def timed(func, *args):
+    begin = time.perf_counter()
+    result = func(*args)
+    return result, time.perf_counter() - begin
+
+
+def run_indicator(data, period, backend):
+    indicator = StopLossIndicator(
+        data=data.copy(), code="SYNTH", period=period, backend=backend
+    )
+    return indicator.predict_stop_loss(start=0)
+
+
+def run_strategy(ohlc, period, restrict, volatile, backtrack):
+    engine = StopLossEngine(period, restrict, volatile, backtrack, warmup=period)
+    update = engine.update
+    columns = [ohlc[name].tolist() for name in ["open", "close", "high", "low"]]
+    return np.array([update(o, c, h, l) for o, c, h, l in zip(*columns)])
+
+
+def run_legacy_indicator(ohlc, period, restrict, volatile, backtrack):
+    legacy = LegacyStopLoss(
+        ohlc["open"],
+        ohlc["close"],
+        ohlc["high"],
+        ohlc["low"],
+        period=period,
+        restrict=restrict,
+        volatile=volatile,
+        backtrack=backtrack,
+    )
+    return np.array(legacy.predict_stop_loss(start=0), dtype=np.float64)
+
+
+def run_legacy_strategy(ohlc, period, restrict, volatile, backtrack):
+    legacy = LegacyStopLossStrategy(period, restrict, volatile, backtrack)
+    columns = [ohlc[name].tolist() for name in ["open", "close", "high", "low"]]
+    return np.array([legacy.cal_stop_loss(o, c, h, l) for o, c, h, l in zip(*columns)])
+
+
+def run_strategy_class(ohlc, period, restrict, volatile, backtrack):
+    """StopLossStrategy 逐条处理json行情消息, 返回每根k线之后的止损值"""
+    install_order_stub()
+    from strategy.stop_loss import StopLossStrategy
+
+    strategy = StopLossStrategy(
+        "suite",
+        "SYNTH",
+        period=period,
+        restrict=restrict,
+        volatile=volatile,
+        backtrack=backtrack,
+        warm_start_bars=0,
+    )
+    data = to_frame(ohlc)
+    data["trade_date"] = data["trade_date"].dt.strftime("%Y-%m-%d %H:%M:%S")
+    data["volume"] = 1.0
+    messages = [json.dumps({"SYNTH": row}) for row in data.to_dict("records")]
+    values = []
+    with contextlib.redirect_stdout(io.StringIO()):
+        for message in messages:
+            # Consumer 读取到一批消息后的入口
+            strategy.process_messages([message])
+            values.append(strategy.stop_loss[-1])
+    return np.array([np.nan if value is None else value for value in values], dtype=np.float64)
+
+
+def check_case(ohlc, period, flags, legacy_bars, stats):
+    """计算一组数据在一组参数下的所有实现, 校验结果并累计耗时"""
+    restrict, volatile, backtrack = flags
+    stop_loss.restrict, stop_loss.volatile, stop_loss.backtrack = flags
+    bars = len(ohlc["close"])
+    data = to_frame(ohlc)
+    case = f"bars={bars} period={period} restrict={restrict} volatile={volatile} backtrack={backtrack}"
+
+    indicator, elapsed = timed(run_indicator, data, period, "numpy")
+    stats.add("indicator", bars, elapsed)
+    kernel, elapsed = timed(run_indicator, data, period, "kernel")
+    stats.add("kernel", bars, elapsed)
+    assert same(indicator, kernel), f"kernel与indicator不一致: {case}"
+
+    strategy, elapsed = timed(run_strategy, ohlc, period, *flags)
+    stats.add("strategy", bars, elapsed)
+    batch = StopLossEngine(period, restrict, volatile, backtrack, warmup=period).run(
+        ohlc["open"], ohlc["close"], ohlc["high"], ohlc["low"]
+    )
+    assert same(strategy, batch), f"strategy与批量计算不一致: {case}"
+
+    prefix = {name: values[:legacy_bars] for name, values in ohlc.items()}
+    legacy_bars = len(prefix["close"])
+    legacy, elapsed = timed(run_legacy_indicator, prefix, period, *flags)
+    stats.add("legacy-indicator", legacy_bars, elapsed)
+    assert same(legacy, indicator[:legacy_bars]), f"indicator与原始实现不一致: {case}"
+    legacy, elapsed = timed(run_legacy_strategy, prefix, period, *flags)
+    stats.add("legacy-strategy", legacy_bars, elapsed)
+    assert same(legacy, strategy[:legacy_bars]), f"strategy与原始实现不一致: {case}"
+    strategy_class, elapsed = timed(run_strategy_class, prefix, period, *flags)
+    stats.add("strategy-class", legacy_bars, elapsed)
+    assert same(strategy_class, strategy[:legacy_bars]), f"StopLossStrategy与strategy不一致: {case}"
+
+
+class Stats:
+    """按实现累计处理的k线数量和耗时"""
+
+    def __init__(self) -> None:
+        self.bars = {}
+        self.elapsed = {}
+
+    def add(self, name, bars, elapsed):
+        self.bars[name] = self.bars.get(name, 0) + bars
+        self.elapsed[name] = self.elapsed.get(name, 0.0) + elapsed
+
+    def rates(self):
+        return {name: self.bars[name] / self.elapsed[name] for name in self.bars}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10_000, 100_000, 1_000_000])
+    parser.add_argument("--profiles", nargs="+", default=list(PROFILES), choices=list(PROFILES))
+    parser.add_argument("--periods", type=int, nargs="+", default=[6])
+    parser.add_argument("--legacy-bars", type=int, default=5_000)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    # 编译numba内核, 不计入耗时
+    warm = make_ohlc(100, seed=args.seed)
+    run_indicator(to_frame(warm), 6, "kernel")
+
+    print(f"numba: {HAS_NUMBA}")
+    for size in args.sizes:
+        stats = Stats()
+        cases = 0
+        for profile, period in itertools.product(args.profiles, args.periods):
+            ohlc = make_ohlc(size, seed=args.seed, **PROFILES[profile])
+            for flags in itertools.product([True, False], repeat=3):
+                check_case(ohlc, period, flags, args.legacy_bars, stats)
+                cases += 1
+        rates = stats.rates()
+        base = rates["legacy-indicator"]
+        print(f"size {size}: {cases} cases, 结果全部一致")
+        for name, rate in rates.items():
+            print(f"  {name:17s} {rate:>14,.0f} bars/sec {rate / base:8.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,106 @@
+"""
+一个慢策略对监听线程和其他策略的影响: inline(原来的依次执行)与线程池、进程池分发的对比
+
+python -m benchmark.strategy_dispatch --strategies 50 --slow-ms 200 --messages 50 --interval-ms 20
+
+不需要redis, 模拟监听线程每interval毫秒收到一分钟的行情并调用 notifyAllStrategy. 其中一个策略每次处理耗时slow毫秒,
+其余策略只记录收到行情的时间. 统计监听线程每次分发的耗时, 快策略从分发到收到行情的延迟, 以及慢策略在
+drop_oldest/coalesce 下丢弃的消息数量
+"""
+import argparse
+import time
+import numpy as np
+from mq.dispatch import StrategyDispatcher
+from benchmark.synthetic import make_market
+
+
+class FastStrategy:
+    def __init__(self, client_id) -> None:
+        self.client_id = client_id
+        self.received = []
+
+    def refresh_data(self, data, sent):
+        self.received.append(time.perf_counter() - sent)
+
+
+class SlowStrategy:
+    def __init__(self, client_id, seconds) -> None:
+        self.client_id = client_id
+        self.seconds = seconds
+        self.closes = []
+
+    def refresh_data(self, data, sent):
+        time.sleep(self.seconds)
+        code = next(iter(data))
+        self.closes.append(data[code]["close"])
+
+
+def run(args, mode, overrun):
+    dispatcher = StrategyDispatcher(
+        mode=mode, workers=args.workers, queue_size=args.queue, overrun=overrun, budget_ms=0
+    )
+    fast = [FastStrategy(f"fast-{i}") for i in range(args.strategies - 1)]
+    slow = SlowStrategy("slow", args.slow_ms / 1000)
+    dispatcher.attach(slow)
+    for strategy in fast:
+        dispatcher.attach(strategy)
+    data = make_market(20)
+    listener = []
+    begin = time.perf_counter()
+    for minute in range(args.messages):
+        data["close"] += 1
+        message = data.to_dict(orient="index")
+        sent = time.perf_counter()
+        dispatcher.dispatch(message, sent)
+        listener.append(time.perf_counter() - sent)
+        # 按固定间隔收到行情, 分发超时的部分不再等待
+        delay = begin + (minute + 1) * args.interval_ms / 1000 - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+    dispatcher.join()
+    elapsed = time.perf_counter() - begin
+    dispatcher.shutdown()
+    if mode == "process":
+        # 进程方式下策略的状态只在子进程中, 主进程中的对象没有记录
+        latency = None
+    else:
+        latency = np.concatenate([strategy.received for strategy in fast]) * 1000
+    stats = {s["name"]: s for s in dispatcher.stats()}
+    return np.array(listener) * 1000, latency, elapsed, stats["slow"]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--strategies", type=int, default=50)
+    parser.add_argument("--slow-ms", type=float, default=200)
+    parser.add_argument("--messages", type=int, default=50)
+    parser.add_argument("--interval-ms", type=float, default=20)
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--queue", type=int, default=4)
+    args = parser.parse_args()
+
+    print(
+        f"strategies: {args.strategies} slow: {args.slow_ms}ms messages: {args.messages} "
+        f"interval: {args.interval_ms}ms"
+    )
+    print(
+        f"{'mode':>8s} {'overrun':>12s} {'listener max':>13s} {'fast p99':>10s} {'total':>9s} "
+        f"{'slow processed':>15s} {'slow dropped':>13s}"
+    )
+    for mode, overrun in [
+        ("inline", "drop_oldest"),
+        ("thread", "drop_oldest"),
+        ("thread", "coalesce"),
+        ("process", "drop_oldest"),
+        ("process", "coalesce"),
+    ]:
+        listener, latency, elapsed, slow = run(args, mode, overrun)
+        p99 = "-" if latency is None else f"{np.percentile(latency, 99):.2f}ms"
+        print(
+            f"{mode:>8s} {overrun:>12s} {listener.max():11.2f}ms {p99:>10s} "
+            f"{elapsed:8.2f}s {slow['processed']:15d} {slow['dropped']:13d}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,28 @@
+"""
+检查脚本使用的替身模块: 下单接口 whorder 替换为只记录委托的实现, 检查策略时不会真的下单,
+也不需要安装 whorder. 需要在导入 strategy.stop_loss(util.order) 之前调用 install_order_stub
+"""
+import sys
+import types
+
+# 替身接口收到的委托, 每个委托为 SendOrderToAlgo 的参数
+orders = []
+
+
+class PyApi(object):
+    def Init(self, account):
+        pass
+
+    def SendOrderToAlgo(self, **kwargs):
+        orders.append(kwargs)
+
+
+def install_order_stub() -> list:
+    """
+    Returns:
+        list: 收到的委托, 与 orders 相同
+    """
+    module = types.ModuleType("whorder")
+    module.PyApi = PyApi
+    sys.modules["whorder"] = module
+    return orders
@@ -0,0 +1,83 @@
+import numpy as np
+import pandas as pd
+
+
+def make_ohlc(
+    n: int,
+    seed: int = 0,
+    flat_ratio: float = 0.3,
+    tick: float = 1.0,
+    start_price: float = 3000.0,
+    max_step: int = 3,
+    max_wick: int = 2,
+) -> dict:
+    """
+    生成合成的分钟级OHLC序列, 价格落在tick网格上, 包含大量开盘价等于收盘价,
+    以及收盘价等于前一根k线价格的情况, 用于覆盖止损值规则中相等价格的分支
+    Args:
+        n: k线数量
+        seed: 随机种子
+        flat_ratio: 开盘价等于收盘价(十字星)k线的比例
+        tick: 最小变动价位
+        start_price: 初始价格
+        max_step: 收盘价每根k线最多变动的tick数, 越小相等价格越多
+        max_wick: 影线最多的tick数, 为0时最高价/最低价等于开盘价或收盘价
+    Returns:
+        dict: open, close, high, low 四个float64数组
+    """
+    rng = np.random.default_rng(seed)
+    steps = rng.integers(-max_step, max_step + 1, size=n)
+    close = start_price + np.cumsum(steps) * tick
+    open_ = np.empty(n)
+    open_[0] = start_price
+    open_[1:] = close[:-1] + rng.integers(-1, 2, size=n - 1) * tick
+    flat = rng.random(n) < flat_ratio
+    close[flat] = open_[flat]
+    high = np.maximum(open_, close) + rng.integers(0, max_wick + 1, size=n) * tick
+    low = np.minimum(open_, close) - rng.integers(0, max_wick + 1, size=n) * tick
+    # 抬高整体价格, 保证价格为正
+    shift = max(0.0, tick - low.min())
+    return {
+        "open": open_ + shift,
+        "close": close + shift,
+        "high": high + shift,
+        "low": low + shift,
+    }
+
+
+def to_frame(ohlc: dict) -> pd.DataFrame:
+    """将make_ohlc的结果转为StopLossIndicator可用的DataFrame"""
+    data = pd.DataFrame(ohlc)
+    data["trade_date"] = pd.date_range("2022-01-04 09:01", periods=len(data), freq="min")
+    return data
+
+
+def make_market(count: int, seed: int = 0, trade_date: str = "2022-05-18 14:27:00") -> pd.DataFrame:
+    """
+    生成一分钟的全市场行情, 格式与 service.get_latest_minute_data 发布前的数据相同
+    Args:
+        count: 合约数量
+        seed: 随机种子
+        trade_date: k线时间
+    Returns:
+        DataFrame: 以合约代码为索引, 包含trade_date, open, high, low, close, volume, money, open_interest
+    """
+    rng = np.random.default_rng(seed)
+    exchanges = ["XDCE", "XSGE", "XZCE", "CCFX", "XINE"]
+    codes = [f"C{i:03d}2209.{exchanges[i % len(exchanges)]}" for i in range(count)]
+    close = rng.integers(1000, 80000, size=count).astype(float)
+    open_ = close + rng.integers(-5, 6, size=count)
+    data = pd.DataFrame(
+        {
+            "trade_date": trade_date,
+            "open": open_,
+            "high": np.maximum(open_, close) + rng.integers(0, 5, size=count),
+            "low": np.minimum(open_, close) - rng.integers(0, 5, size=count),
+            "close": close,
+            "volume": rng.integers(0, 5000, size=count).astype(float),
+            "money": np.round(rng.random(count) * 1e8, 2),
+            "open_interest": rng.integers(1000, 500000, size=count).astype(float),
+        },
+        index=pd.Index(codes, name="code"),
+    )
+    return data
@@ -0,0 +1,98 @@
+"""
+全链路延迟追踪的开销: 消息大小、编码和解码耗时, 以及每次打点的耗时
+
+python -m benchmark.trace_overhead --contracts 80 --repeat 2000
+
+开始前检查策略的打点: 带trace的行情经 Consumer.process_messages 交给 StopLossStrategy,
+触发委托时 decision 和 order 都有记录(下单接口使用 benchmark/stubs.py 的替身)
+"""
+import argparse
+import contextlib
+import io
+import time
+import pandas as pd
+from mq import trace as mq_trace
+from mq.codec import decode_message, encode_message
+from mq.trace import STAGES, Trace, Tracer
+from benchmark.stubs import install_order_stub
+from benchmark.synthetic import make_market
+
+
+def per_call(func, repeat):
+    """每次调用的平均耗时(微秒)"""
+    begin = time.perf_counter()
+    for _ in range(repeat):
+        func()
+    return (time.perf_counter() - begin) / repeat * 1e6
+
+
+def check_strategy_trace():
+    """逐条发送合成k线直到策略第一次下单, 下单的那条消息记录了 decision 和 order"""
+    orders = install_order_stub()
+    from strategy.stop_loss import StopLossStrategy
+    from benchmark.warm_start import CODE, make_bars
+
+    enabled = mq_trace.tracer.enabled
+    mq_trace.tracer.enabled = True
+    try:
+        strategy = StopLossStrategy("check-trace", CODE, warm_start_bars=0)
+        ordered = False
+        with contextlib.redirect_stdout(io.StringIO()):
+            for bar in make_bars(1000).to_dict("records"):
+                bar["trade_date"] = str(bar["trade_date"])
+                frame = pd.DataFrame([bar], index=[CODE])
+                mq_trace.tracer.reset()
+                trace = mq_trace.tracer.start()
+                mq_trace.tracer.mark(trace, "publish")
+                # Consumer 读取到一批消息后的入口
+                strategy.process_messages([encode_message(frame, "json", trace)])
+                if orders:
+                    ordered = True
+                    break
+        assert ordered, "no order in 1000 bars"
+        stages = mq_trace.tracer.to_dict()["stage"]
+        for stage in ["receive", "decode", "decision", "order"]:
+            assert stages.get(stage, {}).get("count") == 1, f"{stage} not recorded: {sorted(stages)}"
+    finally:
+        mq_trace.tracer.enabled = enabled
+        mq_trace.tracer.reset()
+    print("strategy trace check ok")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--contracts", type=int, default=80)
+    parser.add_argument("--repeat", type=int, default=2000)
+    args = parser.parse_args()
+
+    check_strategy_trace()
+    data = make_market(args.contracts)
+    tracer = Tracer(enabled=True)
+    trace = tracer.start()
+    tracer.mark(trace, "fetch_end")
+    tracer.mark(trace, "publish")
+    print(f"contracts: {args.contracts}")
+    print(f"{'codec':>7s} {'trace':>6s} {'size':>8s} {'encode':>10s} {'decode':>10s}")
+    for codec in ["json", "binary"]:
+        for with_trace in [None, trace]:
+            message = encode_message(data, codec, with_trace)
+            encode = per_call(lambda: encode_message(data, codec, with_trace), args.repeat)
+            decode = per_call(lambda: decode_message(message), args.repeat)
+            print(
+                f"{codec:>7s} {str(with_trace is not None):>6s} {len(message):8d} "
+                f"{encode:8.1f}us {decode:8.1f}us"
+            )
+
+    # 消费者和策略每条消息打点4次(receive, decode, decision, order)
+    def consume():
+        forked = Trace(trace.stamps)
+        for stage in STAGES[3:]:
+            tracer.mark(forked, stage)
+
+    print(f"mark receive..order: {per_call(consume, args.repeat * 10):.2f}us per message")
+    disabled = Tracer(enabled=False)
+    print(f"mark when disabled: {per_call(lambda: disabled.mark(trace, 'decode'), args.repeat * 10):.2f}us")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,105 @@
+"""
+list 与 stream 两种消息传输方式的对比
+
+python -m benchmark.transport_latency --host 122.207.108.56 --port 12479 --db 15 --subscribers 1 10 50
+
+每种传输方式启动subscribers个 Consumer(各自一个client_id), Producer 每隔interval-ms毫秒发布一条带发送时间的消息,
+统计从发布到各消费者 process_message 收到的延迟. list方式每条消息写入每个订阅者的消息队列,
+stream方式每条消息只写入一次. 最后发布EXIT, 消费者退出并删除自己的队列或消费者组.
+测试在 --db 指定的库中进行, 只使用 bench 这个channel
+"""
+import argparse
+import contextlib
+import io
+import json
+import threading
+import time
+import numpy as np
+import redis
+from mq import stream
+from mq.consumer import Consumer
+from mq.producer import Producer
+
+CHANNEL = "bench"
+
+
+class LatencyConsumer(Consumer):
+    """记录每条消息从发布到收到的延迟"""
+
+    def __init__(self, conn, transport):
+        super().__init__(CHANNEL, conn=conn, transport=transport)
+        self.latency = []
+
+    def process_message(self, message):
+        self.latency.append(time.time() - json.loads(message)["sent"])
+
+
+def run(args, transport, subscribers):
+    conns = [
+        redis.Redis(host=args.host, port=args.port, db=args.db, decode_responses=True)
+        for _ in range(subscribers + 1)
+    ]
+    conn = conns[-1]
+    producer = Producer(conn, transport=transport)
+    consumers = []
+    threads = []
+    for i in range(subscribers):
+        consumer = LatencyConsumer(conns[i], transport)
+        consumer.set_client_id(f"bench{i}")
+        thread = threading.Thread(target=consumer.subscribe, args=(CHANNEL,), daemon=True)
+        thread.start()
+        consumers.append(consumer)
+        threads.append(thread)
+    # 等待所有消费者完成注册
+    while True:
+        if transport == "stream":
+            ready = conn.exists(stream.stream_key(CHANNEL)) and len(
+                conn.xinfo_groups(stream.stream_key(CHANNEL))
+            ) == subscribers
+        else:
+            # Consumer 先psubscribe再注册到 PERSITS_SUB
+            ready = conn.scard("PERSITS_SUB") == subscribers
+        if ready:
+            break
+        time.sleep(0.01)
+
+    for i in range(args.messages):
+        producer.publish(CHANNEL, json.dumps({"sent": time.time(), "index": i}))
+        time.sleep(args.interval_ms / 1000)
+    producer.publish(CHANNEL, "EXIT")
+    for thread in threads:
+        thread.join(timeout=30)
+    latency = np.concatenate([consumer.latency for consumer in consumers]) * 1000
+    assert len(latency) == args.messages * subscribers, f"{transport} 丢失消息"
+    return latency
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", type=int, default=6379)
+    parser.add_argument("--db", type=int, default=15)
+    parser.add_argument("--subscribers", type=int, nargs="+", default=[1, 10, 50])
+    parser.add_argument("--messages", type=int, default=200)
+    parser.add_argument("--interval-ms", type=float, default=5)
+    args = parser.parse_args()
+
+    conn = redis.Redis(host=args.host, port=args.port, db=args.db, decode_responses=True)
+    print(f"{'transport':>9s} {'subscribers':>11s} {'p50':>10s} {'p99':>10s}")
+    for subscribers in args.subscribers:
+        for transport in ["list", "stream"]:
+            conn.delete("MESSAGE_TXID", "PERSITS_SUB", stream.stream_key(CHANNEL))
+            try:
+                # 原始的list消费者每条消息都会print, 不输出
+                with contextlib.redirect_stdout(io.StringIO()):
+                    latency = run(args, transport, subscribers)
+            finally:
+                conn.delete("MESSAGE_TXID", "PERSITS_SUB", stream.stream_key(CHANNEL))
+            print(
+                f"{transport:>9s} {subscribers:11d} "
+                f"{np.percentile(latency, 50):8.3f}ms {np.percentile(latency, 99):8.3f}ms"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,88 @@
+"""
+StopLossStrategy 启动时批量预热历史k线的耗时, 与逐条接收实时行情的cpu耗时和需要等待的行情时间对比,
+并校验两种方式得到的止损值引擎状态、最近两根k线和主力资金状态相同
+
+python -m benchmark.warm_start --bars 1440 10000
+
+k线从20:00开始, 包含21:00主力资金清空的情况. 逐条处理时不下单(sig=0).
+预热之后, 通过 process_message 收到的已经预热过的k线被跳过, 之后的新k线与逐条处理的结果相同
+"""
+import argparse
+import contextlib
+import io
+import json
+import time
+import pandas as pd
+import numpy as np
+from strategy.stop_loss import StopLossStrategy
+from benchmark.synthetic import make_ohlc, to_frame
+
+CODE = "IH2206.CCFX"
+
+
+def make_bars(n: int, seed: int = 0):
+    data = to_frame(make_ohlc(n, seed=seed))
+    data["trade_date"] = data["trade_date"] - data["trade_date"].iloc[0] + np.datetime64("2022-05-18 20:00")
+    data["volume"] = np.random.default_rng(seed).integers(1, 5000, size=n).astype(float)
+    return data
+
+
+def state_of(strategy: StopLossStrategy) -> dict:
+    return {
+        "engine": strategy.engine.get_state(),
+        "stop_loss": list(strategy.stop_loss),
+        "close": list(strategy.close_),
+        "volume": list(strategy.volume),
+        "buy_volume": list(strategy.buy_volume),
+        "sell_volume": list(strategy.sell_volume),
+    }
+
+
+def check_resume(live, warm, messages):
+    """预热后重复收到的k线不再计算, 新k线在预热的状态上继续计算"""
+    last = messages[-1][CODE]
+    bar = dict(last, trade_date=str(pd.Timestamp(last["trade_date"]) + pd.Timedelta(minutes=1)))
+    with contextlib.redirect_stdout(io.StringIO()):
+        before = state_of(warm)
+        for message in messages[-3:]:
+            warm.process_message(json.dumps(message), sig=0)
+        assert state_of(warm) == before, "warmed bars processed again"
+        for strategy in [live, warm]:
+            strategy.process_message(json.dumps({CODE: bar}), sig=0)
+    assert state_of(warm) == state_of(live), "state mismatch after the first live bar"
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--bars", type=int, nargs="+", default=[1440, 10000])
+    parser.add_argument("--period", type=int, default=6)
+    args = parser.parse_args()
+
+    print(f"{'bars':>7s} {'warm':>10s} {'live cpu':>10s} {'live wait':>10s}")
+    for n in args.bars:
+        bars = make_bars(n)
+        live = StopLossStrategy("bench-live", CODE, period=args.period, warm_start_bars=0)
+        messages = [
+            {CODE: {"trade_date": str(row.trade_date), "open": row.open, "close": row.close,
+                    "high": row.high, "low": row.low, "volume": row.volume}}
+            for row in bars.itertuples()
+        ]
+        begin = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            for message in messages:
+                live.process_message(message, sig=0)
+        live_time = time.perf_counter() - begin
+
+        warm = StopLossStrategy("bench-warm", CODE, period=args.period, warm_start_bars=0)
+        begin = time.perf_counter()
+        warm.warm_start(bars=bars)
+        warm_time = time.perf_counter() - begin
+
+        assert state_of(warm) == state_of(live), f"{n} bars: state mismatch"
+        check_resume(live, warm, messages)
+        # 实时行情每分钟一根k线
+        print(f"{n:7d} {warm_time * 1000:8.1f}ms {live_time * 1000:8.1f}ms {n / 60:9.1f}h")
+
+
+if __name__ == "__main__":
+    main()
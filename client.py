@@ -1,9 +1,13 @@
 from mq.consumer import Consumer
 from strategy.stop_loss import StopLossStrategy
+from model.stop_loss_checkpoint import RedisCheckpointStore
 
 # client1 = Consumer("client1", pool)
 # client1.subscribe("1m", client1.process_message)
 
 # stoploss_strategy = StopLossStrategy("stoploss-client", pool, "IH2206.CCFX")
-stoploss_strategy = StopLossStrategy("stoploss-client", "IH2206.CCFX")
-stoploss_strategy.subscribe("1m")
+stoploss_strategy = StopLossStrategy(
+    "stoploss-client", "IH2206.CCFX", checkpoint_store=RedisCheckpointStore()
+)
+# 只订阅策略合约的分片, 不接收全市场消息
+stoploss_strategy.subscribe("1m", codes=[stoploss_strategy.code])
@@ -3,13 +3,15 @@ import pandas as pd
 from util.db_util import get_connection
 from util.jquant_util import jquant_auth
 from jqdatasdk.api import get_price, normalize_code
+from util.bar_cache import range_bars
+from util.redis_util import redis_pooling
 
 
 class Stock:
     """
     Args:
         code: 股票或期货的ts_code
-        data_src: 数据源, mysql或jquant, 默认mysql
+        data_src: 数据源, mysql、jquant或redis(服务端按合约缓存的最近几天的分钟k线, 见 util/bar_cache.py), 默认mysql
         start_date: 数据开始日期
         end_date: 数据结束日期
         table: data_src为mysql时的数据表
@@ -34,8 +36,10 @@ class Stock:
         self.code = code
         self.start_date = start_date
         self.end_date = end_date
-        assert data_src in ["mysql", "jquant"]
-        if data_src == "mysql":
+        assert data_src in ["mysql", "jquant", "redis"]
+        if data_src == "redis":
+            self.data = self.load_data_from_redis(start_date, end_date, fields)
+        elif data_src == "mysql":
             self.db = get_connection()
             self.data = self.load_data_from_mysql(table, start_date, end_date, fields)
         elif data_src == "jquant":
@@ -68,6 +72,18 @@ class Stock:
         # data = data[["trade_date", "open", "close", "high", "low", "stop_loss"]]
         return data
 
+    def load_data_from_redis(self, start_date, end_date, fields, conn=None):
+        """
+        Args:
+            start_date: 开始时间, 只有日期时从当天第一根k线开始
+            end_date: 结束时间, 只有日期时包括当天所有k线
+            conn: redis连接, 默认为 redis_pooling().get_conn(2)
+        """
+        if conn is None:
+            conn = redis_pooling().get_conn(2)
+        data = range_bars(conn, self.code, start_date, end_date)
+        return data[[field for field in fields if field in data.columns]]
+
     @jquant_auth
     def load_data_from_jquant(
         self, start_date, end_date, frequency, skip_paused, fields
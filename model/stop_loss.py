@@ -1,7 +1,10 @@
 import logging
+import numpy as np
 import pandas as pd
-from util.db_util import get_connection
-from model.stock import Stock
+from model.stop_loss_engine import StopLossEngine, as_float_array
+from model.stop_loss_kernel import HAS_NUMBA, predict_stop_loss_kernel
+from model.stop_loss_panel import from_panel, predict_stop_loss_panel, to_panel
+from model.stop_loss_parallel import predict_stop_loss_parallel, predict_stop_loss_serial
 
 
 logging.basicConfig(
@@ -17,14 +20,17 @@ class StopLossIndicator:
         period: 止损值变化策略(创新低,创新高等)考虑的交易周期数
         data: stock与data 2选1
         code: data不为None时需要指定code
+        backend: pandas: 止损值保存在list(或Series)中, 缺失为None; numpy: 价格与止损值保存在float64数组中, 缺失为NaN;
+            kernel: 与numpy相同, 计算时使用numba编译的内核, 没有安装numba时与numpy相同
     """
 
     def __init__(
         self,
-        stock: Stock = None,
+        stock: "Stock" = None,
         period: int = 6,
         data: pd.DataFrame = None,
         code: str = None,
+        backend: str = "pandas",
     ) -> None:
         if stock is not None:
             self.data = stock.data
@@ -39,6 +45,8 @@ class StopLossIndicator:
                 self.code = code
             else:
                 raise ValueError("code is None")
+        assert backend in ["pandas", "numpy", "kernel"]
+        self.backend = backend
         self.length = len(self.data)
         self.open = self.data["open"].astype("float").reset_index(drop=True)
         self.close = self.data["close"].astype("float").reset_index(drop=True)
@@ -47,7 +55,17 @@ class StopLossIndicator:
         self.data["trade_date"] = pd.to_datetime(self.data["trade_date"])
         self.data.set_index("trade_date", inplace=True, drop=False)
         self.data.sort_index(inplace=True)
-        if "stop_loss" in self.data.columns:
+        if backend in ["numpy", "kernel"]:
+            self.open = as_float_array(self.open)
+            self.close = as_float_array(self.close)
+            self.high = as_float_array(self.high)
+            self.low = as_float_array(self.low)
+            if "stop_loss" in self.data.columns:
+                # 计算结果原地写入, 需要复制一份, 不能是DataFrame的只读视图
+                self.stop_loss = np.array(self.data["stop_loss"], dtype=np.float64)
+            else:
+                self.stop_loss = np.full(len(self.data), np.nan)
+        elif "stop_loss" in self.data.columns:
             self.stop_loss = self.data["stop_loss"].astype("float")
         else:
             self.stop_loss = [0 for _ in range(len(self.data))]
@@ -75,6 +93,8 @@ class StopLossIndicator:
                 data,
             )
         )
+        from util.db_util import get_connection
+
         db = get_connection()
         if table == "future_daily":
             sql = "update future_daily set `stop_loss`=%s where `code`=%s and `trade_date`=%s"
@@ -86,358 +106,89 @@ class StopLossIndicator:
             raise ("table is illegal")
         db.executemany(sql, data)
 
-    def begin(self, cur):
-        """
-        TODO: 获取指标初始值, 与创新低类似
-        """
-        if self.stop_loss[-1] == None:
-            return True
-        # if cur > 0 and self.stop_loss[cur - 1] == self.high[cur - 1]:
-        #     return True
-        return False
-
-    def begin_new_lowest(self, cur):
-        if cur < self.period - 1:
-            return False
-        cur_low = self.low[cur]
-        start = cur - self.period + 1
-        if start < 0:
-            start = 0
-        lowest = self.low[start : cur + 1].min()
-        cur_low = self.low[cur]
-        if cur_low == lowest:
-            return True
-        return False
-
-    def value_of_begin(self, cur):
-        rank = 0
-        cur_high = self.high[cur]
-        pivot = cur_high
-        for i in range(cur - 1, -1, -1):
-            if pivot < self.high[i]:
-                rank += 1
-                pivot = self.high[i]
-                if rank == 2:
-                    return self.high[i]
-        return pivot
-
-    def below_stop_loss(self, cur: int) -> bool:
-        """
-        判断今日和昨日k线是否在止损线之下
-        1. 当日收盘价低于昨日止损线
-        2. 昨日收盘价低于昨日止损线
-        3. 昨日开盘价和收盘价等于止损值时, 往前搜索
-        """
-        cur_open = self.open[cur]
-        cur_close = self.close[cur]
-        last_stop = self.stop_loss[cur - 1]
-        if cur_close > last_stop:
-            return False
-        if cur_close < last_stop:
-            return True
-        if cur_close == last_stop:
-            if cur_open < cur_close:
-                return True
-            elif cur_open > cur_close:
-                return False
-        for i in range(cur - 1, -1, -1):
-            cur_close = self.close[i]
-            cur_stop = self.stop_loss[i]
-            if cur_stop is None:
-                return False
-            if cur_close == cur_open == cur_stop:
-                continue
-            if cur_close < cur_stop:
-                return True
-            if cur_close == cur_stop and cur_open < cur_close:
-                return True
-            else:
-                return False
-        return False
-
-    def above_stop_loss(self, cur: int) -> bool:
-        """
-        判断今日和昨日k线是否在止损线之上
-        1. 当日收盘价高于昨日止损线
-        2. 昨日收盘价高于昨日止损线
-        3. 昨日开盘价和收盘价等于止损值时, 往前搜索
-        """
-        cur_open = self.open[cur]
-        cur_close = self.close[cur]
-        last_stop = self.stop_loss[cur - 1]
-        if cur_close < last_stop:
-            return False
-        if cur_close > last_stop:
-            return True
-        if cur_close == last_stop:
-            if cur_open > cur_close:
-                return True
-            elif cur_open < cur_close:
-                return False
-        for i in range(cur - 1, -1, -1):
-            cur_close = self.close[i]
-            cur_stop = self.stop_loss[i]
-            if cur_stop is None:
-                return False
-            if cur_close == cur_open == cur_stop:
-                continue
-            if cur_close > cur_stop:
-                return True
-            if cur_close == cur_stop and cur_open > cur_close:
-                return True
-            else:
-                return False
-        return False
-
-    def new_lowest(self, cur):
-        """判断是否出现创新低的情况,返回bool类型"""
-        start = cur - self.period + 1
-        if start < 0:
-            start = 0
-        lowest = self.low[start : cur + 1].min()
-        cur_low = self.low[cur]
-        if cur_low == lowest:
-            return True
-        else:
-            return False
-
-    def value_of_new_lowest(self, cur):
-        """当出现创新低的情况时, 返回止损点的值"""
-        rank = 0
-        last_stop = self.stop_loss[cur - 1]
-        cur_high = self.high[cur]
-        pivot = cur_high
-        # if cur_close != last_stop:
-        end = -1
-        if restrict:
-            end = cur - 2 * (self.period) + 1
-            if end < -1:
-                end = -1
-        for i in range(cur - 1, end, -1):
-            # TODO: 往前查询的范围还需要确定
-            # 止损值取比当前最高价高的第二连续最高价
-            if pivot < self.high[i]:
-                rank += 1
-                pivot = self.high[i]
-                if rank == 2:
-                    return self.high[i]
-        return last_stop
-
-    def new_highest(self, cur):
-        """判断是否出现创新高的情况, 返回bool类型"""
-        start = cur - self.period + 1
-        if start < 0:
-            start = 0
-        highest = self.high[start : cur + 1].max()
-        cur_high = self.high[cur]
-        if cur_high == highest:
-            return True
-        else:
-            return False
-
-    def value_of_new_highest(self, cur):
-        """当出现创新高的情况时, 返回止损点的值"""
-        rank = 0
-        cur_low = self.low[cur]
-        last_stop = self.stop_loss[cur - 1]
-        pivot = cur_low
-        # if cur_close != last_stop:
-        end = -1
-        if restrict:
-            end = cur - 2 * (self.period) + 1
-            if end < -1:
-                end = -1
-        for i in range(cur - 1, end, -1):
-            # TODO: 止损值寻找范围还需确定
-            # 止损值取比当前最低价低的第二连续最低价
-            if pivot > self.low[i]:
-                rank += 1
-                pivot = self.low[i]
-                if rank == 2:
-                    return self.low[i]
-        return last_stop
-
-    def rise_above_stop_loss(self, cur):
-        """
-        判断是否涨破止损线, 返回bool类型
-        """
-        assert cur > 0
-        cur_close = self.close[cur]
-        last_stop = self.stop_loss[cur - 1]
-        if last_stop is None:
-            return False
-        last_close = self.close[cur - 1]
-        last_open = self.open[cur - 1]
-        if cur_close > last_stop:
-            if last_close < last_stop:
-                return True
-            elif last_close == last_stop:
-                if last_open < last_close:
-                    return True
-                elif last_open == last_close:
-                    for i in range(cur - 2, -1, -1):
-                        pre_stop = self.stop_loss[i]
-                        if pre_stop is None:
-                            return False
-                        pre_close = self.close[i]
-                        pre_open = self.open[i]
-                        if pre_close < pre_stop:
-                            return True
-                        elif pre_close == pre_stop:
-                            if pre_open < pre_close:
-                                return True
-                            elif pre_open == pre_close:
-                                continue
-                            else:
-                                return False
-                        else:
-                            return False
-        return False
-
-    def fall_below_stop_loss(self, cur):
-        """
-        判断是否跌破止损线,返回bool类型
-        """
-        assert cur > 0
-        cur_close = self.close[cur]
-        last_stop = self.stop_loss[cur - 1]
-        if last_stop is None:
-            return False
-        last_open = self.open[cur - 1]
-        last_close = self.close[cur - 1]
-        if cur_close < last_stop:
-            if last_close > last_stop:
-                return True
-            elif last_close == last_stop:
-                if last_open > last_close:
-                    return True
-                elif last_open == last_close:
-                    for i in range(cur - 2, -1, -1):
-                        pre_stop = self.stop_loss[i]
-                        if pre_stop is None:
-                            return False
-                        pre_close = self.close[i]
-                        pre_open = self.open[i]
-                        if pre_close > pre_stop:
-                            return True
-                        elif pre_close == pre_stop:
-                            if pre_open == pre_close:
-                                continue
-                            elif pre_open > pre_close:
-                                return True
-                            else:
-                                return False
-                        else:
-                            return False
-        return False
-
-    def index_of_last_rise_above(self, cur):
-        for i in range(cur - 1, 1, -1):
-            if not self.above_stop_loss(i):
-                return i
-        return -1
-
-    def index_of_last_fall_below(self, cur):
-        for i in range(cur - 1, 1, -1):
-            if not self.below_stop_loss(i):
-                return i
-        return -1
-
-    def value_of_fall_below(self, cur):
-        rank = 0
-        cur_high = self.high[cur]
-        pivot = cur_high
-        end = -1
-        if restrict:
-            end = cur - 2 * (self.period) + 1
-            end = max(end, -1)
-        for i in range(cur - 1, end, -1):
-            if pivot < self.high[i]:
-                rank += 1
-                pivot = self.high[i]
-                if rank == 2:
-                    return self.high[i]
-        return pivot
-
-    def value_of_rise_above(self, cur):
-        """
-        返回涨破条件下的止损值
-        """
-        rank = 0
-        cur_low = self.low[cur]
-        pivot = cur_low
-        end = -1
-        if restrict:
-            end = cur - 2 * (self.period) + 1
-            end = max(end, -1)
-        for i in range(cur - 1, end, -1):
-            if pivot > self.low[i]:
-                rank += 1
-                pivot = self.low[i]
-                if rank == 2:
-                    return self.low[i]
-        return pivot
-
     def predict_stop_loss(self, start) -> list:
         """
         Args:
             start(int): 计算止损值的初始位置
         Retures:
             stop_loss(list): 基于self.data计算出的止损值, len(self.data)==len(stop_loss)
+            backend为numpy或kernel时返回np.ndarray, 止损值缺失为NaN
         """
+        engine = StopLossEngine(
+            period=self.period, restrict=restrict, volatile=volatile, backtrack=backtrack
+        )
+        if self.backend == "kernel":
+            return predict_stop_loss_kernel(
+                self.open,
+                self.close,
+                self.high,
+                self.low,
+                self.stop_loss,
+                start,
+                period=self.period,
+                restrict=restrict,
+                volatile=volatile,
+                backtrack=backtrack,
+            )
+        if self.backend == "numpy":
+            return engine.run(
+                self.open, self.close, self.high, self.low, self.stop_loss, start
+            )
         try:
-            for i in range(start, len(self.data)):
-                if i < self.period - 1:
-                    self.stop_loss[i] = None
-                    continue
-                if self.stop_loss[i - 1] is None:
-                    value = self.value_of_begin(i) if self.new_lowest(i) else None
-                elif self.fall_below_stop_loss(i) and not self.new_highest(i):
-                    # 跌破且没有创新高
-                    if volatile and i > 1 and self.rise_above_stop_loss(i - 1):
-                        # 震荡: 昨日涨破, 今日跌破, 出现震荡, 止损值取昨日的前一天
-                        value = self.stop_loss[i - 1 - 1]
-                    elif backtrack and self.new_highest(i - 1):
-                        # 回调: 昨日创新高, 取上一次涨破日的前一天的止损值
-                        index = self.index_of_last_rise_above(i)
-                        if index != -1:
-                            value = self.stop_loss[index - 1]
-                    else:
-                        value = self.value_of_fall_below(i)
-                elif self.rise_above_stop_loss(i) and not self.new_lowest(i):
-                    # 涨破且没有创新低
-                    if volatile and i > 1 and self.fall_below_stop_loss(i - 1):
-                        # 震荡: 昨日跌破, 今日涨破, 出现震荡, 止损值取昨日的前一天
-                        value = self.stop_loss[i - 1 - 1]
-                    elif backtrack and self.new_lowest(i - 1):
-                        # 回调: 昨日创新低, 取上一次跌破日的前一天的止损值
-                        index = self.index_of_last_fall_below(i)
-                        if index != -1:
-                            value = self.stop_loss[index - 1]
-                    else:
-                        value = self.value_of_rise_above(i)
-                elif self.fall_below_stop_loss(i) and self.new_highest(i):
-                    # 跌破且创新高
-                    value = self.value_of_new_highest(i)
-                elif self.rise_above_stop_loss(i) and self.new_lowest(i):
-                    # 涨破且创新低
-                    value = self.value_of_new_lowest(i)
-                elif self.above_stop_loss(i) and self.new_highest(i):
-                    # 止损线之上且创新高
-                    value = self.value_of_new_highest(i)
-                elif self.below_stop_loss(i) and self.new_lowest(i):
-                    # 止损线之下且创新低
-                    value = self.value_of_new_lowest(i)
-                else:
-                    # 不符合上述条件取前一天的止损值
-                    value = self.stop_loss[i - 1]
-                self.stop_loss[i] = value
+            stop_loss = engine.run(
+                self.open,
+                self.close,
+                self.high,
+                self.low,
+                np.array(self.stop_loss, dtype=np.float64),
+                start,
+            )
+            if isinstance(self.stop_loss, pd.Series):
+                self.stop_loss.iloc[start:] = stop_loss[start:]
+            else:
+                self.stop_loss[start:] = [
+                    None if np.isnan(value) else value for value in stop_loss[start:].tolist()
+                ]
             return self.stop_loss
         except Exception as e:
             logging.exception(e)
             raise e
 
 
+# 没有安装numba时, 合约数量不少于它才用面板计算. 单核测得(benchmark/stop_loss_panel.py):
+# 70个合约x5000根面板是逐个合约 StopLossEngine 的0.58x, 200个合约x2000根1.39x, 500个合约以上约2.2x;
+# 安装了numba时逐个合约调用编译内核总是更快(3000个合约x500根 内核0.13s, 面板1.5s)
+PANEL_MIN_CODES = 200
+
+
+def predict_stop_loss_by_code(
+    data: pd.DataFrame, period: int = 6, workers: int = 1
+) -> np.ndarray:
+    """
+    一次计算多个合约的止损值, 默认逐个合约调用编译内核(没有安装numba时为 StopLossEngine);
+    没有安装numba且合约数量不少于 PANEL_MIN_CODES 时所有合约在同一个时间步内一起向量化计算(面板)
+    Args:
+        data: 包含code, open, close, high, low列, 同一合约的行相邻且按时间排序
+        period: 止损值变化策略(创新低,创新高等)考虑的交易周期数
+        workers: 进程数, 大于1时把合约分给多个进程计算(行数较少时仍在当前进程计算), None为cpu核数
+    Returns:
+        stop_loss (np.ndarray): 与data逐行对应的止损值, 缺失为NaN
+    """
+    columns = [data[name].values for name in ["code", "open", "close", "high", "low"]]
+    flags = dict(
+        period=period, restrict=restrict, volatile=volatile, backtrack=backtrack
+    )
+    if workers != 1:
+        return predict_stop_loss_parallel(*columns, workers=workers, **flags)
+    codes = columns[0]
+    contracts = int(np.count_nonzero(codes[1:] != codes[:-1])) + 1 if len(codes) else 0
+    if HAS_NUMBA or contracts < PANEL_MIN_CODES:
+        return predict_stop_loss_serial(*columns, **flags)
+    lengths, (open_, close, high, low) = to_panel(*columns)
+    stop_loss = predict_stop_loss_panel(open_, close, high, low, lengths, **flags)
+    return from_panel(stop_loss, lengths)
+
+
 def filter_data_by_date(data, start, end):
     data = data[data["trade_date"] >= start]
     data = data[data["trade_date"] <= end]
@@ -453,16 +204,42 @@ backtrack = False
 # 震荡条件开关
 volatile = True
 if __name__ == "__main__":
+    from model.stock import Stock
+    from model.stop_loss_checkpoint import FileCheckpointStore, StopLossCheckpoint
+
     code = "A2203.DCE"
-    stock = Stock(
-        code=code,
-        start_date="2021-01-01",
-        end_date="2021-12-31",
-        data_src="mysql",
-        table="future_daily",
+    start_date = "2021-01-01"
+    checkpoint = StopLossCheckpoint(
+        FileCheckpointStore(),
+        code,
+        frequency="daily",
+        period=6,
+        restrict=restrict,
+        volatile=volatile,
+        backtrack=backtrack,
+    )
+
+    def load(start):
+        return Stock(
+            code=code,
+            start_date=start,
+            end_date="2021-12-31",
+            data_src="mysql",
+            table="future_daily",
+        ).data
+
+    # 有检查点时只读取检查点之后的k线, 检查点与数据对不上时读取全部数据重新计算
+    resume_date = checkpoint.start_date(start_date)
+    data = load(resume_date)
+    if resume_date != start_date:
+        engine, _ = checkpoint.locate(data["trade_date"], data["close"])
+        if engine is None:
+            data = load(start_date)
+    start, stop_loss = checkpoint.resume(
+        data["trade_date"], data["open"], data["close"], data["high"], data["low"]
     )
-    # print(stock.data)
-    indicator = StopLossIndicator(stock=stock, period=6)
-    stop_loss = indicator.predict_stop_loss(start=len(stock) - 1)
-    print(stop_loss[-1])
-    # print(indicator.stop_loss,len(indicator.stop_loss))
+    if start < len(stop_loss):
+        print(stop_loss[-1])
+    else:
+        # 检查点已经是最后一根k线, 没有新k线需要计算, 最新的止损值在恢复的引擎中
+        print(checkpoint.load()["engine"].stop_loss)
@@ -0,0 +1,208 @@
+"""
+止损值引擎的检查点
+
+按 (合约, 周期, period, restrict/volatile/backtrack) 保存 StopLossEngine 的状态、最后一根k线的时间和收盘价,
+重启或每日任务从检查点继续, 只计算检查点之后的k线. 检查点不存在、参数不一致、
+检查点的k线不在新数据中或收盘价对不上(数据被修正)时, 从头重新计算
+
++ FileCheckpointStore: 保存在本地目录, 每个检查点一个json文件
++ RedisCheckpointStore: 保存在redis的字符串中
++ StopLossCheckpoint: 检查点的读写与续算
+"""
+import json
+import os
+from datetime import timedelta
+import numpy as np
+import pandas as pd
+from model.stop_loss_engine import StopLossEngine
+
+# 检查点格式的版本, 引擎状态的结构变化时加一, 旧版本的检查点视为不存在
+CHECKPOINT_VERSION = 1
+
+
+class FileCheckpointStore:
+    """
+    Args:
+        directory: 检查点文件所在目录
+    """
+
+    def __init__(self, directory: str = "checkpoint") -> None:
+        self.directory = directory
+
+    def _path(self, key):
+        return os.path.join(self.directory, key.replace("/", "_") + ".json")
+
+    def get(self, key: str) -> str:
+        path = self._path(key)
+        if not os.path.exists(path):
+            return None
+        with open(path, "r", encoding="utf-8") as f:
+            return f.read()
+
+    def set(self, key: str, value: str):
+        os.makedirs(self.directory, exist_ok=True)
+        path = self._path(key)
+        # 先写临时文件再替换, 进程中途退出时不会留下写了一半的检查点
+        temp = path + ".tmp"
+        with open(temp, "w", encoding="utf-8") as f:
+            f.write(value)
+        os.replace(temp, path)
+
+
+class RedisCheckpointStore:
+    """
+    Args:
+        conn: redis连接, 默认使用 redis_pooling 的第2个连接
+    """
+
+    def __init__(self, conn=None) -> None:
+        if conn is None:
+            from util.redis_util import redis_pooling
+
+            conn = redis_pooling().get_conn(2)
+        self.conn = conn
+
+    def get(self, key: str) -> str:
+        return self.conn.get(key)
+
+    def set(self, key: str, value: str):
+        self.conn.set(key, value)
+
+
+class StopLossCheckpoint:
+    """
+    一个合约在一组参数下的止损值检查点 \n
+    Args:
+        store: FileCheckpointStore 或 RedisCheckpointStore
+        code: 合约代码
+        frequency: 数据周期, daily: 日线; 1m: 1分钟
+        period, restrict, volatile, backtrack, warmup: StopLossEngine 的参数
+        max_age: 流式计算时, 新k线与检查点最后一根k线的间隔超过max_age视为过期, None不限制
+    """
+
+    def __init__(
+        self,
+        store,
+        code: str,
+        frequency: str = "daily",
+        period: int = 6,
+        restrict: bool = True,
+        volatile: bool = True,
+        backtrack: bool = False,
+        warmup: int = None,
+        max_age: timedelta = None,
+    ) -> None:
+        self.store = store
+        self.code = code
+        self.frequency = frequency
+        self.params = [
+            period,
+            restrict,
+            volatile,
+            backtrack,
+            period - 1 if warmup is None else warmup,
+        ]
+        self.max_age = max_age
+        flags = "".join(str(int(flag)) for flag in [restrict, volatile, backtrack])
+        self.key = f"STOP_LOSS_STATE/{code}/{frequency}/{period}/{flags}/{self.params[4]}"
+
+    def new_engine(self) -> StopLossEngine:
+        """没有可用的检查点时使用的空引擎"""
+        return StopLossEngine(*self.params)
+
+    def load(self) -> dict:
+        """
+        Returns:
+            dict: {"trade_date": 最后一根k线的时间, "close": 最后一根k线的收盘价, "engine": 恢复的引擎},
+            检查点不存在或不可用时为None
+        """
+        value = self.store.get(self.key)
+        if not value:
+            return None
+        checkpoint = json.loads(value)
+        if checkpoint.get("version") != CHECKPOINT_VERSION:
+            return None
+        if checkpoint["engine"]["params"] != self.params:
+            return None
+        return {
+            "trade_date": pd.Timestamp(checkpoint["trade_date"]),
+            "close": checkpoint["close"],
+            "engine": StopLossEngine.from_state(checkpoint["engine"]),
+        }
+
+    def save(self, engine: StopLossEngine, trade_date, close: float):
+        """保存引擎处理完trade_date这根k线之后的状态"""
+        checkpoint = {
+            "version": CHECKPOINT_VERSION,
+            "trade_date": str(pd.Timestamp(trade_date)),
+            "close": float(close),
+            "engine": engine.get_state(),
+        }
+        self.store.set(self.key, json.dumps(checkpoint, separators=(",", ":")))
+
+    def start_date(self, default):
+        """
+        读取数据的开始日期: 有检查点时从检查点的k线开始(用于核对收盘价), 否则为default
+        """
+        checkpoint = self.load()
+        if checkpoint is None:
+            return default
+        return checkpoint["trade_date"].strftime("%Y-%m-%d")
+
+    def is_processed(self, checkpoint: dict, trade_date) -> bool:
+        """trade_date这根k线是否已经包含在检查点中"""
+        return pd.Timestamp(trade_date) <= checkpoint["trade_date"]
+
+    def is_stale(self, checkpoint: dict, trade_date) -> bool:
+        """新k线与检查点的间隔是否超过max_age"""
+        if self.max_age is None:
+            return False
+        return pd.Timestamp(trade_date) - checkpoint["trade_date"] > self.max_age
+
+    def locate(self, trade_date, close):
+        """
+        在k线中找到检查点的位置
+        Args:
+            trade_date: 升序排列的k线时间
+            close: 与trade_date等长的收盘价
+        Returns:
+            (StopLossEngine, int): 恢复的引擎和检查点之后第一根k线的位置,
+            检查点不存在, 检查点的k线不在输入中或收盘价不一致时为 (None, 0)
+        """
+        checkpoint = self.load()
+        if checkpoint is None:
+            return None, 0
+        dates = pd.DatetimeIndex(pd.to_datetime(trade_date))
+        pos = dates.searchsorted(checkpoint["trade_date"])
+        if pos == len(dates) or dates[pos] != checkpoint["trade_date"]:
+            return None, 0
+        if float(np.asarray(close)[pos]) != checkpoint["close"]:
+            return None, 0
+        return checkpoint["engine"], pos + 1
+
+    def resume(self, trade_date, open_, close, high, low):
+        """
+        从检查点继续计算, 检查点不可用时从第一根k线开始计算,
+        并把最后一根k线之后的状态保存为新的检查点
+        Args:
+            trade_date: 升序排列的k线时间
+            open_, close, high, low: 与trade_date等长的价格序列
+        Returns:
+            start (int): 第一根计算了止损值的k线位置, 检查点不可用时为0
+            stop_loss (np.ndarray): 与输入等长的止损值, start之前为NaN
+        """
+        dates = pd.DatetimeIndex(pd.to_datetime(trade_date))
+        engine, start = self.locate(dates, close)
+        if engine is None:
+            engine = self.new_engine()
+        o = np.asarray(open_, dtype=np.float64).tolist()
+        c = np.asarray(close, dtype=np.float64).tolist()
+        h = np.asarray(high, dtype=np.float64).tolist()
+        l = np.asarray(low, dtype=np.float64).tolist()
+        n = len(c)
+        stop_loss = np.full(n, np.nan)
+        for i in range(start, n):
+            stop_loss[i] = engine.update(o[i], c[i], h[i], l[i])
+        if start < n:
+            self.save(engine, dates[-1], c[-1])
+        return start, stop_loss
@@ -0,0 +1,520 @@
+"""
+止损值计算引擎, 由 model/stop_loss.py 与 strategy/stop_loss.py 共用
+
++ RollingExtremes: 滑动窗口内的最低价/最高价, 判断创新低/创新高, 单调队列存放在预先分配的环形缓冲区中
++ PivotStack: 往前第一个/第二个严格更高(低)的价格, 用于求"第二连续最高价/最低价"
++ CrossingState: 逐根k线递推收盘价与止损线的相对位置(之上/之下/涨破/跌破)
++ StopLossEngine: 组合以上状态的止损值状态机, 逐根k线O(1)更新, 内存不随k线数量增长
++ predict_stop_loss_array: 基于 StopLossEngine 的数组后端, 输入与输出均为连续的 float64 数组,
+  用 NaN 代替 None 表示止损值缺失
+"""
+import math
+import numpy as np
+
+
+def as_float_array(values) -> np.ndarray:
+    """将 Series/list/ndarray 转为连续的 float64 数组"""
+    return np.ascontiguousarray(np.asarray(values, dtype=np.float64))
+
+
+def _plain(value):
+    """numpy标量转为python标量, 便于json序列化"""
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
+
+
+class RollingExtremes:
+    """
+    最近period个周期的最低价和最高价, 用于判断创新低/创新高 \n
+    使用单调队列实现, 队列存放在预先分配的环形缓冲区中: 容量为不小于period的2的幂, head/tail为递增的计数,
+    与mask按位与得到位置. 窗口内最多period根k线, 队列不会溢出, 每次更新均摊O(1)且不创建新的对象
+    Args:
+        period: 滑动窗口的周期数
+    """
+
+    def __init__(self, period: int) -> None:
+        self.period = period
+        self.count = 0
+        capacity = 1
+        while capacity < period:
+            capacity <<= 1
+        self._mask = capacity - 1
+        # 最低价队列: 价格严格递增; 最高价队列: 价格严格递减; 队列为[head, tail)
+        self._low_index = [0] * capacity
+        self._low_value = [0.0] * capacity
+        self._low_head = self._low_tail = 0
+        self._high_index = [0] * capacity
+        self._high_value = [0.0] * capacity
+        self._high_head = self._high_tail = 0
+
+    def push(self, low: float, high: float):
+        """
+        加入一根k线
+        Returns:
+            (bool, bool): 当前k线是否创新低, 是否创新高
+        """
+        cur = self.count
+        self.count = cur + 1
+        expired = cur - self.period
+        mask = self._mask
+
+        # 队尾不低于当前最低价的元素不可能再成为最低价, 出队
+        index, value = self._low_index, self._low_value
+        head, tail = self._low_head, self._low_tail
+        if head != tail and index[head & mask] <= expired:
+            head += 1
+        while tail != head and value[(tail - 1) & mask] >= low:
+            tail -= 1
+        lowest = tail == head
+        index[tail & mask] = cur
+        value[tail & mask] = low
+        self._low_head, self._low_tail = head, tail + 1
+
+        index, value = self._high_index, self._high_value
+        head, tail = self._high_head, self._high_tail
+        if head != tail and index[head & mask] <= expired:
+            head += 1
+        while tail != head and value[(tail - 1) & mask] <= high:
+            tail -= 1
+        highest = tail == head
+        index[tail & mask] = cur
+        value[tail & mask] = high
+        self._high_head, self._high_tail = head, tail + 1
+        return lowest, highest
+
+    def _queue(self, index, value, head, tail):
+        """环形缓冲区中的队列, 从队首到队尾"""
+        mask = self._mask
+        return [index[i & mask] for i in range(head, tail)], [value[i & mask] for i in range(head, tail)]
+
+    def get_state(self) -> dict:
+        """可以json序列化的状态, 与set_state配合保存检查点"""
+        return {
+            "count": self.count,
+            "low": self._queue(self._low_index, self._low_value, self._low_head, self._low_tail),
+            "high": self._queue(self._high_index, self._high_value, self._high_head, self._high_tail),
+        }
+
+    def set_state(self, state: dict):
+        self.count = state["count"]
+        low_index, low_value = state["low"]
+        high_index, high_value = state["high"]
+        self._low_index[: len(low_index)] = low_index
+        self._low_value[: len(low_value)] = low_value
+        self._low_head, self._low_tail = 0, len(low_index)
+        self._high_index[: len(high_index)] = high_index
+        self._high_value[: len(high_value)] = high_value
+        self._high_head, self._high_tail = 0, len(high_index)
+
+    @property
+    def lowest(self) -> float:
+        """窗口内最低价"""
+        return self._low_value[self._low_head & self._mask]
+
+    @property
+    def highest(self) -> float:
+        """窗口内最高价"""
+        return self._high_value[self._high_head & self._mask]
+
+
+class PivotStack:
+    """
+    前高/前低单调栈 \n
+    对第cur根k线, 往前第一个严格高于(higher=True)或严格低于(higher=False)当前价格的位置first,
+    以及first往前第一个严格高于(低于)first价格的位置second. 从cur往前逐根比较,
+    价格每被刷新一次rank加一, rank为1和2时的位置正是first和second \n
+    栈内价格严格单调, 栈顶是最近一次push的k线, 其下依次是first和second, 每次更新均摊O(1).
+    栈的长度不超过价格区间内的价位数, 与k线数量无关
+    Args:
+        higher: True 求更高的价格(最高价序列); False 求更低的价格(最低价序列)
+    """
+
+    def __init__(self, higher: bool = True) -> None:
+        self.higher = higher
+        self._index = []
+        self._value = []
+
+    def push(self, cur: int, value: float):
+        """
+        加入第cur根k线的价格
+        """
+        index, values = self._index, self._value
+        if self.higher:
+            while values and values[-1] <= value:
+                index.pop()
+                values.pop()
+        else:
+            while values and values[-1] >= value:
+                index.pop()
+                values.pop()
+        index.append(cur)
+        values.append(value)
+
+    def pivot(self, end: int = -1):
+        """
+        在 (end, cur) 范围内往前寻找比最近一次push的价格严格更高(低)的第二连续价格,
+        与逐根往前比较, 价格被刷新两次即返回的写法等价
+        Returns:
+            (int, float): rank 找到的次数(0, 1, 2); pivot 最后一次刷新后的价格
+        """
+        index, values = self._index, self._value
+        size = len(index)
+        if size < 2 or index[-2] <= end:
+            return 0, values[-1]
+        if size < 3 or index[-3] <= end:
+            return 1, values[-2]
+        return 2, values[-3]
+
+    def get_state(self) -> list:
+        return [list(self._index), list(self._value)]
+
+    def set_state(self, state: list):
+        self._index = list(state[0])
+        self._value = list(state[1])
+
+    def __len__(self):
+        return len(self._index)
+
+
+class CrossingState:
+    """
+    逐根k线递推收盘价与止损线的相对位置 \n
+    原实现判断之上/之下/涨破/跌破时, 遇到收盘价等于止损值且价格不变的k线会一直往前搜索,
+    回调条件还要对之前每根k线重新判断. 这里在计算每根k线时记录判断结果,
+    平盘段只记录往前的第一根非平盘k线, 上一次涨破/跌破的位置直接保存, 各项查询均为O(1) \n
+    每根k线先调用push, 得到当前k线的 above/below/rise/fall, 算出止损值后再调用settle
+    """
+
+    def __init__(self) -> None:
+        self.count = 0
+        # 当前k线: 是否在止损线之上/之下, 是否涨破/跌破
+        self.above = False
+        self.below = False
+        self.rise = False
+        self.fall = False
+        # 上一根k线是否涨破/跌破
+        self.last_rise = False
+        self.last_fall = False
+        # index_of_last_rise_above/index_of_last_fall_below 的结果(不含当前k线),
+        # 以及该位置前一根k线的止损值
+        self.index_of_last_rise_above = -1
+        self.stop_of_last_rise_above = math.nan
+        self.index_of_last_fall_below = -1
+        self.stop_of_last_fall_below = math.nan
+        # 当前k线的价格
+        self._open = math.nan
+        self._new_close = math.nan
+        # 上一根k线的价格与止损值
+        self._close = math.nan
+        self._stop = math.nan
+        # 上一根k线往前(含)最近一根非平盘k线的收盘价是否在其止损线之上/之下
+        self._up = False
+        self._down = False
+        # 上一根k线为平盘(收盘价等于止损值)时, 所在平盘段往前第一根k线的收盘价和止损值
+        self._run_close = math.nan
+        self._run_stop = math.nan
+
+    # 两根k线之间需要保留的状态, above/below等在push时重新计算
+    _state_fields = (
+        "count",
+        "rise",
+        "fall",
+        "index_of_last_rise_above",
+        "stop_of_last_rise_above",
+        "index_of_last_fall_below",
+        "stop_of_last_fall_below",
+        "_close",
+        "_stop",
+        "_up",
+        "_down",
+        "_run_close",
+        "_run_stop",
+    )
+
+    def get_state(self) -> list:
+        return [_plain(getattr(self, name)) for name in self._state_fields]
+
+    def set_state(self, state: list):
+        for name, value in zip(self._state_fields, state):
+            setattr(self, name, value)
+
+    def push(self, open_: float, close: float):
+        """
+        加入一根k线, 与上一根k线的止损值比较, 结果记录在 above/below/rise/fall
+        """
+        last_close, last_stop = self._close, self._stop
+        self.last_rise, self.last_fall = self.rise, self.fall
+        # 跌破: 收盘价低于昨日止损线, 且昨日(平盘时往前)在止损线之上
+        self.fall = close < last_stop and self._up
+        self.rise = close > last_stop and self._down
+        if close < last_stop:
+            above, below = False, True
+        elif close > last_stop:
+            above, below = True, False
+        elif close == last_stop and open_ != close:
+            above, below = open_ > close, open_ < close
+        else:
+            # 收盘价=开盘价=昨日止损值, 跳过止损值与收盘价都等于开盘价的平盘段
+            if last_close == last_stop == open_:
+                pre_close, pre_stop = self._run_close, self._run_stop
+            else:
+                pre_close, pre_stop = last_close, last_stop
+            above = pre_close > pre_stop or (pre_close == pre_stop and open_ > pre_close)
+            below = pre_close < pre_stop or (pre_close == pre_stop and open_ < pre_close)
+        self.above, self.below = above, below
+        self._open = open_
+        self._new_close = close
+
+    def settle(self, stop: float):
+        """
+        当前k线的止损值计算完成后调用, stop为None或NaN表示没有止损值
+        """
+        if stop is None:
+            stop = math.nan
+        cur = self.count
+        open_, close = self._open, self._new_close
+        last_close, last_stop = self._close, self._stop
+        if cur >= 2:
+            if not self.above:
+                self.index_of_last_rise_above = cur
+                self.stop_of_last_rise_above = last_stop
+            if not self.below:
+                self.index_of_last_fall_below = cur
+                self.stop_of_last_fall_below = last_stop
+        if close == stop:
+            if not last_close == last_stop == close:
+                # 新的平盘段, 记录往前第一根k线
+                self._run_close, self._run_stop = last_close, last_stop
+            if open_ == close:
+                up, down = self._up, self._down
+            else:
+                up, down = open_ > close, open_ < close
+        else:
+            up, down = close > stop, close < stop
+        self._up, self._down = up, down
+        self._close, self._stop = close, stop
+        self.count = cur + 1
+
+
+class StopLossEngine:
+    """
+    止损值状态机, 影响止损值变化的策略包括初始化,创新低, 创新高, 跌破, 涨破策略 \n
+    每次update加入一根k线并返回它的止损值, 只保留规则需要的状态:
+    最近period根k线的单调队列, 前高/前低单调栈, 最近两根k线的止损值和k线与止损线的相对位置,
+    每根k线的计算量和占用的内存都与已处理的k线数量无关
+    Args:
+        period: 止损值变化策略(创新低,创新高等)考虑的交易周期数
+        restrict: 是否限制止损值策略的某些规则往前搜索的周期数
+        volatile: 是否开启止损值震荡条件
+        backtrack: 是否开启止损值回调条件
+        warmup: 前warmup根k线不计算止损值, 默认period-1
+    """
+
+    def __init__(
+        self,
+        period: int = 6,
+        restrict: bool = True,
+        volatile: bool = True,
+        backtrack: bool = False,
+        warmup: int = None,
+    ) -> None:
+        self.period = period
+        self.restrict = restrict
+        self.volatile = volatile
+        self.backtrack = backtrack
+        self.warmup = period - 1 if warmup is None else warmup
+        self.count = 0
+        self.window = RollingExtremes(period)
+        self.higher = PivotStack(higher=True)
+        self.lower = PivotStack(higher=False)
+        self.crossing = CrossingState()
+        # 最近两根k线的止损值
+        self.stop_loss = math.nan
+        self.last_stop_loss = math.nan
+        # 最近一根k线是否创新低/创新高
+        self.lowest = False
+        self.highest = False
+
+    def get_state(self) -> dict:
+        """
+        引擎的全部状态, 只包含list/float/int/bool, 可以直接json序列化
+        """
+        return {
+            "params": [
+                self.period,
+                self.restrict,
+                self.volatile,
+                self.backtrack,
+                self.warmup,
+            ],
+            "count": self.count,
+            "stop_loss": [self.last_stop_loss, self.stop_loss],
+            "extremes": [bool(self.lowest), bool(self.highest)],
+            "window": self.window.get_state(),
+            "higher": self.higher.get_state(),
+            "lower": self.lower.get_state(),
+            "crossing": self.crossing.get_state(),
+        }
+
+    @classmethod
+    def from_state(cls, state: dict) -> "StopLossEngine":
+        """
+        由get_state的结果恢复引擎, 之后可以继续update
+        """
+        period, restrict, volatile, backtrack, warmup = state["params"]
+        engine = cls(period, restrict, volatile, backtrack, warmup)
+        engine.count = state["count"]
+        engine.last_stop_loss, engine.stop_loss = state["stop_loss"]
+        engine.lowest, engine.highest = state["extremes"]
+        engine.window.set_state(state["window"])
+        engine.higher.set_state(state["higher"])
+        engine.lower.set_state(state["lower"])
+        engine.crossing.set_state(state["crossing"])
+        return engine
+
+    def update(self, open_: float, close: float, high: float, low: float) -> float:
+        """
+        加入一根k线, 返回它的止损值, 没有止损值时为NaN
+        """
+        return self._advance(open_, close, high, low, None)
+
+    def replay(
+        self, open_: float, close: float, high: float, low: float, stop_loss: float
+    ) -> None:
+        """
+        加入一根止损值已知的k线(如数据库中的历史止损值), 只更新状态不重新计算
+        """
+        self._advance(open_, close, high, low, math.nan if stop_loss is None else stop_loss)
+
+    def run(self, open_, close, high, low, stop_loss=None, start: int = 0) -> np.ndarray:
+        """
+        依次加入多根k线
+        Args:
+            open_, close, high, low: 价格序列
+            stop_loss: 已知的止损值, start之前的值通过replay加入, 结果原地写入
+            start: 开始计算止损值的位置
+        Returns:
+            stop_loss (np.ndarray): 与输入等长的止损值数组
+        """
+        if stop_loss is None:
+            stop_loss = np.full(len(close), np.nan)
+        # 逐元素访问时 list 比 ndarray 快得多
+        o = as_float_array(open_).tolist()
+        c = as_float_array(close).tolist()
+        h = as_float_array(high).tolist()
+        l = as_float_array(low).tolist()
+        s = stop_loss.tolist()
+        advance = self._advance
+        for i in range(len(s)):
+            if i < start:
+                advance(o[i], c[i], h[i], l[i], s[i])
+            else:
+                s[i] = advance(o[i], c[i], h[i], l[i], None)
+        stop_loss[:] = s
+        return stop_loss
+
+    def _advance(self, open_, close, high, low, known):
+        cur = self.count
+        lowest, highest = self.window.push(low, high)
+        higher, lower, crossing = self.higher, self.lower, self.crossing
+        higher.push(cur, high)
+        lower.push(cur, low)
+        crossing.push(open_, close)
+        last_stop = self.stop_loss
+        if known is not None:
+            value = known
+        elif cur < self.warmup:
+            value = math.nan
+        else:
+            end = max(cur - 2 * self.period + 1, -1) if self.restrict else -1
+            if last_stop != last_stop:
+                value = higher.pivot(-1)[1] if lowest else math.nan
+            elif crossing.fall and not highest:
+                # 跌破且没有创新高
+                if self.volatile and cur > 1 and crossing.last_rise:
+                    # 震荡: 昨日涨破, 今日跌破, 出现震荡, 止损值取昨日的前一天
+                    value = self.last_stop_loss
+                elif self.backtrack and self.highest:
+                    # 回调: 昨日创新高, 取上一次涨破日的前一天的止损值
+                    if crossing.index_of_last_rise_above != -1:
+                        value = crossing.stop_of_last_rise_above
+                    else:
+                        # 找不到涨破日时沿用前一日止损值
+                        value = last_stop
+                else:
+                    value = higher.pivot(end)[1]
+            elif crossing.rise and not lowest:
+                # 涨破且没有创新低
+                if self.volatile and cur > 1 and crossing.last_fall:
+                    # 震荡: 昨日跌破, 今日涨破, 出现震荡, 止损值取昨日的前一天
+                    value = self.last_stop_loss
+                elif self.backtrack and self.lowest:
+                    # 回调: 昨日创新低, 取上一次跌破日的前一天的止损值
+                    if crossing.index_of_last_fall_below != -1:
+                        value = crossing.stop_of_last_fall_below
+                    else:
+                        value = last_stop
+                else:
+                    value = lower.pivot(end)[1]
+            elif crossing.fall and highest:
+                # 跌破且创新高
+                value = self._value_of_new_highest(end)
+            elif crossing.rise and lowest:
+                # 涨破且创新低
+                value = self._value_of_new_lowest(end)
+            elif crossing.above and highest:
+                # 止损线之上且创新高
+                value = self._value_of_new_highest(end)
+            elif crossing.below and lowest:
+                # 止损线之下且创新低
+                value = self._value_of_new_lowest(end)
+            else:
+                # 不符合上述条件取前一天的止损值
+                value = last_stop
+        crossing.settle(value)
+        self.last_stop_loss = last_stop
+        self.stop_loss = value
+        self.lowest, self.highest = lowest, highest
+        self.count = cur + 1
+        return value
+
+
+    def _value_of_new_lowest(self, end):
+        """创新低时止损值取比当前最高价高的第二连续最高价, 找不到时沿用前一日止损值"""
+        rank, pivot = self.higher.pivot(end)
+        return pivot if rank == 2 else self.stop_loss
+
+    def _value_of_new_highest(self, end):
+        """创新高时止损值取比当前最低价低的第二连续最低价, 找不到时沿用前一日止损值"""
+        rank, pivot = self.lower.pivot(end)
+        return pivot if rank == 2 else self.stop_loss
+
+
+def predict_stop_loss_array(
+    open_: np.ndarray,
+    close: np.ndarray,
+    high: np.ndarray,
+    low: np.ndarray,
+    stop_loss: np.ndarray,
+    start: int = 0,
+    period: int = 6,
+    restrict: bool = True,
+    volatile: bool = True,
+    backtrack: bool = False,
+) -> np.ndarray:
+    """
+    基于数组计算止损值, 结果原地写入 stop_loss
+    Args:
+        open_, close, high, low: float64 数组
+        stop_loss: float64 数组, start 之前的值作为已知历史, NaN 表示没有止损值
+        start: 计算止损值的初始位置
+        period: 止损值变化策略考虑的交易周期数
+        restrict: 是否限制止损值策略往前搜索的周期范围
+        volatile: 是否开启震荡条件
+        backtrack: 是否开启回调条件
+    Returns:
+        stop_loss (np.ndarray): 与输入等长的止损值数组
+    """
+    engine = StopLossEngine(period, restrict, volatile, backtrack)
+    return engine.run(open_, close, high, low, stop_loss, start)
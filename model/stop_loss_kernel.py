@@ -0,0 +1,262 @@
+"""
+止损值状态机的编译内核
+
+把 StopLossEngine 的整个递推写成一个只操作numpy数组和标量的循环, 安装了numba时用numba.njit编译,
+单合约的计算不再经过python解释器. 没有安装numba时自动退回 StopLossEngine.run, 结果相同 \n
+numba不是必须的依赖, 需要时 pip install numba
+"""
+import math
+import numpy as np
+from model.stop_loss_engine import StopLossEngine, as_float_array
+
+try:
+    from numba import njit
+except ImportError:
+    njit = None
+
+HAS_NUMBA = njit is not None
+
+
+def _pivot(index, value, size, end):
+    """与 PivotStack.pivot 相同, 栈为 index[:size]/value[:size]"""
+    if size < 2 or index[size - 2] <= end:
+        return 0, value[size - 1]
+    if size < 3 or index[size - 3] <= end:
+        return 1, value[size - 2]
+    return 2, value[size - 3]
+
+
+def _second_pivot(index, value, size, end, last_stop):
+    """
+    与 StopLossEngine._value_of_new_lowest/_value_of_new_highest 相同, 方向由传入的栈决定:
+    创新低时传入前高栈, 取第二连续最高价; 创新高时传入前低栈, 取第二连续最低价; 找不到时沿用前一日止损值
+    """
+    rank, pivot = _pivot(index, value, size, end)
+    return pivot if rank == 2 else last_stop
+
+
+def _stop_loss_kernel(
+    open_, close, high, low, stop_loss, start, period, restrict, volatile, backtrack, warmup
+):
+    """
+    逐根k线计算止损值并写入stop_loss, start之前的止损值作为已知历史,
+    每一步与 StopLossEngine._advance 一一对应
+    """
+    n = close.shape[0]
+    # RollingExtremes: 环形缓冲区中的单调队列
+    low_index = np.zeros(period, dtype=np.int64)
+    low_value = np.zeros(period, dtype=np.float64)
+    low_head = 0
+    low_size = 0
+    high_index = np.zeros(period, dtype=np.int64)
+    high_value = np.zeros(period, dtype=np.float64)
+    high_head = 0
+    high_size = 0
+    # PivotStack: 前高/前低单调栈
+    higher_index = np.zeros(n, dtype=np.int64)
+    higher_value = np.zeros(n, dtype=np.float64)
+    higher_size = 0
+    lower_index = np.zeros(n, dtype=np.int64)
+    lower_value = np.zeros(n, dtype=np.float64)
+    lower_size = 0
+    # CrossingState
+    rise = False
+    fall = False
+    has_rise_above = False
+    stop_of_rise_above = math.nan
+    has_fall_below = False
+    stop_of_fall_below = math.nan
+    last_close = math.nan
+    up = False
+    down = False
+    run_close = math.nan
+    run_stop = math.nan
+    # StopLossEngine
+    stop = math.nan
+    last_stop_loss = math.nan
+    last_lowest = False
+    last_highest = False
+
+    for cur in range(n):
+        o = open_[cur]
+        c = close[cur]
+        h = high[cur]
+        l = low[cur]
+
+        # 创新低/创新高
+        expired = cur - period
+        if low_size > 0 and low_index[low_head] <= expired:
+            low_head = (low_head + 1) % period
+            low_size -= 1
+        while low_size > 0 and low_value[(low_head + low_size - 1) % period] >= l:
+            low_size -= 1
+        lowest = low_size == 0
+        tail = (low_head + low_size) % period
+        low_index[tail] = cur
+        low_value[tail] = l
+        low_size += 1
+        if high_size > 0 and high_index[high_head] <= expired:
+            high_head = (high_head + 1) % period
+            high_size -= 1
+        while high_size > 0 and high_value[(high_head + high_size - 1) % period] <= h:
+            high_size -= 1
+        highest = high_size == 0
+        tail = (high_head + high_size) % period
+        high_index[tail] = cur
+        high_value[tail] = h
+        high_size += 1
+
+        # 前高/前低
+        while higher_size > 0 and higher_value[higher_size - 1] <= h:
+            higher_size -= 1
+        higher_index[higher_size] = cur
+        higher_value[higher_size] = h
+        higher_size += 1
+        while lower_size > 0 and lower_value[lower_size - 1] >= l:
+            lower_size -= 1
+        lower_index[lower_size] = cur
+        lower_value[lower_size] = l
+        lower_size += 1
+
+        # 之上/之下/涨破/跌破
+        last_stop = stop
+        last_rise = rise
+        last_fall = fall
+        fall = c < last_stop and up
+        rise = c > last_stop and down
+        if c < last_stop:
+            above = False
+            below = True
+        elif c > last_stop:
+            above = True
+            below = False
+        elif c == last_stop and o != c:
+            above = o > c
+            below = o < c
+        else:
+            if last_close == last_stop and last_stop == o:
+                pre_close = run_close
+                pre_stop = run_stop
+            else:
+                pre_close = last_close
+                pre_stop = last_stop
+            above = pre_close > pre_stop or (pre_close == pre_stop and o > pre_close)
+            below = pre_close < pre_stop or (pre_close == pre_stop and o < pre_close)
+
+        if cur < start:
+            value = stop_loss[cur]
+        elif cur < warmup:
+            value = math.nan
+        else:
+            end = -1
+            if restrict:
+                end = max(cur - 2 * period + 1, -1)
+            if last_stop != last_stop:
+                if lowest:
+                    value = _pivot(higher_index, higher_value, higher_size, -1)[1]
+                else:
+                    value = math.nan
+            elif fall and not highest:
+                if volatile and cur > 1 and last_rise:
+                    value = last_stop_loss
+                elif backtrack and last_highest:
+                    value = stop_of_rise_above if has_rise_above else last_stop
+                else:
+                    value = _pivot(higher_index, higher_value, higher_size, end)[1]
+            elif rise and not lowest:
+                if volatile and cur > 1 and last_fall:
+                    value = last_stop_loss
+                elif backtrack and last_lowest:
+                    value = stop_of_fall_below if has_fall_below else last_stop
+                else:
+                    value = _pivot(lower_index, lower_value, lower_size, end)[1]
+            elif fall and highest:
+                value = _second_pivot(lower_index, lower_value, lower_size, end, last_stop)
+            elif rise and lowest:
+                value = _second_pivot(higher_index, higher_value, higher_size, end, last_stop)
+            elif above and highest:
+                value = _second_pivot(lower_index, lower_value, lower_size, end, last_stop)
+            elif below and lowest:
+                value = _second_pivot(higher_index, higher_value, higher_size, end, last_stop)
+            else:
+                value = last_stop
+
+        # 记录当前k线的状态
+        if cur >= 2:
+            if not above:
+                has_rise_above = True
+                stop_of_rise_above = last_stop
+            if not below:
+                has_fall_below = True
+                stop_of_fall_below = last_stop
+        if c == value:
+            if not (last_close == last_stop and last_stop == c):
+                run_close = last_close
+                run_stop = last_stop
+            if o != c:
+                up = o > c
+                down = o < c
+        else:
+            up = c > value
+            down = c < value
+        last_close = c
+        last_stop_loss = last_stop
+        stop = value
+        last_lowest = lowest
+        last_highest = highest
+        stop_loss[cur] = value
+    return stop_loss
+
+
+if HAS_NUMBA:
+    _pivot = njit(cache=True)(_pivot)
+    _second_pivot = njit(cache=True)(_second_pivot)
+    _compiled_kernel = njit(cache=True)(_stop_loss_kernel)
+else:
+    _compiled_kernel = None
+
+
+def predict_stop_loss_kernel(
+    open_,
+    close,
+    high,
+    low,
+    stop_loss=None,
+    start: int = 0,
+    period: int = 6,
+    restrict: bool = True,
+    volatile: bool = True,
+    backtrack: bool = False,
+    warmup: int = None,
+) -> np.ndarray:
+    """
+    用编译内核计算单个合约的止损值, 没有安装numba时使用 StopLossEngine.run
+    Args:
+        open_, close, high, low: 价格序列
+        stop_loss: float64 数组, start 之前的值作为已知历史, 结果原地写入; None时新建
+        start: 计算止损值的初始位置
+        period, restrict, volatile, backtrack, warmup: 与 StopLossEngine 相同
+    Returns:
+        stop_loss (np.ndarray): 与输入等长的止损值数组, 缺失为NaN
+    """
+    if warmup is None:
+        warmup = period - 1
+    if _compiled_kernel is None:
+        engine = StopLossEngine(period, restrict, volatile, backtrack, warmup)
+        return engine.run(open_, close, high, low, stop_loss, start)
+    close = as_float_array(close)
+    if stop_loss is None:
+        stop_loss = np.full(len(close), np.nan)
+    return _compiled_kernel(
+        as_float_array(open_),
+        close,
+        as_float_array(high),
+        as_float_array(low),
+        stop_loss,
+        start,
+        period,
+        bool(restrict),
+        bool(volatile),
+        bool(backtrack),
+        warmup,
+    )
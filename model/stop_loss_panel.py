@@ -0,0 +1,276 @@
+"""
+多合约止损值的面板计算
+
+把多个合约的k线排成 合约数 x k线数 的矩阵(每个合约的k线靠左排列, 长度不同时右侧补NaN),
+每个时间步对所有合约同时推进 StopLossEngine 的状态机, 合约方向上全部是numpy向量运算.
+只与价格有关的创新低/创新高标记和前高/前低在循环之前对整个面板一次算出,
+循环的次数等于最长合约的k线数, 与合约数量无关
+
++ to_panel / from_panel: 按code分组排列的长表与面板矩阵之间的转换
++ predict_stop_loss_panel: 面板上的止损值计算, 与逐个合约调用 StopLossEngine.run 的结果逐位一致
+"""
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+
+def to_panel(codes, *columns):
+    """
+    将按code分组(组内按时间排序)的列转为面板矩阵
+    Args:
+        codes: 每行的合约代码, 同一合约的行必须相邻
+        columns: 需要转换的列, 每列与codes等长
+    Returns:
+        lengths (np.ndarray): 每个合约的k线数量
+        panels (list): 每列对应的 合约数 x 最大k线数 的float64矩阵, 空位为NaN
+    """
+    codes = np.asarray(codes)
+    n = len(codes)
+    starts = np.flatnonzero(codes[1:] != codes[:-1]) + 1
+    starts = np.concatenate([[0], starts]) if n else starts
+    lengths = np.diff(np.append(starts, n))
+    rows, cols = _positions(starts, lengths)
+    width = lengths.max() if n else 0
+    panels = []
+    for column in columns:
+        panel = np.full((len(lengths), width), np.nan)
+        panel[rows, cols] = np.asarray(column, dtype=np.float64)
+        panels.append(panel)
+    return lengths, panels
+
+
+def from_panel(panel, lengths):
+    """to_panel的逆操作, 按合约依次取出每行的前lengths个值拼接为一列"""
+    starts = np.cumsum(lengths) - lengths
+    rows, cols = _positions(starts, lengths)
+    return panel[rows, cols]
+
+
+def _positions(starts, lengths):
+    rows = np.repeat(np.arange(len(lengths)), lengths)
+    cols = np.arange(lengths.sum()) - np.repeat(starts, lengths)
+    return rows, cols
+
+
+def predict_stop_loss_panel(
+    open_: np.ndarray,
+    close: np.ndarray,
+    high: np.ndarray,
+    low: np.ndarray,
+    lengths: np.ndarray,
+    period: int = 6,
+    restrict: bool = True,
+    volatile: bool = True,
+    backtrack: bool = False,
+    warmup: int = None,
+) -> np.ndarray:
+    """
+    计算面板上所有合约的止损值
+    Args:
+        open_, close, high, low: 合约数 x k线数 的float64矩阵, 每行的k线靠左排列
+        lengths: 每个合约的k线数量
+        period: 止损值变化策略(创新低,创新高等)考虑的交易周期数
+        restrict: 是否限制止损值策略的某些规则往前搜索的周期数
+        volatile: 是否开启止损值震荡条件
+        backtrack: 是否开启止损值回调条件
+        warmup: 前warmup根k线不计算止损值, 默认period-1
+    Returns:
+        stop_loss (np.ndarray): 与输入同形状的止损值矩阵, 没有止损值或空位为NaN
+    """
+    if warmup is None:
+        warmup = period - 1
+    lengths = np.asarray(lengths, dtype=np.int64)
+    # 按k线数量从多到少排列, 第t步仍有k线的合约正好是前active[t]行, 可以直接切片
+    order = np.argsort(-lengths, kind="stable")
+    lengths = lengths[order]
+    open_ = np.ascontiguousarray(open_[order], dtype=np.float64)
+    close = np.ascontiguousarray(close[order], dtype=np.float64)
+    high = np.ascontiguousarray(high[order], dtype=np.float64)
+    low = np.ascontiguousarray(low[order], dtype=np.float64)
+    count, width = close.shape
+    if count == 0 or width == 0:
+        return np.full((count, width), np.nan)
+    active = np.searchsorted(-lengths, -np.arange(width), side="left")
+
+    lowest, highest = _rolling_flags(low, high, period)
+    # 每个时间步规则往前搜索的边界(不含), 与 StopLossEngine 相同
+    steps = np.arange(width)
+    if restrict:
+        end = np.maximum(steps - 2 * period + 1, -1)
+    else:
+        end = np.full(width, -1)
+    higher_first, higher_second = _previous_index(high, active, higher=True)
+    lower_first, lower_second = _previous_index(low, active, higher=False)
+    # 第二连续最高价: 开始条件不限制范围, 跌破条件与创新低条件受end限制
+    begin_value = _pivot_value(high, higher_first, higher_second, -1)[1]
+    higher_rank, higher_value = _pivot_value(high, higher_first, higher_second, end)
+    lower_rank, lower_value = _pivot_value(low, lower_first, lower_second, end)
+    higher_found = higher_rank == 2
+    lower_found = lower_rank == 2
+
+    # 每个合约的状态, 含义与 StopLossEngine / CrossingState 的同名属性相同
+    stop = np.full(count, np.nan)
+    last_stop_loss = np.full(count, np.nan)
+    last_close = np.full(count, np.nan)
+    run_close = np.full(count, np.nan)
+    run_stop = np.full(count, np.nan)
+    up = np.zeros(count, dtype=bool)
+    down = np.zeros(count, dtype=bool)
+    rise = np.zeros(count, dtype=bool)
+    fall = np.zeros(count, dtype=bool)
+    has_rise_above = np.zeros(count, dtype=bool)
+    stop_of_rise_above = np.full(count, np.nan)
+    has_fall_below = np.zeros(count, dtype=bool)
+    stop_of_fall_below = np.full(count, np.nan)
+
+    # 循环内按时间步逐行访问, 转为 k线数 x 合约数 使每一步读写的内存连续
+    open_, close = open_.T.copy(), close.T.copy()
+    lowest, highest = lowest.T.copy(), highest.T.copy()
+    begin_value = begin_value.T.copy()
+    higher_found, higher_value = higher_found.T.copy(), higher_value.T.copy()
+    lower_found, lower_value = lower_found.T.copy(), lower_value.T.copy()
+    result = np.full((width, count), np.nan)
+    for t in range(width):
+        k = active[t]
+        o = open_[t, :k]
+        c = close[t, :k]
+        last_stop = stop[:k].copy()
+        pre_close = last_close[:k]
+
+        # 之上/之下/涨破/跌破, 对应 CrossingState.push
+        new_fall = (c < last_stop) & up[:k]
+        new_rise = (c > last_stop) & down[:k]
+        moved = (c == last_stop) & (o != c)
+        flat = ~((c < last_stop) | (c > last_stop) | moved)
+        in_run = (pre_close == last_stop) & (last_stop == o)
+        pc = np.where(in_run, run_close[:k], pre_close)
+        ps = np.where(in_run, run_stop[:k], last_stop)
+        above = (
+            (c > last_stop)
+            | (moved & (o > c))
+            | (flat & ((pc > ps) | ((pc == ps) & (o > pc))))
+        )
+        below = (
+            (c < last_stop)
+            | (moved & (o < c))
+            | (flat & ((pc < ps) | ((pc == ps) & (o < pc))))
+        )
+
+        if t < warmup:
+            value = np.full(k, np.nan)
+        else:
+            cur_lowest = lowest[t, :k]
+            cur_highest = highest[t, :k]
+            new_highest_value = np.where(lower_found[t, :k], lower_value[t, :k], last_stop)
+            new_lowest_value = np.where(higher_found[t, :k], higher_value[t, :k], last_stop)
+            fall_value = higher_value[t, :k]
+            rise_value = lower_value[t, :k]
+            if backtrack and t > 0:
+                # 回调: 昨日创新高(低), 取上一次涨破(跌破)日的前一天的止损值
+                fall_value = np.where(
+                    highest[t - 1, :k],
+                    np.where(has_rise_above[:k], stop_of_rise_above[:k], last_stop),
+                    fall_value,
+                )
+                rise_value = np.where(
+                    lowest[t - 1, :k],
+                    np.where(has_fall_below[:k], stop_of_fall_below[:k], last_stop),
+                    rise_value,
+                )
+            if volatile and t > 1:
+                # 震荡: 昨日涨破(跌破), 今日跌破(涨破), 止损值取昨日的前一天
+                fall_value = np.where(rise[:k], last_stop_loss[:k], fall_value)
+                rise_value = np.where(fall[:k], last_stop_loss[:k], rise_value)
+            # 按规则的先后顺序取第一个满足的条件, 都不满足时取前一天的止损值
+            value = np.select(
+                [
+                    last_stop != last_stop,
+                    new_fall & ~cur_highest,
+                    new_rise & ~cur_lowest,
+                    new_fall & cur_highest,
+                    new_rise & cur_lowest,
+                    above & cur_highest,
+                    below & cur_lowest,
+                ],
+                [
+                    np.where(cur_lowest, begin_value[t, :k], np.nan),
+                    fall_value,
+                    rise_value,
+                    new_highest_value,
+                    new_lowest_value,
+                    new_highest_value,
+                    new_lowest_value,
+                ],
+                default=last_stop,
+            )
+        result[t, :k] = value
+
+        # 记录当前k线的状态, 对应 CrossingState.settle
+        if t >= 2:
+            stop_of_rise_above[:k] = np.where(above, stop_of_rise_above[:k], last_stop)
+            has_rise_above[:k] |= ~above
+            stop_of_fall_below[:k] = np.where(below, stop_of_fall_below[:k], last_stop)
+            has_fall_below[:k] |= ~below
+        on_stop = c == value
+        new_run = on_stop & ~((pre_close == last_stop) & (last_stop == c))
+        run_close[:k] = np.where(new_run, pre_close, run_close[:k])
+        run_stop[:k] = np.where(new_run, last_stop, run_stop[:k])
+        flat_bar = o == c
+        up[:k] = np.where(on_stop, np.where(flat_bar, up[:k], o > c), c > value)
+        down[:k] = np.where(on_stop, np.where(flat_bar, down[:k], o < c), c < value)
+        rise[:k] = new_rise
+        fall[:k] = new_fall
+        last_close[:k] = c
+        last_stop_loss[:k] = last_stop
+        stop[:k] = value
+
+    stop_loss = np.empty((count, width))
+    stop_loss[order] = result.T
+    return stop_loss
+
+
+def _rolling_flags(low, high, period):
+    """每根k线是否为最近period根k线(不足period根时从第一根开始)的最低价/最高价"""
+    count = low.shape[0]
+    pad = np.full((count, period - 1), np.inf)
+    lowest = sliding_window_view(np.hstack([pad, low]), period, axis=1).min(axis=2)
+    highest = sliding_window_view(np.hstack([-pad, high]), period, axis=1).max(axis=2)
+    return low == lowest, high == highest
+
+
+def _previous_index(values, active, higher=True):
+    """
+    每根k线往前第一个严格高于(低于)当前价格的位置first, 以及first往前第一个严格高于(低于)first的位置second,
+    不存在时为-1. 沿着"前一个更高价"的链往前跳, 每个合约均摊O(1)
+    """
+    count, width = values.shape
+    first = np.full((count, width), -1, dtype=np.int64)
+    rows_all = np.arange(count)
+    for t in range(1, width):
+        k = active[t]
+        rows = rows_all[:k]
+        value = values[:k, t]
+        j = np.full(k, t - 1, dtype=np.int64)
+        while True:
+            pre = values[rows, j]
+            if higher:
+                move = (j >= 0) & (pre <= value)
+            else:
+                move = (j >= 0) & (pre >= value)
+            if not move.any():
+                break
+            j[move] = first[rows[move], j[move]]
+        first[:k, t] = j
+    second = np.where(
+        first >= 0, np.take_along_axis(first, np.maximum(first, 0), axis=1), -1
+    )
+    return first, second
+
+
+def _pivot_value(values, first, second, end):
+    """与 PivotStack.pivot 相同, end为每列的搜索边界(不含)"""
+    end = np.broadcast_to(end, values.shape[1])
+    first_value = np.take_along_axis(values, np.maximum(first, 0), axis=1)
+    second_value = np.take_along_axis(values, np.maximum(second, 0), axis=1)
+    rank = np.where(second > end, 2, np.where(first > end, 1, 0))
+    value = np.where(rank == 2, second_value, np.where(rank == 1, first_value, values))
+    return rank, value
@@ -0,0 +1,153 @@
+"""
+多进程计算多个合约的止损值
+
+合约按k线数量大致均分为若干段, 每段交给进程池中的一个进程逐个合约计算(predict_stop_loss_serial,
+安装了numba时使用编译内核). 价格和结果都放在共享内存(multiprocessing.shared_memory)中, 子进程只接收共享内存的名字和
+自己负责的合约范围, 不需要序列化DataFrame. 每个进程把结果写回自己那一段的位置,
+因此结果的顺序与输入相同, 与单进程计算逐位一致.
+
+进程池的启动和共享内存有固定开销, 总行数少于 PARALLEL_MIN_ROWS 时直接在当前进程计算
+"""
+import os
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+import numpy as np
+from model.stop_loss_kernel import HAS_NUMBA, predict_stop_loss_kernel
+
+# 使用进程池的最少行数. 单核测得: 启动进程池约0.1s(子进程从缓存加载编译内核再加约0.2s),
+# 逐个合约计算编译内核约0.1us/行, StopLossEngine约3us/行, 行数少于它时多进程比单进程慢
+PARALLEL_MIN_ROWS = 5000000 if HAS_NUMBA else 200000
+
+
+def predict_stop_loss_parallel(
+    codes,
+    open_,
+    close,
+    high,
+    low,
+    workers: int = None,
+    period: int = 6,
+    restrict: bool = True,
+    volatile: bool = True,
+    backtrack: bool = False,
+    warmup: int = None,
+    min_rows: int = None,
+) -> np.ndarray:
+    """
+    多进程计算按code分组排列的多个合约的止损值
+    Args:
+        codes: 每行的合约代码, 同一合约的行必须相邻且按时间排序
+        open_, close, high, low: 与codes等长的价格序列
+        workers: 进程数, 默认为cpu核数
+        period, restrict, volatile, backtrack, warmup: 与 StopLossEngine 相同
+        min_rows: 使用进程池的最少行数, 默认为 PARALLEL_MIN_ROWS, 行数更少时在当前进程计算
+    Returns:
+        stop_loss (np.ndarray): 与codes逐行对应的止损值, 缺失为NaN
+    """
+    codes = np.asarray(codes)
+    n = len(codes)
+    if workers is None:
+        workers = os.cpu_count() or 1
+    starts = np.flatnonzero(codes[1:] != codes[:-1]) + 1
+    # 每段的起止行号, 切分点只取在合约的边界上
+    bounds = _split(n, starts, workers)
+    flags = dict(
+        period=period,
+        restrict=restrict,
+        volatile=volatile,
+        backtrack=backtrack,
+        warmup=warmup,
+    )
+    if min_rows is None:
+        min_rows = PARALLEL_MIN_ROWS
+    if len(bounds) <= 2 or n < min_rows:
+        return predict_stop_loss_serial(codes, open_, close, high, low, **flags)
+
+    # 合约代码转为整数编号, 与价格一起放进共享内存
+    _, code_ids = np.unique(codes, return_inverse=True)
+    prices = shared_memory.SharedMemory(create=True, size=max(5 * n * 8, 1))
+    output = shared_memory.SharedMemory(create=True, size=max(n * 8, 1))
+    try:
+        table = np.ndarray((5, n), dtype=np.float64, buffer=prices.buf)
+        table[0] = code_ids
+        for row, column in enumerate([open_, close, high, low], start=1):
+            table[row] = np.asarray(column, dtype=np.float64)
+        with ProcessPoolExecutor(max_workers=len(bounds) - 1) as executor:
+            tasks = [
+                executor.submit(
+                    _predict_shared, prices.name, output.name, n, begin, end, flags
+                )
+                for begin, end in zip(bounds[:-1], bounds[1:])
+            ]
+            for task in tasks:
+                task.result()
+        stop_loss = np.ndarray((n,), dtype=np.float64, buffer=output.buf).copy()
+        del table
+    finally:
+        prices.close()
+        prices.unlink()
+        output.close()
+        output.unlink()
+    return stop_loss
+
+
+def _split(n, starts, workers):
+    """按行数把合约均分为workers段, 返回各段边界的行号"""
+    if n == 0:
+        return [0, 0]
+    if len(starts) == 0:
+        return [0, n]
+    targets = np.arange(1, workers) * n / workers
+    cuts = starts[np.minimum(np.searchsorted(starts, targets), len(starts) - 1)]
+    return sorted(set([0, n] + cuts.tolist()))
+
+
+def predict_stop_loss_serial(
+    codes,
+    open_,
+    close,
+    high,
+    low,
+    period: int = 6,
+    restrict: bool = True,
+    volatile: bool = True,
+    backtrack: bool = False,
+    warmup: int = None,
+) -> np.ndarray:
+    """
+    在当前进程逐个合约计算止损值, 每个合约调用一次 predict_stop_loss_kernel(没有安装numba时为 StopLossEngine.run)
+    Args:
+        与 predict_stop_loss_parallel 相同
+    Returns:
+        stop_loss (np.ndarray): 与codes逐行对应的止损值, 缺失为NaN
+    """
+    codes = np.asarray(codes)
+    n = len(codes)
+    columns = [np.asarray(column, dtype=np.float64) for column in [open_, close, high, low]]
+    stop_loss = np.full(n, np.nan)
+    bounds = np.concatenate([[0], np.flatnonzero(codes[1:] != codes[:-1]) + 1, [n]]) if n else []
+    for begin, end in zip(bounds[:-1], bounds[1:]):
+        stop_loss[begin:end] = predict_stop_loss_kernel(
+            *[column[begin:end] for column in columns],
+            period=period,
+            restrict=restrict,
+            volatile=volatile,
+            backtrack=backtrack,
+            warmup=warmup,
+        )
+    return stop_loss
+
+
+def _predict_shared(prices_name, output_name, n, begin, end, flags):
+    """子进程: 计算第begin到end行的止损值并写入共享内存"""
+    prices = shared_memory.SharedMemory(name=prices_name)
+    output = shared_memory.SharedMemory(name=output_name)
+    try:
+        table = np.ndarray((5, n), dtype=np.float64, buffer=prices.buf)
+        result = np.ndarray((n,), dtype=np.float64, buffer=output.buf)
+        codes, open_, close, high, low = table[:, begin:end]
+        result[begin:end] = predict_stop_loss_serial(codes, open_, close, high, low, **flags)
+        del table, result, codes, open_, close, high, low
+    finally:
+        prices.close()
+        output.close()
@@ -0,0 +1,260 @@
+"""
+基于asyncio的消费者
+
+一个事件循环上订阅任意多个channel(包括分片channel), 驱动任意多个策略, 不为每个channel或策略启动线程:
+
++ list: 所有channel共用一个pubsub连接, 收到通知后批量读取对应的消息队列
++ stream: 所有channel的stream在一次 XREADGROUP 中阻塞读取
+
+没有消息时事件循环阻塞在socket上, 空闲时几乎不占用cpu. 每条消息只解码一次, 依次交给订阅了该channel的策略的
+on_market(data)(与 StopLossStrategy.on_market 相同, data为解码后的行情 {合约代码: k线}), on_market 可以是普通函数
+或协程函数. 同步的调用方式见 run_forever
+"""
+import asyncio
+import inspect
+import time
+from redis.exceptions import ResponseError
+from mq import stream, subscriber
+from mq.codec import as_text, decode_message
+from mq.config import mq_config
+from mq.consumer import EXIT_MESSAGES, parse_batch, split_content
+from mq.shard import shard_channel
+from mq.trace import trace_of, tracer
+from util.redis_util import get_async_conn
+
+
+class AsyncConsumer(object):
+    """
+    Args:
+        client_id: 客户端唯一标识id, 与 Consumer 相同, list方式的消息队列和stream方式的消费者组以它命名
+        conn: redis.asyncio 的连接(不解码返回值), 默认在事件循环中用 get_async_conn 创建
+        transport: list 或 stream, 默认为配置文件 [MQ] 中的 TRANSPORT, 必须与 Producer 相同
+        consumer_name: stream方式下在消费者组中的名字, 默认与client_id相同
+        dispatcher: StrategyDispatcher(method="on_market"), 策略在线程池或进程池中执行, 不阻塞事件循环,
+            此时 on_market 必须是普通函数; None 在事件循环中直接调用
+    """
+
+    def __init__(
+        self,
+        client_id: str = "futures",
+        conn=None,
+        transport: str = None,
+        consumer_name: str = None,
+        dispatcher=None,
+    ):
+        self.client_id = client_id
+        self.conn = conn
+        self.transport = transport or mq_config["TRANSPORT"]
+        self.consumer_name = consumer_name or client_id
+        self.dispatcher = dispatcher
+        self.__heartbeat = subscriber.Heartbeat()
+        # channel -> 订阅了该channel的策略
+        self.strategies = {}
+        self.__active = False
+
+    def attach(self, strategy, channel: str = "1m", codes: list = None):
+        """
+        注册策略, 在 run 之前调用
+        :param strategy: 有 on_market(data) 方法的对象, 例如 StopLossStrategy
+        :param channel:
+        :param codes: 合约代码或交易所代码, 只订阅这些分片, None订阅全市场消息
+        :return:
+        """
+        channels = [shard_channel(channel, code) for code in codes] if codes else [channel]
+        for name in channels:
+            self.strategies.setdefault(name, []).append(strategy)
+        if self.dispatcher is not None:
+            self.dispatcher.attach(strategy)
+
+    async def dispatch(self, channel: str, messages: list):
+        """依次解码消息并交给订阅了channel的策略"""
+        received = time.time()
+        for message in messages:
+            data = decode_message(message)
+            trace = trace_of(data)
+            tracer.mark(trace, "receive", received)
+            tracer.mark(trace, "decode")
+            for strategy in self.strategies.get(channel, []):
+                if self.dispatcher is not None:
+                    self.dispatcher.submit(strategy, data)
+                    continue
+                result = strategy.on_market(data)
+                if inspect.isawaitable(result):
+                    await result
+
+    async def run(self):
+        """
+        订阅所有注册了策略的channel并处理消息, 直到 stop 或所有channel都收到退出消息
+        """
+        if self.conn is None:
+            self.conn = get_async_conn()
+        self.__active = True
+        channels = list(self.strategies)
+        try:
+            if self.transport == "stream":
+                await self.listen_stream(channels)
+            else:
+                await self.listen_list(channels)
+        finally:
+            self.__active = False
+
+    def run_forever(self):
+        """同步调用: 在新的事件循环中运行 run, 阻塞到结束"""
+        asyncio.run(self.run())
+
+    def stop(self):
+        """关闭监听开关, 监听在下一次收到消息或读取超时后结束"""
+        self.__active = False
+
+    async def listen_list(self, channels: list):
+        pub = self.conn.pubsub()
+        # 按channel名精确订阅, 不使用模式订阅, redis发布时不需要逐个匹配模式
+        await pub.subscribe(*channels)
+        await self.register(channels)
+        active = set(channels)
+        try:
+            # 先处理完历史消息
+            for channel in channels:
+                if not await self.drain(channel):
+                    active.discard(channel)
+            while self.__active and active:
+                item = await pub.get_message(
+                    ignore_subscribe_messages=True, timeout=mq_config["STREAM_BLOCK_MS"] / 1000
+                )
+                await self.register(active)
+                if item is None or item["type"] != "message":
+                    continue
+                channel = as_text(item["channel"])
+                if channel not in active:
+                    continue
+                txid, _ = split_content(item["data"])
+                if txid is None:
+                    continue
+                if not await self.drain(channel, txid):
+                    active.discard(channel)
+        finally:
+            await pub.close()
+
+    async def register(self, channels):
+        """登记channels中心跳到期的订阅者并记录心跳, 见 mq/subscriber.py"""
+        channel_keys = [f"{self.client_id}/{channel}" for channel in channels]
+        channel_keys = [key for key in channel_keys if self.__heartbeat.due(key)]
+        if not channel_keys:
+            return
+        pipe = self.conn.pipeline(transaction=False)
+        for channel_key in channel_keys:
+            subscriber.register(pipe, channel_key)
+        await pipe.execute()
+
+    async def drain(self, channel: str, txid: int = None) -> bool:
+        """
+        与 Consumer.drain 相同, 批量读取并处理消息队列中的消息
+        :return: 收到退出消息并取消订阅时为False
+        """
+        channel_key = f"{self.client_id}/{channel}"
+        batch = mq_config["LIST_BATCH"]
+        while True:
+            lms = await self.conn.lrange(channel_key, 0, batch - 1)
+            messages, consumed, last_txid, is_exit = parse_batch(lms, txid)
+            if messages:
+                await self.dispatch(channel, messages)
+            pipe = self.conn.pipeline(transaction=False)
+            if is_exit:
+                subscriber.remove(pipe, channel_key)
+                await pipe.execute()
+                return False
+            if consumed:
+                pipe.ltrim(channel_key, consumed, -1)
+                if last_txid is not None:
+                    subscriber.record_progress(pipe, channel_key, last_txid)
+                if self.__heartbeat.due(channel_key):
+                    subscriber.register(pipe, channel_key)
+                await pipe.execute()
+            if consumed < batch:
+                return True
+
+    async def listen_stream(self, channels: list):
+        for channel in channels:
+            try:
+                await self.conn.xgroup_create(
+                    stream.stream_key(channel), self.client_id, id="$", mkstream=True
+                )
+            except ResponseError as e:
+                if "BUSYGROUP" not in str(e):
+                    raise
+        count = mq_config["STREAM_COUNT"]
+        active = set(channels)
+        # 先处理完本消费者上次退出时已读取未确认的消息
+        while self.__active and active:
+            response = await self.conn.xreadgroup(
+                self.client_id,
+                self.consumer_name,
+                {stream.stream_key(channel): "0" for channel in active},
+                count=count,
+            )
+            pending = stream.parse_streams(response)
+            if not any(entries or deleted for _, entries, deleted in pending):
+                break
+            for channel, entries, deleted in pending:
+                # 已被裁剪的消息直接确认
+                if deleted:
+                    await self.conn.xack(stream.stream_key(channel), self.client_id, *deleted)
+                if entries and not await self.handle_entries(channel, entries):
+                    active.discard(channel)
+        claim_idle_ms = mq_config["STREAM_CLAIM_IDLE_MS"]
+        loop = asyncio.get_running_loop()
+        last_claim = None
+        while self.__active and active:
+            if last_claim is None or (loop.time() - last_claim) * 1000 >= claim_idle_ms:
+                last_claim = loop.time()
+                for channel in list(active):
+                    result = await self.conn.xautoclaim(
+                        stream.stream_key(channel),
+                        self.client_id,
+                        self.consumer_name,
+                        claim_idle_ms,
+                        start_id="0-0",
+                        count=count,
+                    )
+                    entries, deleted = stream.parse_claim(result)
+                    if deleted:
+                        await self.conn.xack(stream.stream_key(channel), self.client_id, *deleted)
+                    if entries and not await self.handle_entries(channel, entries):
+                        active.discard(channel)
+            if not active:
+                break
+            response = await self.conn.xreadgroup(
+                self.client_id,
+                self.consumer_name,
+                {stream.stream_key(channel): ">" for channel in active},
+                count=count,
+                block=mq_config["STREAM_BLOCK_MS"],
+            )
+            for channel, entries, _ in stream.parse_streams(response):
+                if channel in active and not await self.handle_entries(channel, entries):
+                    active.discard(channel)
+
+    async def handle_entries(self, channel: str, entries: list) -> bool:
+        """
+        与 Consumer.handle_entries 相同, 处理一批stream消息并确认
+        :return: 收到退出消息并从消费者组中删除本消费者时为False
+        """
+        processed = []
+        messages = []
+        for message_id, fields in entries:
+            processed.append(message_id)
+            message = as_text(fields["data"])
+            if message in EXIT_MESSAGES:
+                await self.dispatch(channel, messages)
+                await self.conn.xack(stream.stream_key(channel), self.client_id, *processed)
+                # 只删除本消费者, 同一client_id的其他进程继续读取
+                await self.conn.xgroup_delconsumer(
+                    stream.stream_key(channel), self.client_id, self.consumer_name
+                )
+                return False
+            messages.append(message)
+        if messages:
+            await self.dispatch(channel, messages)
+        if processed:
+            await self.conn.xack(stream.stream_key(channel), self.client_id, *processed)
+        return True
@@ -0,0 +1,227 @@
+"""
+分钟级行情消息的编码
+
++ json: DataFrame.to_json(orient="index"), 即 {code: {field: value, ...}, ...}
++ binary: 带版本号的二进制列式格式, 合约代码只出现一次, 数值字段为float64数组, 消费者用 np.frombuffer
+  直接在收到的bytes上建立数组视图, 不需要逐个字段解析
+
+binary格式(小端):
+
+    0  : b"JQB" + 版本号(1字节)
+    4  : uint32 头部长度H
+    8  : 头部, utf-8编码的json: {"codes": [合约代码], "columns": [数值字段], "text": {文本字段: 值}, "trace": {阶段: 时间戳}}
+         文本字段(如trade_date)所有合约相同时为一个字符串, 否则为与codes等长的列表; trace 可选, 见 mq/trace.py
+    8+H: 补齐到8字节对齐
+    ...: float64矩阵, len(columns) 行 x len(codes) 列, 缺失值为NaN
+
+json格式的trace放在 _trace 字段中, 解码时取出.
+decode_message 根据开头的标识自动识别格式, 消费者可以同时接收两种格式的消息
+"""
+import json
+import struct
+from collections.abc import Mapping
+import numpy as np
+import pandas as pd
+from mq.trace import Trace
+
+MAGIC = b"JQB"
+VERSION = 1
+_HEADER = struct.Struct("<3sBI")
+
+
+def encode_message(data: pd.DataFrame, codec: str = "json", trace: Trace = None):
+    """
+    Args:
+        data: 以合约代码为索引的行情, 每行一个合约
+        codec: json 或 binary
+        trace: 随消息发送的各阶段时间戳, None不发送
+    Returns:
+        message (str | bytes): json为str, binary为bytes
+    """
+    if codec == "binary":
+        return encode_binary(data, trace)
+    message = data.to_json(orient="index")
+    if trace is None:
+        return message
+    stamps = json.dumps({"_trace": trace.to_dict()}, separators=(",", ":"))
+    if message == "{}":
+        return stamps
+    return stamps[:-1] + "," + message[1:]
+
+
+def encode_binary(data: pd.DataFrame, trace: Trace = None) -> bytes:
+    codes, numeric, text, matrix = _columns(data)
+    return _pack(codes, numeric, text, matrix, trace)
+
+
+def encode_groups(data: pd.DataFrame, groups: list, codec: str = "json", trace: Trace = None) -> list:
+    """
+    把行情中的若干组合约分别编码为消息, 结果与对每组调用 encode_message(data.iloc[rows]) 相同,
+    但只对整个行情解析一次
+    Args:
+        data: 以合约代码为索引的行情
+        groups: 每组合约在data中的行号列表
+        codec: json 或 binary
+        trace: 随每条消息发送的各阶段时间戳, None不发送
+    Returns:
+        messages (list): 与groups一一对应的消息
+    """
+    if codec == "binary":
+        codes, numeric, text, matrix = _columns(data)
+        return [
+            _pack(
+                [codes[i] for i in rows],
+                numeric,
+                {name: [values[i] for i in rows] for name, values in text.items()},
+                matrix[:, rows],
+                trace,
+            )
+            for rows in groups
+        ]
+    codes = [str(code) for code in data.index]
+    records = json.loads(data.to_json(orient="index"))
+    head = {} if trace is None else {"_trace": trace.to_dict()}
+    return [
+        json.dumps(dict(head, **{codes[i]: records[codes[i]] for i in rows}), separators=(",", ":"))
+        for rows in groups
+    ]
+
+
+def _columns(data):
+    """行情拆分为合约代码, 数值字段名, 文本字段 {字段名: 每个合约的值}, 数值字段 x 合约 的float64矩阵"""
+    numeric = [c for c in data.columns if pd.api.types.is_numeric_dtype(data[c])]
+    text = {
+        column: data[column].astype(str).tolist()
+        for column in data.columns
+        if column not in numeric
+    }
+    matrix = data[numeric].to_numpy(dtype="<f8").T
+    return [str(code) for code in data.index], numeric, text, matrix
+
+
+def _pack(codes, numeric, text, matrix, trace=None) -> bytes:
+    # 所有合约相同的文本字段只保存一个值
+    text = {
+        name: values[0] if len(set(values)) == 1 else values
+        for name, values in text.items()
+    }
+    header = {"codes": codes, "columns": numeric, "text": text}
+    if trace is not None:
+        header["trace"] = trace.to_dict()
+    header = json.dumps(header, separators=(",", ":")).encode("utf-8")
+    padding = -(_HEADER.size + len(header)) % 8
+    return b"".join(
+        [
+            _HEADER.pack(MAGIC, VERSION, len(header)),
+            header,
+            b"\0" * padding,
+            np.ascontiguousarray(matrix).tobytes(),
+        ]
+    )
+
+
+def is_binary(message) -> bool:
+    return isinstance(message, (bytes, bytearray, memoryview)) and bytes(message[:3]) == MAGIC
+
+
+def as_text(message):
+    """bytes形式的文本消息(json, EXIT等)转为str, 二进制消息保持不变"""
+    if isinstance(message, bytes) and not is_binary(message):
+        return message.decode("utf-8")
+    return message
+
+
+def decode_message(message):
+    """
+    Args:
+        message: json字符串(str或bytes)或二进制消息
+    Returns:
+        data: json为 {code: {field: value}}; binary为 MinuteBars, 与dict一样用 data.get(code) 取得单个合约的数据;
+            消息带有trace时 data.trace 为 Trace
+    """
+    if is_binary(message):
+        return MinuteBars(message)
+    data = json.loads(message)
+    stamps = data.pop("_trace", None)
+    if stamps is None:
+        return data
+    data = TracedDict(data)
+    data.trace = Trace(stamps)
+    return data
+
+
+def to_frame(data) -> pd.DataFrame:
+    """
+    解码后的行情转为与发布前相同的 DataFrame
+    Args:
+        data: decode_message 的结果
+    Returns:
+        DataFrame: 以合约代码为索引, 每行一个合约
+    """
+    if isinstance(data, MinuteBars):
+        return data.to_frame()
+    return pd.DataFrame.from_dict(dict(data), orient="index")
+
+
+class TracedDict(dict):
+    """带有trace的json行情"""
+
+    trace = None
+
+
+class MinuteBars(Mapping):
+    """
+    二进制消息的解码结果, 数值字段是消息bytes上的只读数组视图 \n
+    Args:
+        message: binary格式的消息
+    """
+
+    def __init__(self, message) -> None:
+        _, version, size = _HEADER.unpack_from(message, 0)
+        if version != VERSION:
+            raise ValueError(f"不支持的消息版本: {version}")
+        header = json.loads(bytes(message[_HEADER.size : _HEADER.size + size]))
+        offset = _HEADER.size + size
+        offset += -offset % 8
+        self.codes = header["codes"]
+        self.columns = header["columns"]
+        self.text = header["text"]
+        self.trace = Trace(header["trace"]) if "trace" in header else None
+        self.index = {code: i for i, code in enumerate(self.codes)}
+        # 列数 x 合约数 的矩阵, 不复制数据
+        self.values = np.frombuffer(
+            message, dtype="<f8", count=len(self.columns) * len(self.codes), offset=offset
+        ).reshape(len(self.columns), len(self.codes))
+
+    def to_frame(self) -> pd.DataFrame:
+        """以合约代码为索引的 DataFrame, 文本字段在前"""
+        frame = pd.DataFrame(
+            {name: value if isinstance(value, str) else list(value) for name, value in self.text.items()},
+            index=pd.Index(self.codes),
+        )
+        for name, values in zip(self.columns, self.values):
+            frame[name] = values
+        return frame
+
+    def column(self, name: str) -> np.ndarray:
+        """所有合约某个数值字段的数组, 顺序与codes相同"""
+        return self.values[self.columns.index(name)]
+
+    def __getitem__(self, code: str) -> dict:
+        i = self.index[code]
+        row = {}
+        for name, value in self.text.items():
+            row[name] = value if isinstance(value, str) else value[i]
+        for name, value in zip(self.columns, self.values[:, i].tolist()):
+            # 与json中的null一致, 缺失值为None
+            row[name] = None if value != value else value
+        return row
+
+    def __contains__(self, code) -> bool:
+        return code in self.index
+
+    def __iter__(self):
+        return iter(self.codes)
+
+    def __len__(self) -> int:
+        return len(self.codes)
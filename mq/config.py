@@ -0,0 +1,75 @@
+"""
+消息队列的配置, 读取 config/dev.ini 的 [MQ] 部分, 没有配置的项使用默认值
+
++ TRANSPORT: list 每个订阅者一个消息队列(PERSITS_SUB) + PUBLISH通知; stream redis stream + 消费者组
++ CODEC: 行情消息的编码, json 或 binary, 见 mq/codec.py
++ SHARD: 1 同时发布按交易所和合约分片的消息, 见 mq/shard.py; 0 只发布全市场消息
++ LIST_BATCH: list方式每次从消息队列读取的最大消息数量
++ LIST_MAXLEN: list方式每个订阅者的消息队列最多保留的消息数量, 超过时丢弃最早的消息, 0 不限制
++ HEARTBEAT_TTL: list方式订阅者的心跳超时(秒), 超时的订阅者在下一次发布时被删除, 0 不删除, 见 mq/subscriber.py
++ STREAM_MAXLEN: stream中保留的消息数量(近似裁剪)
++ STREAM_BLOCK_MS: 消费者阻塞读取的超时时间(毫秒)
++ STREAM_COUNT: 消费者每次读取的最大消息数量
++ STREAM_CLAIM_IDLE_MS: 消息被同组的其他消费者读取后超过该时间仍未确认, 视为该消费者已退出, 重新认领
++ DISPATCH: 消费者把行情交给策略的方式, inline 依次执行, thread 线程池, process 进程池, 见 mq/dispatch.py
++ DISPATCH_WORKERS: 线程池的线程数或进程数
++ DISPATCH_QUEUE: 每个策略最多排队的消息数量
++ DISPATCH_OVERRUN: 策略队列满时的处理方式, drop_oldest 丢弃最早的消息, coalesce 只保留最新的消息
++ DISPATCH_BUDGET_MS: 策略单次执行的时间预算(毫秒), 超过时输出警告, 0 不限制
++ TRACE: 1 行情消息带有各阶段的时间戳并汇总阶段延迟, 0 不记录, 见 mq/trace.py
+"""
+import configparser
+import os
+
+DEFAULT_MQ_CONFIG = {
+    "TRANSPORT": "list",
+    "CODEC": "json",
+    "SHARD": 1,
+    "LIST_BATCH": 500,
+    "LIST_MAXLEN": 10000,
+    "HEARTBEAT_TTL": 300,
+    "STREAM_MAXLEN": 100000,
+    "STREAM_BLOCK_MS": 1000,
+    "STREAM_COUNT": 100,
+    "STREAM_CLAIM_IDLE_MS": 60000,
+    "DISPATCH": "inline",
+    "DISPATCH_WORKERS": 4,
+    "DISPATCH_QUEUE": 16,
+    "DISPATCH_OVERRUN": "drop_oldest",
+    "DISPATCH_BUDGET_MS": 0,
+    "TRACE": 1,
+}
+
+
+def get_section_config(section: str, defaults: dict, config_filepath: str = None) -> dict:
+    """
+    Args:
+        section: 配置文件中的部分, 例如 MQ
+        defaults: 没有配置的项使用的默认值
+        config_filepath: 配置文件路径, 默认为 config/dev.ini
+    Returns:
+        config (dict): section部分的配置, 数字转为int
+    """
+    if config_filepath is None:
+        config_filepath = f"{os.path.dirname(os.path.dirname(__file__))}/config/dev.ini"
+    parser = configparser.ConfigParser()
+    parser.optionxform = str
+    parser.read(config_filepath)
+    config = dict(defaults)
+    if parser.has_section(section):
+        for option, value in parser.items(section):
+            config[option] = int(value) if value.isdigit() else value
+    return config
+
+
+def get_mq_config(config_filepath: str = None) -> dict:
+    """
+    Args:
+        config_filepath: 配置文件路径, 默认为 config/dev.ini
+    Returns:
+        config (dict): [MQ] 部分的配置, 数字转为int
+    """
+    return get_section_config("MQ", DEFAULT_MQ_CONFIG, config_filepath)
+
+
+mq_config = get_mq_config()
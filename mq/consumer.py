@@ -1,110 +1,240 @@
 import threading
-from util.mysingleton import singleton
+import time
 from util.redis_util import redis_pooling
-import json
+from mq import stream, subscriber
+from mq.codec import as_text, decode_message
+from mq.config import mq_config
+from mq.dispatch import StrategyDispatcher
+from mq.shard import shard_channel
+from mq.trace import trace_of, tracer
+
+# 收到这些消息时关闭channel
+EXIT_MESSAGES = ["EXIT", "exit", "Exit", "Quit", "quit", "QUIT"]
+
+
+class _Listener(object):
+    """一个channel的监听开关和监听线程, 每个channel(分片)单独关闭, 互不影响"""
+
+    def __init__(self) -> None:
+        self.active = threading.Event()
+        self.active.set()
+        self.thread = None
+
 
-@singleton
 class Consumer(object):
-    def __init__(self , channel = '1m'):
-        self.__conn = redis_pooling().get_conn(1)
+    """
+    Args:
+        channel: 默认订阅的channel
+        conn: redis连接, 默认使用 redis_pooling 的第1个不解码的连接, 可以同时接收json和二进制消息
+        transport: list 或 stream, 默认为配置文件 [MQ] 中的 TRANSPORT, 必须与 Producer 相同
+        consumer_name: stream方式下在消费者组(client_id)中的名字, 默认与client_id相同;
+            同一client_id启动多个进程分担消息时每个进程使用不同的名字
+        dispatcher: 把行情交给策略的 StrategyDispatcher, 默认按配置文件 [MQ] 中的 DISPATCH 创建;
+            thread/process 方式下策略在线程池或进程池中执行, 慢策略不阻塞监听线程
+    """
+
+    def __init__(
+        self,
+        channel='1m',
+        conn=None,
+        transport: str = None,
+        consumer_name: str = None,
+        dispatcher: StrategyDispatcher = None,
+    ):
+        if conn is None:
+            conn = redis_pooling().get_conn(1, binary=True)
+        self.__conn = conn
         self.client_id = 'futures'
+        # 最近一次订阅的channel的pubsub, 每个channel(分片)有自己的pubsub
         self.pub = None
-        self.__active = False
+        # channel -> _Listener
+        self.__listeners = {}
         self.latest_data = None
+        # 当前处理的一批消息从redis读取到的时间
+        self.received_at = None
         self.channel = channel
         self.strategy_list = []
+        self.transport = transport or mq_config["TRANSPORT"]
+        self.consumer_name = consumer_name
+        self.dispatcher = dispatcher or StrategyDispatcher()
+        self.__heartbeat = subscriber.Heartbeat()
+        # 同时订阅多个分片时, 各监听线程依次处理消息
+        self.__lock = threading.Lock()
         
     def set_client_id(self, client_id):
         self.client_id = client_id
 
     def process_message(self, message):
-        self.latest_data = json.loads(message)
+        self.latest_data = decode_message(message)
+        trace = trace_of(self.latest_data)
+        tracer.mark(trace, "receive", self.received_at)
+        tracer.mark(trace, "decode")
         self.notifyAllStrategy()
         
-    def subscribe(self, channel):
+    def subscribe(self, channel, codes: list = None, block: bool = True):
         """
         订阅操作步骤:
            1. 判断 clientID是否在persists_sub 队列中
            2. 如果在队列中说明已经订阅， 或者将clientId 添加到队列中
         :param channel:
-        :return:
+        :param codes: 合约代码或交易所代码, 只订阅这些分片(channel:code)而不是全市场消息, None订阅全市场消息
+        :param block: 是否等待监听线程结束; False 时启动监听线程后立即返回
+        :return: 监听线程, 订阅多个分片时为监听线程的列表
         """
+        if codes:
+            # 每个分片一个监听线程和pubsub, 单独关闭; 消息的处理由 __lock 串行
+            threads = [
+                self.subscribe(shard_channel(channel, code), block=False) for code in codes
+            ]
+            if block:
+                for thread in threads:
+                    thread.join()
+            return threads
+        if self.transport == "stream":
+            return self.subscribe_stream(channel, block)
         # 将channel 注册到redis中
-        self.pub = self.__conn.pubsub()
-        self.pub.psubscribe(channel)
+        pub = self.__conn.pubsub()
+        pub.psubscribe(channel)
+        self.pub = pub
 
         channel_key = "%s/%s" % (self.client_id, channel)
-        is_exists = self.__conn.sismember("PERSITS_SUB", channel_key)
-
-        if not is_exists:
-            self.__conn.sadd("PERSITS_SUB", channel_key)
+        # 登记订阅者并记录心跳, 已经登记时只更新心跳
+        subscriber.register(self.__conn, channel_key)
+        self.__heartbeat.due(channel_key)
 
-        self.__active = True  # 将监听开关打开
+        # 将监听开关打开
+        listener = self.__listeners[channel] = _Listener()
 
         # 先处理完历史消息
         self.clear_msg(channel)
 
         def listen():
             print(f"开启 {self.client_id} {channel} 监听线程")
-
-            msg = self.pub.listen()
-            for item in msg:
-                if not self.__active:
-                    break
-                # print("client：{} recieve a message: {}".format(self.client_id,item))
-                #
-                # print("item : {}".format(item[u'type']))
-                if item["type"] == "pmessage":
-                    print(f"{self.client_id} receive a message from {channel}")
-                    self.handle(channel, item["data"])
-            print(f"{self.client_id} {channel} 监听线程结束，退出")
+            try:
+                while listener.active.is_set():
+                    # 超时返回None, 没有消息时定时发送心跳, 避免被生产者当作已退出的订阅者删除
+                    item = pub.get_message(timeout=mq_config["STREAM_BLOCK_MS"] / 1000)
+                    if not listener.active.is_set():
+                        break
+                    if self.__heartbeat.due(channel_key):
+                        subscriber.register(self.__conn, channel_key)
+                    if item is None:
+                        continue
+                    if item["type"] == "pmessage":
+                        print(f"{self.client_id} receive a message from {channel}")
+                        self.handle(channel, item["data"])
+            finally:
+                # 出错时只结束这个channel, 其他channel的pubsub不受影响
+                listener.active.clear()
+                pub.close()
+                print(f"{self.client_id} {channel} 监听线程结束，退出")
 
         # 启动一个线程来对消息进行监听
-        listen_thread = threading.Thread(target=listen)
+        listen_thread = listener.thread = threading.Thread(target=listen)
         # 将监听线程设置为 守护线程， 主线程结束时，监听线程会一起结束
         listen_thread.daemon = 1
         listen_thread.start()
-        listen_thread.join()
+        if block:
+            listen_thread.join()
+        return listen_thread
 
-    def clear_msg(self, channel):
+    def subscribe_stream(self, channel, block: bool = True):
         """
-        注册时，先检查一下 channel 对应的消息list 中是否有信息，如果有就先进行处理
-        :return:
+        stream方式订阅:
+           1. 以client_id为名创建消费者组, 已存在时沿用(从上次确认的位置继续)
+           2. 先处理完本消费者上次退出时已读取未确认的消息, 再认领组内其他消费者超时未确认的消息
+           3. 阻塞批量读取新消息, 每批处理完成后确认
+        :param channel:
+        :param block: 是否等待监听线程结束
+        :return: 监听线程
         """
-        channel_key = f"{self.client_id}/{channel}"
+        stream.create_group(self.__conn, channel, self.client_id)
+        listener = self.__listeners[channel] = _Listener()
+        active = listener.active
 
-        while True:
-            # 获取第一个消息
-            lm = self.__conn.lindex(channel_key, 0)
+        def listen():
+            print(f"开启 {self.client_id} {channel} 监听线程")
+            consumer_name = self.consumer_name or self.client_id
+            try:
+                self.listen_stream(channel, active, consumer_name)
+            finally:
+                active.clear()
+                # close 时监听线程可能正在阻塞读取, 读取会重新创建消费者, 退出前再删除一次
+                stream.delete_consumer(self.__conn, channel, self.client_id, consumer_name)
+                print(f"{self.client_id} {channel} 监听线程结束，退出")
+
+        listen_thread = listener.thread = threading.Thread(target=listen)
+        listen_thread.daemon = 1
+        listen_thread.start()
+        if block:
+            listen_thread.join()
+        return listen_thread
 
-            if lm is None:
+    def listen_stream(self, channel, active: threading.Event, consumer_name: str):
+        """
+        stream方式的监听循环, 在监听线程中执行, active 关闭后在下一次读取超时或收到消息后返回
+        :param channel:
+        :param active: 这个channel的监听开关
+        :param consumer_name: 在消费者组中的名字
+        """
+        count = mq_config["STREAM_COUNT"]
+        claim_idle_ms = mq_config["STREAM_CLAIM_IDLE_MS"]
+        while active.is_set():
+            entries = stream.read_pending(self.__conn, channel, self.client_id, consumer_name, count)
+            if not entries:
                 break
-            # else:
-            #     lm = lm.decode()
-            li = int(lm.index("/"))
-
-            if li < 0:
-                # 消息不合法
-                result = self.__conn.lpop(channel_key)
-                if result is None:
-                    break
-                print(f"接收到一个不合法的消息: {result}")
-                #  callback(channel, message)
-                continue
-
-            # 消息序号
-            lmid = int(lm[:li])
-            # 取出消息内容
-            lmessage = lm[(li + 1) :]
-
-            # 判断是否退出消息,如果不是就执行回调函数
-            if lmessage in ["EXIT", "exit", "Exit", "Quit", "quit", "QUIT"]:
+            self.handle_entries(channel, entries)
+        last_claim = None
+        while active.is_set():
+            entries = []
+            now = time.monotonic()
+            if last_claim is None or (now - last_claim) * 1000 >= claim_idle_ms:
+                last_claim = now
+                entries = stream.claim(
+                    self.__conn, channel, self.client_id, consumer_name, claim_idle_ms, count
+                )
+            if not entries:
+                entries = stream.read(
+                    self.__conn,
+                    channel,
+                    self.client_id,
+                    consumer_name,
+                    count,
+                    mq_config["STREAM_BLOCK_MS"],
+                )
+            self.handle_entries(channel, entries)
+
+    def handle_entries(self, channel, entries):
+        """
+        处理一批stream消息并确认, 收到退出消息时确认已处理的消息后关闭channel
+        :param channel:
+        :param entries: [(消息id, {"data": 消息内容}), ...]
+        :return:
+        """
+        self.received_at = time.time()
+        processed = []
+        messages = []
+        for message_id, fields in entries:
+            processed.append(message_id)
+            message = as_text(fields["data"])
+            if message in EXIT_MESSAGES:
+                with self.__lock:
+                    self.process_messages(messages)
+                stream.ack(self.__conn, channel, self.client_id, processed)
                 self.close(channel)
-            else:
-                self.process_message(lmessage)
+                return
+            messages.append(message)
+        if messages:
+            with self.__lock:
+                self.process_messages(messages)
+        stream.ack(self.__conn, channel, self.client_id, processed)
 
-            # 将处理过的消息丢弃
-            self.__conn.lpop(channel_key)
+    def clear_msg(self, channel):
+        """
+        注册时，先检查一下 channel 对应的消息list 中是否有信息，如果有就先进行处理
+        :return:
+        """
+        self.drain(channel)
 
     def handle(self, channel, message:str):
         """
@@ -112,76 +242,95 @@ class Consumer(object):
         :param message: - string 消息 是从 真正的redis channel 中接收到的消息
         :return:
         """
-        index = int(message.index("/"))
+        txid, _ = split_content(message)
 
-        if index < 0:
+        if txid is None:
             # 消息不合法, 丢弃
             return
 
-        txid = int(message[:index])
+        # txid >= 队列中消息的序号 表示队列中有没有处理的消息，
+        # 调用回调函数进行消费，直到处理完txid个消息
+        self.drain(channel, txid)
+
+    def drain(self, channel, txid: int = None):
+        """
+        从redis client+channel 对应的 list 中批量获取消息并处理:
+        每次 LRANGE 读取最多 LIST_BATCH 条消息, 整批交给 process_messages 处理后 LTRIM 一次丢弃,
+        同时记录处理到的消息序号, 心跳到期时发送心跳(mq/subscriber.py), 每批只需要两次往返
+        :param channel:
+        :param txid: 只处理序号不超过txid的消息, None 处理全部消息
+        :return:
+        """
         channel_key = f"{self.client_id}/{channel}"
+        batch = mq_config["LIST_BATCH"]
 
-        # 下面是从redis client+channel 对应的 list 中获取消息
         while True:
-            # 获取第一个消息
-            lm = self.__conn.lindex(channel_key, 0)
-                       
-            if lm is None:
-                break
-            # else:
-            #     lm=lm.decode()
-
-            # print("Client {} 从 list:{} 中获取一个消息: {}".format(self.client_id, channel_key, lm))
-
-            li = int(lm.index("/"))
-
-            if li < 0:
-                # 消息不合法
-                result = self.__conn.lpop(channel_key)
-                if result is None:
-                    break
-                print(f"接收到一个不合法的消息: {result}")
-                #  callback(channel, message)
-                continue
-
-            # 消息序号
-            lmid = int(lm[:li])
-
-            # txid > lmid 表示队列中有没有处理的消息，
-            # 调用回调函数进行消费，直到处理完txid个消息
-            if txid >= lmid:
-                self.__conn.lpop(channel_key)
-                # 取出消息内容
-                lmessage = lm[(li + 1) :]
-
-                # 判断是否退出消息,如果不是就执行回调函数
-                if lmessage in ["EXIT", "exit", "Exit", "Quit", "quit", "QUIT"]:
-                    self.close(channel)
-                else:
-                    self.process_message(lmessage)
-                continue
-            else:
+            lms = self.__conn.lrange(channel_key, 0, batch - 1)
+            self.received_at = time.time()
+            messages, consumed, last_txid, is_exit = parse_batch(lms, txid)
+            if messages:
+                with self.__lock:
+                    self.process_messages(messages)
+            if is_exit:
+                # close 会删除消息list
+                self.close(channel)
+                return
+            # 将处理过的消息丢弃
+            if consumed:
+                pipe = self.__conn.pipeline(transaction=False)
+                pipe.ltrim(channel_key, consumed, -1)
+                if last_txid is not None:
+                    subscriber.record_progress(pipe, channel_key, last_txid)
+                if self.__heartbeat.due(channel_key):
+                    subscriber.register(pipe, channel_key)
+                pipe.execute()
+            if consumed < batch:
                 break
+
+    def process_messages(self, messages: list):
+        """
+        处理一批消息, 消息按序号排列, 默认逐条调用 process_message, 需要整批处理时重写
+        :param messages: - list 消息内容
+        :return:
+        """
+        for message in messages:
+            self.process_message(message)
     
     def attach(self, strategy):
         self.strategy_list.append(strategy)
+        self.dispatcher.attach(strategy)
     
     def notifyAllStrategy(self):
-        for strategy in self.strategy_list:
-            strategy.refresh_data()
+        """
+        把最新的行情交给所有策略的 refresh_data(data), 执行方式和队列满时的处理见 mq/dispatch.py
+        """
+        self.dispatcher.dispatch(self.latest_data)
 
                 
-    def close(self, channel):
+    def close(self, channel=None, timeout: float = None):
         """
-        关闭channel
-        :param channel:
+        关闭channel: 关闭它的监听开关, 取消订阅, 等待监听线程结束(在监听线程中调用时不等待自己),
+        同时订阅的其他channel(分片)不受影响
+        :param channel: None 关闭所有订阅的channel
+        :param timeout: 等待每个监听线程结束的最长时间(秒), None 一直等待
         :return:
         """
-        self.__conn.publish(channel, "exit")
-        # 删除channel对应的消息队列的list
-        self.on_unsubscribe(channel)
-        # 关闭监听开关，线程结束
-        self.__active = False
+        channels = list(self.__listeners) if channel is None else [channel]
+        listeners = []
+        for name in channels:
+            listener = self.__listeners.pop(name, None)
+            if listener is not None:
+                # 关闭监听开关，线程结束
+                listener.active.clear()
+                listeners.append(listener)
+            if self.transport != "stream":
+                # 唤醒阻塞在 get_message 上的监听线程; stream方式的监听线程在阻塞读取超时后检查监听开关
+                self.__conn.publish(name, "exit")
+            # 删除channel对应的消息队列的list
+            self.on_unsubscribe(name)
+        for listener in listeners:
+            if listener.thread is not None and listener.thread is not threading.current_thread():
+                listener.thread.join(timeout)
 
     def on_unsubscribe(self, channel):
         """
@@ -190,11 +339,18 @@ class Consumer(object):
         :param channel:
         :return:
         """
+        if self.transport == "stream":
+            # 只从消费者组中删除本消费者, 组的消费进度和同一client_id的其他消费者不受影响;
+            # stream中的消息由其他订阅者共享, 不删除
+            stream.delete_consumer(
+                self.__conn, channel, self.client_id, self.consumer_name or self.client_id
+            )
+            return
         channel_key = f"{self.client_id}/{channel}"
-        # 1. 从订阅者队列中删除
-        self.__conn.srem("PERSITS_SUB", channel_key)
-        # 2. 删除订阅者消息队列
-        self.__conn.delete(channel_key)
+        # 从订阅者队列中删除, 删除订阅者消息队列、心跳和消费进度
+        pipe = self.__conn.pipeline(transaction=False)
+        subscriber.remove(pipe, channel_key)
+        pipe.execute()
         
     def get_latest_data(self, code:str=None):
         """
@@ -205,10 +361,65 @@ class Consumer(object):
         return self.latest_data
 
 
-consumer = Consumer()
-consumer.subscribe(consumer.channel)
+def split_content(content):
+    """
+    消息队列中的 txid/messageContent 拆分为消息序号和消息内容, 文本消息的内容转为str
+    :param content: - str 或 bytes
+    :return: (txid, message), 不合法时为 (None, None)
+    """
+    index = content.find(b"/" if isinstance(content, bytes) else "/")
+    if index < 0:
+        return None, None
+    try:
+        txid = int(content[:index])
+    except ValueError:
+        return None, None
+    return txid, as_text(content[(index + 1) :])
+
+
+def parse_batch(lms: list, txid: int = None):
+    """
+    解析从消息队列读取的一批 txid/messageContent
+    :param lms: - list 按序号排列的消息
+    :param txid: 只处理序号不超过txid的消息, None 处理全部消息
+    :return: (messages, consumed, last_txid, is_exit) 需要处理的消息内容, 本批中处理过(包括不合法)的消息数量,
+        处理过的最后一条合法消息的序号(没有时为None), 是否遇到退出消息(退出消息之前的消息仍然处理)
+    """
+    messages = []
+    consumed = 0
+    last_txid = None
+    for lm in lms:
+        # 消息序号, 消息内容
+        lmid, lmessage = split_content(lm)
+        if lmid is None:
+            # 消息不合法
+            consumed += 1
+            print(f"接收到一个不合法的消息: {lm}")
+            continue
+        if txid is not None and lmid > txid:
+            break
+        consumed += 1
+        last_txid = lmid
+        if lmessage in EXIT_MESSAGES:
+            return messages, consumed, last_txid, True
+        messages.append(lmessage)
+    return messages, consumed, last_txid, False
+
+
+_consumer = None
+
+
+def default_consumer():
+    """
+    模块默认的消费者, 第一次调用时创建
+    """
+    global _consumer
+    if _consumer is None:
+        _consumer = Consumer()
+    return _consumer
+
 
-def get_latest_data(code:str=None, consumer=consumer):
+def get_latest_data(code:str=None, consumer=None):
     """
     获取每分钟新数据
     :return 
@@ -231,6 +442,8 @@ def get_latest_data(code:str=None, consumer=consumer):
     }
     
     """
+    if consumer is None:
+        consumer = default_consumer()
     try:
         if code:
             return consumer.latest_data.get(code)
@@ -239,3 +452,6 @@ def get_latest_data(code:str=None, consumer=consumer):
     return consumer.latest_data
 
 
+if __name__ == "__main__":
+    consumer = default_consumer()
+    consumer.subscribe(consumer.channel)
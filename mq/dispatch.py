@@ -0,0 +1,299 @@
+"""
+策略分发: 把收到的行情交给多个策略并发处理, 慢策略不阻塞监听线程和其他策略
+
+每个策略有自己的待处理队列, 同一个策略的消息按顺序逐条处理, 不同策略在线程池或进程池中并发执行.
+策略处理不过来, 队列满了时的处理方式(OVERRUN):
+
++ drop_oldest: 丢弃队列中最早的消息, 保留最近的 queue_size 条
++ coalesce: 只保留最新的一条, 还没开始处理的消息都被新消息替换
+
+执行方式(mode):
+
++ inline: 在调用线程中依次执行, 与原来的 notifyAllStrategy 相同
++ thread: 线程池, 适合处理时间主要花在io(下单, 数据库)上的策略
++ process: 进程池, 每个策略固定在一个子进程中, 策略对象在开始分发时复制到子进程, 之后的状态只在子进程中,
+  策略和消息都必须可以pickle
+
+每个策略的执行次数、耗时、排队时间、丢弃的消息数量见 stats
+"""
+import itertools
+import logging
+import threading
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from mq.config import mq_config
+
+logger = logging.getLogger(__name__)
+
+OVERRUN_POLICIES = ["drop_oldest", "coalesce"]
+MODES = ["inline", "thread", "process"]
+
+
+class StrategyStats(object):
+    """单个策略的执行统计, 时间单位为秒"""
+
+    def __init__(self, name: str) -> None:
+        self.name = name
+        # 收到的消息数量
+        self.received = 0
+        # 执行完成的次数(包括出错)
+        self.processed = 0
+        # 队列满时被丢弃或被新消息替换的消息数量
+        self.dropped = 0
+        self.errors = 0
+        # 执行时间超过预算的次数
+        self.over_budget = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+        self.last_time = 0.0
+        # 消息从进入队列到开始执行的最长等待时间
+        self.max_wait = 0.0
+
+    @property
+    def mean_time(self) -> float:
+        return self.total_time / self.processed if self.processed else 0.0
+
+    def to_dict(self) -> dict:
+        return {
+            "name": self.name,
+            "received": self.received,
+            "processed": self.processed,
+            "dropped": self.dropped,
+            "errors": self.errors,
+            "over_budget": self.over_budget,
+            "mean_time": self.mean_time,
+            "max_time": self.max_time,
+            "last_time": self.last_time,
+            "max_wait": self.max_wait,
+        }
+
+
+class _Slot(object):
+    """策略的待处理队列和执行状态"""
+
+    def __init__(self, index, strategy, queue_size, name) -> None:
+        self.index = index
+        self.strategy = strategy
+        self.queue = deque(maxlen=queue_size)
+        self.running = False
+        self.stats = StrategyStats(name)
+
+
+class StrategyDispatcher(object):
+    """
+    Args:
+        mode: inline, thread 或 process, 默认为配置文件 [MQ] 中的 DISPATCH
+        workers: 线程池的线程数或进程数, 默认为 DISPATCH_WORKERS
+        queue_size: 每个策略最多排队的消息数量, 默认为 DISPATCH_QUEUE
+        overrun: 队列满时的处理方式 drop_oldest 或 coalesce, 默认为 DISPATCH_OVERRUN
+        budget_ms: 单次执行时间预算(毫秒), 超过时记录到 stats 并输出警告, 0 不限制, 默认为 DISPATCH_BUDGET_MS
+        method: 分发时调用的策略方法名, 参数为 dispatch 的参数
+    """
+
+    def __init__(
+        self,
+        mode: str = None,
+        workers: int = None,
+        queue_size: int = None,
+        overrun: str = None,
+        budget_ms: int = None,
+        method: str = "refresh_data",
+    ) -> None:
+        self.mode = mode or mq_config["DISPATCH"]
+        if self.mode not in MODES:
+            raise ValueError(f"不支持的分发方式: {self.mode}")
+        self.overrun = overrun or mq_config["DISPATCH_OVERRUN"]
+        if self.overrun not in OVERRUN_POLICIES:
+            raise ValueError(f"不支持的队列溢出处理方式: {self.overrun}")
+        self.workers = workers or mq_config["DISPATCH_WORKERS"]
+        self.queue_size = 1 if self.overrun == "coalesce" else (queue_size or mq_config["DISPATCH_QUEUE"])
+        budget_ms = mq_config["DISPATCH_BUDGET_MS"] if budget_ms is None else budget_ms
+        self.budget = budget_ms / 1000
+        self.method = method
+        self.__slots = {}
+        # 策略的注册序号, 取消注册后不再使用, 进程池中按序号区分策略
+        self.__index = itertools.count()
+        self.__lock = threading.Lock()
+        self.__idle = threading.Condition(self.__lock)
+        self.__executors = None
+
+    def attach(self, strategy, name: str = None):
+        """
+        注册策略, process方式必须在第一次 dispatch 之前注册
+        :param strategy:
+        :param name: stats中的名字, 默认为策略的 client_id 或 strategy_id
+        """
+        if self.mode == "process" and self.__executors is not None:
+            raise RuntimeError("process方式需要在开始分发之前注册所有策略")
+        with self.__lock:
+            if id(strategy) in self.__slots:
+                return
+            index = next(self.__index)
+            if name is None:
+                name = getattr(strategy, "client_id", None) or getattr(strategy, "strategy_id", None)
+                name = str(name or f"strategy-{index}")
+            self.__slots[id(strategy)] = _Slot(index, strategy, self.queue_size, name)
+
+    def detach(self, strategy):
+        """取消注册, 已经排队的消息不再处理"""
+        with self.__lock:
+            slot = self.__slots.pop(id(strategy), None)
+            if slot is not None:
+                slot.queue.clear()
+                self.__idle.notify_all()
+
+    def dispatch(self, *args):
+        """把消息交给所有注册的策略"""
+        with self.__lock:
+            slots = list(self.__slots.values())
+        for slot in slots:
+            self.__submit(slot, args)
+
+    def submit(self, strategy, *args):
+        """把消息只交给一个策略, 策略没有注册时先注册"""
+        if id(strategy) not in self.__slots:
+            self.attach(strategy)
+        self.__submit(self.__slots[id(strategy)], args)
+
+    def __submit(self, slot, args):
+        with self.__lock:
+            slot.stats.received += 1
+            if len(slot.queue) == slot.queue.maxlen:
+                # deque满时append会丢弃最早的消息
+                slot.stats.dropped += 1
+            slot.queue.append((args, time.perf_counter()))
+            if slot.running:
+                return
+            slot.running = True
+        if self.mode == "inline":
+            while self.__next(slot):
+                pass
+        else:
+            self.__next(slot)
+
+    def __next(self, slot) -> bool:
+        """
+        取出策略的下一条消息执行, inline方式在当前线程执行, 其他方式提交到线程池或进程池, 执行完后再取下一条
+        :return: inline方式下还有没有消息需要执行
+        """
+        with self.__lock:
+            if not slot.queue or self.__slots.get(id(slot.strategy)) is not slot:
+                slot.running = False
+                self.__idle.notify_all()
+                return False
+            args, enqueued = slot.queue.popleft()
+            wait = time.perf_counter() - enqueued
+            if wait > slot.stats.max_wait:
+                slot.stats.max_wait = wait
+        if self.mode == "inline":
+            try:
+                elapsed = _execute(slot.strategy, self.method, args)
+            except Exception:
+                self.__record(slot, None)
+                logger.exception(f"策略 {slot.stats.name} 处理消息出错")
+            else:
+                self.__record(slot, elapsed)
+            return True
+        executor, call = self.__executor_of(slot)
+        future = executor.submit(*call, args)
+        future.add_done_callback(lambda f: self.__done(slot, f))
+        return False
+
+    def __executor_of(self, slot):
+        if self.__executors is None:
+            with self.__lock:
+                if self.__executors is None:
+                    self.__executors = self.__start()
+        if self.mode == "process":
+            return self.__executors[slot.index % len(self.__executors)], (_call_in_worker, slot.index)
+        return self.__executors[0], (_execute, slot.strategy, self.method)
+
+    def __start(self) -> list:
+        if self.mode == "thread":
+            return [ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="strategy")]
+        # 每个子进程一个单进程的进程池, 策略固定在一个子进程中, 状态在多次调用之间保留
+        workers = max(1, min(self.workers, len(self.__slots)))
+        groups = [{} for _ in range(workers)]
+        for slot in self.__slots.values():
+            groups[slot.index % workers][slot.index] = slot.strategy
+        return [
+            ProcessPoolExecutor(max_workers=1, initializer=_init_worker, initargs=(group, self.method))
+            for group in groups
+        ]
+
+    def __done(self, slot, future):
+        try:
+            elapsed = future.result()
+        except Exception as e:
+            self.__record(slot, None)
+            logger.error(f"策略 {slot.stats.name} 处理消息出错: {e!r}")
+        else:
+            self.__record(slot, elapsed)
+        self.__next(slot)
+
+    def __record(self, slot, elapsed):
+        with self.__lock:
+            stats = slot.stats
+            stats.processed += 1
+            if elapsed is None:
+                stats.errors += 1
+                return
+            stats.total_time += elapsed
+            stats.last_time = elapsed
+            if elapsed > stats.max_time:
+                stats.max_time = elapsed
+            over_budget = self.budget and elapsed > self.budget
+            if over_budget:
+                stats.over_budget += 1
+        if over_budget:
+            logger.warning(f"策略 {stats.name} 执行时间 {elapsed * 1000:.1f}ms 超过预算 {self.budget * 1000:.0f}ms")
+
+    def stats(self) -> list:
+        """
+        Returns:
+            list: 每个策略的统计 StrategyStats.to_dict(), 按注册顺序
+        """
+        with self.__lock:
+            return [slot.stats.to_dict() for slot in self.__slots.values()]
+
+    def join(self, timeout: float = None) -> bool:
+        """
+        等待所有排队的消息处理完成
+        :return: 超时为False
+        """
+        with self.__idle:
+            return self.__idle.wait_for(
+                lambda: not any(slot.running for slot in self.__slots.values()), timeout
+            )
+
+    def shutdown(self, wait: bool = True):
+        """关闭线程池或进程池, wait为True时先处理完排队的消息"""
+        if wait:
+            self.join()
+        if self.__executors is not None:
+            for executor in self.__executors:
+                executor.shutdown(wait=wait)
+            self.__executors = None
+
+
+def _execute(strategy, method, args) -> float:
+    """执行策略方法, 返回耗时(秒)"""
+    begin = time.perf_counter()
+    getattr(strategy, method)(*args)
+    return time.perf_counter() - begin
+
+
+# 子进程中的策略, 注册序号 -> 策略
+_worker_strategies = {}
+_worker_method = None
+
+
+def _init_worker(strategies, method):
+    global _worker_method
+    _worker_strategies.update(strategies)
+    _worker_method = method
+
+
+def _call_in_worker(index, args) -> float:
+    return _execute(_worker_strategies[index], _worker_method, args)
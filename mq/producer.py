@@ -1,18 +1,118 @@
-from util.redis_util import redis_pooling 
-import threading
+from util.redis_util import redis_pooling
+from mq import stream, subscriber
+from mq.codec import encode_message
+from mq.config import mq_config
+from mq.shard import shard_market
+from mq.trace import Trace, tracer
 import json
-import pandas as pd
-from util.init_table import get_codes
-from model.stock import Stock
-from jqdatasdk import get_price, get_all_securities
-from datetime import date, datetime, timedelta
-from util.jquant_util import jquant_auth
-from apscheduler.schedulers.blocking import BlockingScheduler
+import time
+
+
+# 发布消息的lua脚本, 在redis服务端依次完成: 生成消息序号, 写入订阅了该channel的每个订阅者的消息队列, 发送通知事件
+# 脚本在redis中原子执行, 一次往返完成, 不会出现序号已增加而消息只写入了部分队列的情况
+# 同时删除心跳超时的订阅者, 消息队列超过最大长度时丢弃最早的消息, 并更新每个订阅者的滞后量和channel的汇总(见 mq/subscriber.py)
+# 订阅者从 SUB_CHANNEL:{channel} 中读取, 只写入订阅了该channel的订阅者, 发布只需要一次EVALSHA
+# KEYS: MESSAGE_TXID, SUB_CHANNEL:{channel}, SUB_HEARTBEAT, SUB_TXID, SUB_LAG, SUB_LAG_SUMMARY, SUB_EVICTED, PERSITS_SUB
+# ARGV[1]: channel; ARGV[2]: 消息内容; ARGV[3]: 当前时间戳(秒); ARGV[4]: 心跳超时(秒), 0不删除; ARGV[5]: 队列最大长度, 0不限制
+PUBLISH_SCRIPT = """
+local txid = redis.call('INCR', KEYS[1])
+local content = txid .. '/' .. ARGV[2]
+local now = tonumber(ARGV[3])
+local ttl = tonumber(ARGV[4])
+local maxlen = tonumber(ARGV[5])
+local summary = {txid = txid, time = now, subscribers = 0, max_lag = 0, max_lag_subscriber = '', evicted = 0}
+local channel_keys = redis.call('SMEMBERS', KEYS[2])
+if #channel_keys > 0 then
+    -- 所有订阅者的心跳一次读取
+    local beats = redis.call('HMGET', KEYS[3], unpack(channel_keys))
+    local new_beats = {}
+    local lags = {}
+    local evicted = {}
+    for i, channel_key in ipairs(channel_keys) do
+        local beat = tonumber(beats[i])
+        if not beat then
+            -- 没有心跳记录的订阅者(旧版本的消费者)从现在开始计时
+            table.insert(new_beats, channel_key)
+            table.insert(new_beats, now)
+            beat = now
+        end
+        if ttl > 0 and now - beat > ttl then
+            table.insert(evicted, channel_key)
+        else
+            -- 滞后量为这个订阅者的消息队列中还没有处理的消息数, 与其他channel的消息数量无关
+            local pending = redis.call('RPUSH', channel_key, content)
+            if maxlen > 0 and pending > maxlen then
+                redis.call('LTRIM', channel_key, -maxlen, -1)
+                pending = maxlen
+            end
+            table.insert(lags, channel_key)
+            table.insert(lags, pending)
+            summary.subscribers = summary.subscribers + 1
+            if pending > summary.max_lag then
+                summary.max_lag = pending
+                summary.max_lag_subscriber = channel_key
+            end
+        end
+    end
+    if #new_beats > 0 then
+        redis.call('HSET', KEYS[3], unpack(new_beats))
+    end
+    if #lags > 0 then
+        redis.call('HSET', KEYS[5], unpack(lags))
+    end
+    if #evicted > 0 then
+        redis.call('SREM', KEYS[2], unpack(evicted))
+        redis.call('SREM', KEYS[8], unpack(evicted))
+        redis.call('DEL', unpack(evicted))
+        redis.call('HDEL', KEYS[3], unpack(evicted))
+        redis.call('HDEL', KEYS[4], unpack(evicted))
+        redis.call('HDEL', KEYS[5], unpack(evicted))
+        local evicted_at = {}
+        for _, channel_key in ipairs(evicted) do
+            table.insert(evicted_at, channel_key)
+            table.insert(evicted_at, now)
+        end
+        redis.call('HSET', KEYS[7], unpack(evicted_at))
+        summary.evicted = #evicted
+    end
+end
+redis.call('HSET', KEYS[6], ARGV[1], cjson.encode(summary))
+redis.call('PUBLISH', ARGV[1], content)
+return txid
+"""
+
+
+def publish_keys(channel: str) -> list:
+    """PUBLISH_SCRIPT 的KEYS"""
+    return [
+        "MESSAGE_TXID",
+        subscriber.channel_set(channel),
+        subscriber.SUB_HEARTBEAT,
+        subscriber.SUB_TXID,
+        subscriber.SUB_LAG,
+        subscriber.SUB_LAG_SUMMARY,
+        subscriber.SUB_EVICTED,
+        subscriber.PERSITS_SUB,
+    ]
 
 
 class Producer(object):
-    def __init__(self):
-        self.__conn = redis_pooling().get_conn(0)
+    """
+    Args:
+        conn: redis连接, 默认使用 redis_pooling 的第0个连接
+        transport: list 或 stream, 默认为配置文件 [MQ] 中的 TRANSPORT
+    """
+
+    def __init__(self, conn=None, transport: str = None):
+        if conn is None:
+            conn = redis_pooling().get_conn(0)
+        self.__conn = conn
+        self.transport = transport or mq_config["TRANSPORT"]
+        # 注册脚本只在本地计算sha, 第一次发布时由redis-py通过EVALSHA执行, 服务端没有缓存时自动加载
+        self.__publish_script = self.__conn.register_script(PUBLISH_SCRIPT)
+        if self.transport != "stream":
+            # 把旧版本消费者的登记加入 SUB_CHANNEL:{channel}, 之后发布时只在脚本中读取
+            subscriber.index_channels(self.__conn)
 
     def reset_msg_idx(self):
         """
@@ -22,30 +122,53 @@ class Producer(object):
         # 重置消息发送顺序号
         self.__conn.set("MESSAGE_TXID", 0)
 
-    def publish(self, channel, message):
+    def publish(self, channel, message, client=None):
         """
-        发布辅助函数
+        发布辅助函数 \n
+        list: 消息格式为 txid/messageContent, 先写入订阅了该channel的每个订阅者 ClientID/channelName 的消息队列
+        (SUB_CHANNEL:{channel}中的成员), 再向channel发送事件触发 subscribe 接收消息. 读取订阅者、写入和通知在一个lua脚本中
+        原子完成, 一次往返.
+        消息队列最多保留 LIST_MAXLEN 条消息, 心跳超过 HEARTBEAT_TTL 秒的订阅者被删除 \n
+        stream: 消息写入channel对应的stream, 只保存一份
         :param channel:
         :param message:
-        :return:
+        :param client: 执行命令的redis连接或pipeline, 默认为生产者的连接
+        :return: list为txid 消息序号, stream为消息id; client为pipeline时为pipeline
         """
-        txid = self.__conn.incr("MESSAGE_TXID")
-        # 为每个消息设定id, 最终消息格式 1000/messageContent
-        content = f"{txid}/{message}"
-        # 首先 将消息发布到 list 中
-        # 获取 client 列表， 对每一个client channel 的list 发送当前消息  PERSITS_SUB
-        channel_keys = self.__conn.smembers("PERSITS_SUB")
-        print(f"查询到的 channel 列表为: {channel_keys}")
-
-        # 将消息发送到每个client 注册的 channel 中  channel key的格式: ClientID/channelName
-        for channel_key in channel_keys:
-            # Rpush 命令用于将一个或多个值插入到列表的尾部(最右边)
-            # 如果列表不存在，一个空列表会被创建并执行 RPUSH 操作
-            print(f"Publisher 向 list: {channel_key} 发布一条消息")
-            self.__conn.rpush(channel_key, content)
+        if client is None:
+            client = self.__conn
+        if self.transport == "stream":
+            return stream.publish(client, channel, message, mq_config["STREAM_MAXLEN"])
+        return self.__publish_script(
+            keys=publish_keys(channel),
+            args=[channel, message, time.time(), mq_config["HEARTBEAT_TTL"], mq_config["LIST_MAXLEN"]],
+            client=client,
+        )
 
-        # 再调用 redis 的 publish 方法 发送事件，触发 subscribe 接收消息
-        self.__conn.publish(channel=channel, message=content)
+    def publish_market(self, channel, data, codec: str = None, shard: bool = None, trace: Trace = None):
+        """
+        发布全市场行情, 开启分片时同时发布每个交易所(channel:交易所代码)和每个合约(channel:合约代码)的分片消息,
+        所有消息在一个事务pipeline中发送, 订阅者不会只收到一部分分片
+        :param channel:
+        :param data: 以合约代码为索引的全市场行情
+        :param codec: json 或 binary, 默认为配置文件 [MQ] 中的 CODEC
+        :param shard: 是否发布分片, 默认为配置文件 [MQ] 中的 SHARD
+        :param trace: tracer.start() 创建的trace, 记录发布时间后随每条消息发送, None不发送
+        :return: 完整消息的内容
+        """
+        codec = codec or mq_config["CODEC"]
+        if shard is None:
+            shard = bool(mq_config["SHARD"])
+        tracer.mark(trace, "publish")
+        message = encode_message(data, codec, trace)
+        messages = [(channel, message)]
+        if shard:
+            messages += shard_market(channel, data, codec, trace)
+        pipe = self.__conn.pipeline(transaction=True)
+        for name, content in messages:
+            self.publish(name, content, client=pipe)
+        pipe.execute()
+        return message
 
 
 def test_redis(host="localhost", port=6379):
@@ -0,0 +1,62 @@
+"""
+行情消息按合约和交易所分片
+
+除了完整的全市场消息(channel), 生产者还向每个交易所和每个合约发布只包含对应数据的消息:
+
++ 交易所: channel:交易所代码, 例如 1m:CCFX
++ 合约: channel:合约代码, 例如 1m:IH2206.CCFX
+
+只关心少数合约的策略用 Consumer.subscribe(channel, codes=[...]) 只订阅这些分片
+"""
+import pandas as pd
+from mq.codec import encode_groups
+from mq.trace import Trace
+
+
+def exchange_of(code: str) -> str:
+    """合约代码中的交易所代码, 例如 IH2206.CCFX -> CCFX"""
+    return code.rsplit(".", 1)[-1]
+
+
+def shard_channel(channel: str, key: str) -> str:
+    """
+    Args:
+        channel: 完整消息的channel, 例如 1m
+        key: 合约代码或交易所代码
+    """
+    return f"{channel}:{key}"
+
+
+def shard_groups(channel: str, data: pd.DataFrame) -> list:
+    """
+    Args:
+        channel: 完整消息的channel
+        data: 以合约代码为索引的全市场行情
+    Returns:
+        list: [(分片channel, 分片包含的合约在data中的行号), ...], 先交易所后合约
+    """
+    codes = [str(code) for code in data.index]
+    exchanges = {}
+    for i, code in enumerate(codes):
+        exchanges.setdefault(exchange_of(code), []).append(i)
+    shards = [
+        (shard_channel(channel, exchange), rows)
+        for exchange, rows in sorted(exchanges.items())
+    ]
+    shards += [(shard_channel(channel, code), [i]) for i, code in enumerate(codes)]
+    return shards
+
+
+def shard_market(channel: str, data: pd.DataFrame, codec: str = "json", trace: Trace = None) -> list:
+    """
+    Args:
+        channel: 完整消息的channel
+        data: 以合约代码为索引的全市场行情
+        codec: json 或 binary
+        trace: 随每条分片消息发送的各阶段时间戳
+    Returns:
+        list: [(分片channel, 分片消息), ...], 先交易所后合约
+    """
+    shards = shard_groups(channel, data)
+    messages = encode_groups(data, [rows for _, rows in shards], codec, trace)
+    return [(name, message) for (name, _), message in zip(shards, messages)]
@@ -0,0 +1,142 @@
+"""
+基于redis stream的消息传输
+
+每个channel对应一个stream(STREAM/channel), 每条消息在redis中只保存一份, 与订阅者数量无关.
+每个client_id是stream上的一个消费者组, 组内的消费者各自读取一部分消息, 处理完成后确认(XACK).
+消费者退出时已读取未确认的消息留在组的待处理列表(PEL)中, 同名消费者重启后先处理自己的待处理消息,
+超过 STREAM_CLAIM_IDLE_MS 仍未确认的其他消费者的消息由存活的消费者认领(XAUTOCLAIM).
+待处理的消息可能已经因为超过 STREAM_MAXLEN 被裁剪, 读取时内容为空, 这些消息直接确认.
+取消订阅时只从组中删除本消费者(XGROUP DELCONSUMER), 组和组内其他消费者不受影响
+"""
+from redis.exceptions import ResponseError
+
+
+def stream_key(channel: str) -> str:
+    return f"STREAM/{channel}"
+
+
+def create_group(conn, channel: str, group: str):
+    """
+    创建消费者组, 已存在时不做任何操作.
+    新建的组从当前最新的消息之后开始读取, 与list方式注册到 PERSITS_SUB 之后才能收到消息相同
+    """
+    try:
+        conn.xgroup_create(stream_key(channel), group, id="$", mkstream=True)
+    except ResponseError as e:
+        if "BUSYGROUP" not in str(e):
+            raise
+
+
+def destroy_group(conn, channel: str, group: str):
+    conn.xgroup_destroy(stream_key(channel), group)
+
+
+def delete_consumer(conn, channel: str, group: str, consumer: str):
+    """从消费者组中删除一个消费者, 它的待处理消息一起删除, 组内其他消费者继续读取"""
+    conn.xgroup_delconsumer(stream_key(channel), group, consumer)
+
+
+def publish(conn, channel: str, message: str, maxlen: int) -> str:
+    """
+    写入一条消息, stream只保留最近约maxlen条
+    Returns:
+        id (str): 消息id, 格式为 毫秒时间戳-序号, 单调递增
+    """
+    return conn.xadd(stream_key(channel), {"data": message}, maxlen=maxlen, approximate=True)
+
+
+def read_pending(conn, channel: str, group: str, consumer: str, count: int) -> list:
+    """
+    读取本消费者已读取但未确认的消息, 用于重启后继续处理. 已被裁剪的消息直接确认, 继续读取后面的消息
+    Returns:
+        entries (list): [(消息id, {"data": 消息内容}), ...], 没有待处理的消息时为空列表
+    """
+    while True:
+        response = conn.xreadgroup(group, consumer, {stream_key(channel): "0"}, count=count)
+        entries, deleted = _split(_messages(response))
+        ack(conn, channel, group, deleted)
+        if entries or not deleted:
+            return entries
+
+
+def claim(conn, channel: str, group: str, consumer: str, min_idle_ms: int, count: int) -> list:
+    """认领组内其他消费者超过min_idle_ms仍未确认的消息"""
+    result = conn.xautoclaim(
+        stream_key(channel), group, consumer, min_idle_ms, start_id="0-0", count=count
+    )
+    entries, deleted = parse_claim(result)
+    ack(conn, channel, group, deleted)
+    return entries
+
+
+def parse_claim(result):
+    """
+    xautoclaim 返回 [下一次扫描的起点, 认领的消息, 已被删除的消息id(redis 7)],
+    redis 6.2 中已被裁剪的消息内容为空, 需要直接确认
+    Returns:
+        entries (list): [(消息id, {"data": 消息内容}), ...]
+        deleted (list): 已被裁剪的消息id
+    """
+    return _split(result[1])
+
+
+def read(conn, channel: str, group: str, consumer: str, count: int, block_ms: int) -> list:
+    """阻塞读取新消息, 最多等待block_ms毫秒, 一次最多count条"""
+    return _entries(
+        conn.xreadgroup(
+            group, consumer, {stream_key(channel): ">"}, count=count, block=block_ms
+        )
+    )
+
+
+def ack(conn, channel: str, group: str, message_ids: list):
+    if message_ids:
+        conn.xack(stream_key(channel), group, *message_ids)
+
+
+def _messages(response) -> list:
+    """xreadgroup 读取一个stream的返回值中的 [(消息id, 字段), ...]"""
+    messages = []
+    for _, part in response or []:
+        messages.extend(part)
+    return messages
+
+
+def _entries(response) -> list:
+    """xreadgroup 的返回值转为 [(消息id, {"data": 消息内容}), ...], 不包括已被裁剪的消息"""
+    return _split(_messages(response))[0]
+
+
+def _split(messages):
+    """
+    Returns:
+        entries (list): [(消息id, {"data": 消息内容}), ...]
+        deleted (list): 已被裁剪(内容为空)的消息id
+    """
+    entries = [(message_id, _fields(fields)) for message_id, fields in messages if fields]
+    deleted = [message_id for message_id, fields in messages if not fields]
+    return entries, deleted
+
+
+def _fields(fields):
+    """不解码的连接返回的字段名为bytes, 统一为str"""
+    return {
+        name.decode("utf-8") if isinstance(name, bytes) else name: value
+        for name, value in fields.items()
+    }
+
+
+def channel_of(key) -> str:
+    """stream的key转为channel, 即 stream_key 的逆操作"""
+    if isinstance(key, bytes):
+        key = key.decode("utf-8")
+    return key[len(stream_key("")) :]
+
+
+def parse_streams(response) -> list:
+    """
+    同时读取多个stream时 xreadgroup 的返回值转为 [(channel, [(消息id, {"data": 消息内容}), ...], 已被裁剪的消息id), ...]
+    """
+    if not response:
+        return []
+    return [(channel_of(key), *_split(messages)) for key, messages in response]
@@ -0,0 +1,120 @@
+"""
+list方式订阅者的登记、心跳和消费进度
+
+订阅者 client_id/channel 除了在 PERSITS_SUB 中登记外, 还记录在:
+
++ SUB_CHANNEL:{channel}: set, 订阅了channel的订阅者, 生产者发布时只读取这个channel的订阅者
++ SUB_HEARTBEAT: hash, 订阅者 -> 最近一次心跳的时间戳(秒). 生产者发布时, 心跳超过 HEARTBEAT_TTL 的订阅者
+  被认为已经退出, 从 PERSITS_SUB 中删除并删除它的消息队列, 记录到 SUB_EVICTED
++ SUB_TXID: hash, 订阅者 -> 最近一次处理的消息序号
++ SUB_LAG: hash, 订阅者 -> 生产者最近一次发布时的滞后量(消息队列中还没有处理的消息数), max_lag 为其中的最大值
++ SUB_LAG_SUMMARY: hash, channel -> json {txid, time, subscribers, max_lag, max_lag_subscriber, evicted},
+  生产者每次发布时更新, 运维用 HGETALL SUB_LAG_SUMMARY 即可查看所有channel的情况
++ SUB_EVICTED: hash, 被删除的订阅者 -> 删除时间
+"""
+import json
+import time
+from mq.config import mq_config
+
+PERSITS_SUB = "PERSITS_SUB"
+SUB_HEARTBEAT = "SUB_HEARTBEAT"
+SUB_TXID = "SUB_TXID"
+SUB_LAG = "SUB_LAG"
+SUB_LAG_SUMMARY = "SUB_LAG_SUMMARY"
+SUB_EVICTED = "SUB_EVICTED"
+SUB_CHANNEL = "SUB_CHANNEL:"
+
+
+def channel_of(channel_key: str) -> str:
+    """client_id/channel 中的channel"""
+    return channel_key.split("/", 1)[1]
+
+
+def channel_set(channel: str) -> str:
+    """订阅了channel的订阅者集合的key"""
+    return f"{SUB_CHANNEL}{channel}"
+
+
+def heartbeat_interval() -> float:
+    """订阅者没有收到消息时发送心跳的间隔(秒), 为心跳超时的1/3"""
+    ttl = mq_config["HEARTBEAT_TTL"]
+    return ttl / 3 if ttl > 0 else 60
+
+
+class Heartbeat(object):
+    """记录每个订阅者上次心跳的时间, 心跳只在间隔到期时发送, 不随每批消息写入"""
+
+    def __init__(self) -> None:
+        self.interval = heartbeat_interval()
+        self.__last = {}
+
+    def due(self, channel_key: str) -> bool:
+        """channel_key的心跳是否到期, 到期时记为已发送"""
+        now = time.monotonic()
+        if now - self.__last.get(channel_key, float("-inf")) < self.interval:
+            return False
+        self.__last[channel_key] = now
+        return True
+
+
+def register(client, channel_key: str):
+    """
+    登记订阅者并记录心跳, 也用于定时心跳: 订阅者因为心跳超时被删除后, 下一次心跳时重新登记
+    :param client: redis连接或pipeline(包括redis.asyncio的pipeline)
+    :param channel_key: client_id/channel
+    """
+    client.sadd(PERSITS_SUB, channel_key)
+    client.sadd(channel_set(channel_of(channel_key)), channel_key)
+    client.hset(SUB_HEARTBEAT, channel_key, time.time())
+
+
+def record_progress(client, channel_key: str, txid: int):
+    """记录订阅者处理到的消息序号"""
+    client.hset(SUB_TXID, channel_key, txid)
+
+
+def remove(client, channel_key: str):
+    """取消订阅: 删除登记、消息队列、心跳和消费进度"""
+    client.srem(PERSITS_SUB, channel_key)
+    client.srem(channel_set(channel_of(channel_key)), channel_key)
+    client.delete(channel_key)
+    client.hdel(SUB_HEARTBEAT, channel_key)
+    client.hdel(SUB_TXID, channel_key)
+    client.hdel(SUB_LAG, channel_key)
+
+
+def index_channels(conn) -> int:
+    """
+    把只登记在 PERSITS_SUB 中的订阅者(旧版本的消费者)加入 SUB_CHANNEL:{channel}
+    Returns:
+        int: 新加入的订阅者数量
+    """
+    pipe = conn.pipeline(transaction=False)
+    channel_keys = [_text(key) for key in conn.smembers(PERSITS_SUB)]
+    channel_keys = [key for key in channel_keys if "/" in key]
+    for channel_key in channel_keys:
+        pipe.sadd(channel_set(channel_of(channel_key)), channel_key)
+    return sum(pipe.execute())
+
+
+def lag_summary(conn) -> dict:
+    """
+    Returns:
+        dict: {channel: {txid, time, subscribers, max_lag, max_lag_subscriber, evicted}}
+    """
+    return {
+        _text(channel): json.loads(summary)
+        for channel, summary in conn.hgetall(SUB_LAG_SUMMARY).items()
+    }
+
+
+def subscriber_lag(conn) -> dict:
+    """
+    Returns:
+        dict: {client_id/channel: 还没有处理的消息数}
+    """
+    return {_text(key): int(lag) for key, lag in conn.hgetall(SUB_LAG).items()}
+
+
+def _text(value):
+    return value.decode("utf-8") if isinstance(value, bytes) else value
@@ -0,0 +1,199 @@
+"""
+行情从获取到下单的全链路延迟追踪
+
+每条行情消息带有各阶段的时间戳(秒, time.time()), 依次为:
+
++ fetch_start: 服务端开始从聚宽获取分钟数据
++ fetch_end: 获取完成
++ publish: 生产者编码并发布消息
++ receive: 消费者从redis读取到消息
++ decode: 消费者解码完成
++ decision: 策略计算出信号
++ order: 策略提交委托
+
+服务端的时间戳随消息发送(binary格式在头部的trace中, json格式在 _trace 字段中, 解码后为 data.trace),
+消费者和策略在收到的trace上继续打点. 每次打点在本进程的 tracer 中记录两个延迟: 与上一个阶段的间隔(stage)
+和与 fetch_start 的间隔(total), 用固定的对数分桶直方图累计, 每次打点只有一次 time.time() 和一次二分查找.
+跨进程的延迟依赖服务器之间的时钟同步.
+
+导出: tracer.to_dict() / tracer.to_json() / tracer.to_text() (prometheus文本格式)
+"""
+import json
+import threading
+import time
+from bisect import bisect_left
+from mq.config import mq_config
+
+STAGES = ["fetch_start", "fetch_end", "publish", "receive", "decode", "decision", "order"]
+_STAGE_INDEX = {stage: i for i, stage in enumerate(STAGES)}
+# 直方图分桶上界(秒), 0.1ms 到约52秒, 最后一个桶为 +Inf
+BUCKETS = [0.0001 * 2 ** i for i in range(20)]
+
+
+class Trace(object):
+    """
+    一条消息的各阶段时间戳 \n
+    Args:
+        stamps: {阶段: 时间戳}
+    """
+
+    __slots__ = ["stamps"]
+
+    def __init__(self, stamps: dict = None) -> None:
+        self.stamps = dict(stamps) if stamps else {}
+
+    def previous(self, stage: str):
+        """stage之前最近一个已经打点的阶段和时间戳, 没有时为 (None, None)"""
+        for i in range(_STAGE_INDEX[stage] - 1, -1, -1):
+            t = self.stamps.get(STAGES[i])
+            if t is not None:
+                return STAGES[i], t
+        return None, None
+
+    def to_dict(self) -> dict:
+        return dict(self.stamps)
+
+
+class LatencyHistogram(object):
+    """延迟直方图, 分桶见 BUCKETS"""
+
+    def __init__(self) -> None:
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds: float):
+        self.counts[bisect_left(BUCKETS, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def quantile(self, q: float) -> float:
+        """由分桶估计的分位数, 取所在桶的上界, 落在 +Inf 桶时为最大值"""
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        cumulative = 0
+        for bound, count in zip(BUCKETS, self.counts):
+            cumulative += count
+            if cumulative >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    def to_dict(self) -> dict:
+        return {
+            "count": self.count,
+            "sum": self.sum,
+            "max": self.max,
+            "p50": self.quantile(0.5),
+            "p90": self.quantile(0.9),
+            "p99": self.quantile(0.99),
+            "buckets": self.counts,
+        }
+
+
+class Tracer(object):
+    """
+    本进程的阶段延迟汇总 \n
+    Args:
+        enabled: 是否记录, 默认为配置文件 [MQ] 中的 TRACE
+    """
+
+    def __init__(self, enabled: bool = None) -> None:
+        self.enabled = bool(mq_config["TRACE"]) if enabled is None else enabled
+        # (kind, stage) -> LatencyHistogram, kind 为 stage 或 total
+        self.histograms = {}
+        self.__lock = threading.Lock()
+
+    def start(self, t: float = None):
+        """
+        服务端开始获取数据时创建trace
+        :return: Trace, 没有开启时为None
+        """
+        if not self.enabled:
+            return None
+        return Trace({"fetch_start": time.time() if t is None else t})
+
+    def mark(self, trace, stage: str, t: float = None):
+        """
+        在trace上记录stage的时间戳, 并记录与上一个阶段、与fetch_start的间隔
+        :param trace: Trace 或 None(消息没有带trace或没有开启时不记录)
+        :param stage: STAGES中的阶段
+        :param t: 时间戳, 默认为当前时间
+        """
+        if trace is None or not self.enabled:
+            return
+        if t is None:
+            t = time.time()
+        trace.stamps[stage] = t
+        previous, previous_t = trace.previous(stage)
+        start = trace.stamps.get("fetch_start")
+        with self.__lock:
+            if previous_t is not None:
+                self.__observe("stage", stage, t - previous_t)
+            if start is not None and previous != "fetch_start" and stage != "fetch_start":
+                self.__observe("total", stage, t - start)
+
+    def __observe(self, kind, stage, seconds):
+        key = (kind, stage)
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            histogram = self.histograms[key] = LatencyHistogram()
+        # 时钟不同步时跨进程的间隔可能为负数
+        histogram.observe(max(seconds, 0.0))
+
+    def reset(self):
+        with self.__lock:
+            self.histograms = {}
+
+    def to_dict(self) -> dict:
+        """
+        Returns:
+            dict: {"stage": {阶段: 直方图}, "total": {阶段: 直方图}, "buckets": 分桶上界}, 单位为秒
+        """
+        with self.__lock:
+            result = {"stage": {}, "total": {}, "buckets": BUCKETS}
+            for (kind, stage), histogram in sorted(
+                self.histograms.items(), key=lambda item: _STAGE_INDEX[item[0][1]]
+            ):
+                result[kind][stage] = histogram.to_dict()
+            return result
+
+    def to_json(self) -> str:
+        return json.dumps(self.to_dict())
+
+    def to_text(self, name: str = "jquant_latency_seconds") -> str:
+        """prometheus文本格式, 标签 kind(stage/total) 和 stage"""
+        lines = [f"# TYPE {name} histogram"]
+        data = self.to_dict()
+        for kind in ["stage", "total"]:
+            for stage, histogram in data[kind].items():
+                labels = f'kind="{kind}",stage="{stage}"'
+                cumulative = 0
+                for bound, count in zip(BUCKETS + ["+Inf"], histogram["buckets"]):
+                    cumulative += count
+                    le = bound if isinstance(bound, str) else f"{bound:g}"
+                    lines.append(f'{name}_bucket{{{labels},le="{le}"}} {cumulative}')
+                lines.append(f"{name}_sum{{{labels}}} {histogram['sum']}")
+                lines.append(f"{name}_count{{{labels}}} {histogram['count']}")
+        return "\n".join(lines) + "\n"
+
+
+def trace_of(data):
+    """解码后的行情带有的trace, 没有时为None"""
+    return getattr(data, "trace", None)
+
+
+def fork(data):
+    """
+    同一条行情交给多个策略时, 每个策略在trace的副本上记录 decision 和 order, 互不覆盖
+    :return: Trace 或 None
+    """
+    trace = trace_of(data)
+    return None if trace is None else Trace(trace.stamps)
+
+
+# 本进程的tracer
+tracer = Tracer()
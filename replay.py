@@ -0,0 +1,247 @@
+"""
+历史行情回放: 把历史分钟数据按时间顺序通过 Producer 发布到消息队列, 策略通过真实的消费者链路接收,
+用于回测和消息队列的压力测试
+
+数据来源:
+
++ mysql: future_m 表
++ redis: get_latest_minute_data 以分钟时间为key缓存的消息集合
++ file: 本地csv或parquet文件, 列与 future_m 相同(code, trade_date, open, high, low, close, ...)
+
+python replay.py --source mysql --start "2022-05-18 09:00:00" --end "2022-05-18 15:00:00" --speed 60
+python replay.py --source file --path bars.csv --speed 0 --exit
+
+speed为相对真实时间的倍数, 按相邻两分钟k线的时间间隔除以speed等待; 0 不等待, 尽可能快地发布
+"""
+import argparse
+import logging
+import time
+from datetime import datetime, timedelta
+import pandas as pd
+from mq.codec import decode_message, to_frame
+from mq.config import mq_config
+from mq.producer import Producer
+from mq.shard import shard_groups
+from mq.trace import tracer
+
+logging.basicConfig(level=logging.INFO, format="%(levelname)s:%(message)s")
+
+# 与 get_latest_minute_data 发布的字段相同
+FIELDS = ["open", "high", "low", "close", "volume", "money", "open_interest"]
+
+
+def group_minutes(data: pd.DataFrame):
+    """
+    按分钟拆分历史行情
+    Args:
+        data: 包含 code, trade_date 和行情字段的 DataFrame
+    Returns:
+        generator: (trade_date, 以合约代码为索引的当分钟行情), 按时间排序
+    """
+    data = data.copy()
+    data["trade_date"] = pd.to_datetime(data["trade_date"]).astype(str)
+    data.sort_values(["trade_date", "code"], inplace=True)
+    for trade_date, minute in data.groupby("trade_date", sort=True):
+        yield trade_date, minute.set_index("code", drop=True)
+
+
+def mysql_bars(start: str, end: str, codes: list = None):
+    """
+    从 future_m 表读取 [start, end] 的分钟行情
+    Args:
+        start: 开始时间, 例如 2022-05-18 09:00:00
+        end: 结束时间
+        codes: 只回放这些合约, None为全部合约
+    """
+    # 导入时会读取数据库配置, 只在使用mysql数据源时导入; 单独的连接, 读取后关闭, 不影响 db_util 共用的连接
+    from util.mysql_sink import mysql_connect
+
+    columns = ["code", "trade_date"] + FIELDS
+    sql = f"select {','.join(columns)} from future_m where trade_date between %s and %s"
+    params = [start, end]
+    if codes:
+        sql += " and code in (%s)" % ",".join(["%s"] * len(codes))
+        params += list(codes)
+    conn = mysql_connect()
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute(sql, params)
+            rows = cursor.fetchall()
+    finally:
+        conn.close()
+    data = pd.DataFrame([list(row) for row in rows], columns=columns)
+    data[FIELDS] = data[FIELDS].astype(float)
+    return group_minutes(data)
+
+
+def redis_bars(conn, start: str, end: str, codes: list = None, chunk: int = 500):
+    """
+    读取 get_latest_minute_data 缓存的每分钟消息, key为分钟时间, 值为该分钟发布的消息集合
+    Args:
+        conn: 不解码返回值的redis连接(集合中可能有二进制消息)
+        start: 开始时间
+        end: 结束时间
+        codes: 只回放这些合约, None为全部合约
+        chunk: 每次pipeline读取的分钟数
+    """
+    minute = datetime.strptime(start, "%Y-%m-%d %H:%M:%S")
+    end = datetime.strptime(end, "%Y-%m-%d %H:%M:%S")
+    while minute <= end:
+        keys = []
+        while minute <= end and len(keys) < chunk:
+            keys.append(minute.strftime("%Y-%m-%d %H:%M:%S"))
+            minute += timedelta(minutes=1)
+        pipe = conn.pipeline(transaction=False)
+        for key in keys:
+            pipe.smembers(key)
+        for key, messages in zip(keys, pipe.execute()):
+            if not messages:
+                continue
+            # 同一分钟重复获取时集合中有多条消息, 按合约合并
+            frames = [to_frame(decode_message(message)) for message in messages]
+            data = pd.concat(frames)
+            data = data[~data.index.duplicated(keep="last")].sort_index()
+            if codes:
+                data = data[data.index.isin(codes)]
+            if len(data):
+                yield key, data
+
+
+def file_bars(path: str, codes: list = None):
+    """
+    读取本地的csv或parquet文件
+    Args:
+        path: 文件路径, .parquet 为parquet格式, 其他为csv
+        codes: 只回放这些合约, None为全部合约
+    """
+    if path.endswith(".parquet"):
+        data = pd.read_parquet(path)
+    else:
+        data = pd.read_csv(path)
+    if codes:
+        data = data[data["code"].isin(codes)]
+    columns = ["code", "trade_date"] + [field for field in FIELDS if field in data.columns]
+    return group_minutes(data[columns])
+
+
+class Replayer(object):
+    """
+    Args:
+        producer: 发布消息的 Producer, 默认为 Producer()
+        channel: 发布的channel
+        speed: 相对真实时间的倍数, 0 不等待
+        codec: json 或 binary, 默认为配置文件 [MQ] 中的 CODEC
+        shard: 是否发布分片, 默认为配置文件 [MQ] 中的 SHARD
+        report_every: 每发布多少分钟输出一次进度, 0 不输出
+    """
+
+    def __init__(
+        self,
+        producer: Producer = None,
+        channel: str = "1m",
+        speed: float = 0,
+        codec: str = None,
+        shard: bool = None,
+        report_every: int = 0,
+    ) -> None:
+        self.producer = producer or Producer()
+        self.channel = channel
+        self.speed = speed
+        self.codec = codec
+        self.shard = bool(mq_config["SHARD"]) if shard is None else shard
+        self.report_every = report_every
+        # 发布过的channel(包括分片), 用于结束时发送退出消息
+        self.channels = {channel}
+
+    def run(self, bars) -> dict:
+        """
+        依次发布每分钟的行情
+        Args:
+            bars: (trade_date, DataFrame) 的迭代器, 例如 mysql_bars / redis_bars / file_bars 的结果
+        Returns:
+            dict: minutes 发布的分钟数, rows 合约行数, elapsed 耗时(秒), minutes_per_second, rows_per_second,
+                publish_ms 每分钟发布耗时的平均值
+        """
+        minutes = 0
+        rows = 0
+        publish_time = 0.0
+        previous = None
+        begin = time.perf_counter()
+        schedule = begin
+        iterator = iter(bars)
+        while True:
+            # 读取数据对应实时服务中从聚宽获取数据的阶段
+            trace = tracer.start()
+            try:
+                trade_date, data = next(iterator)
+            except StopIteration:
+                break
+            tracer.mark(trace, "fetch_end")
+            current = pd.Timestamp(trade_date)
+            if self.speed > 0 and previous is not None:
+                schedule += (current - previous).total_seconds() / self.speed
+                delay = schedule - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+            previous = current
+            started = time.perf_counter()
+            self.producer.publish_market(
+                self.channel, data, codec=self.codec, shard=self.shard, trace=trace
+            )
+            publish_time += time.perf_counter() - started
+            if self.shard:
+                self.channels.update(name for name, _ in shard_groups(self.channel, data))
+            minutes += 1
+            rows += len(data)
+            if self.report_every and minutes % self.report_every == 0:
+                logging.info(f"replayed {minutes} minutes, last: {trade_date}")
+        elapsed = time.perf_counter() - begin
+        return {
+            "minutes": minutes,
+            "rows": rows,
+            "elapsed": elapsed,
+            "minutes_per_second": minutes / elapsed if elapsed else 0.0,
+            "rows_per_second": rows / elapsed if elapsed else 0.0,
+            "publish_ms": publish_time / minutes * 1000 if minutes else 0.0,
+        }
+
+    def finish(self):
+        """向发布过的所有channel发送退出消息, 订阅这些channel的消费者处理完消息后退出"""
+        for channel in sorted(self.channels):
+            self.producer.publish(channel, "EXIT")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--source", default="mysql", choices=["mysql", "redis", "file"])
+    parser.add_argument("--start", help="开始时间, 例如 2022-05-18 09:00:00")
+    parser.add_argument("--end", help="结束时间")
+    parser.add_argument("--path", help="file数据源的文件路径")
+    parser.add_argument("--codes", nargs="+", help="只回放这些合约")
+    parser.add_argument("--channel", default="1m")
+    parser.add_argument("--speed", type=float, default=0, help="相对真实时间的倍数, 0 尽可能快")
+    parser.add_argument("--codec", choices=["json", "binary"])
+    parser.add_argument("--exit", action="store_true", help="结束时发送退出消息")
+    args = parser.parse_args()
+
+    if args.source == "mysql":
+        bars = mysql_bars(args.start, args.end, args.codes)
+    elif args.source == "redis":
+        from util.redis_util import redis_pooling
+
+        bars = redis_bars(redis_pooling().get_conn(2, binary=True), args.start, args.end, args.codes)
+    else:
+        bars = file_bars(args.path, args.codes)
+    replayer = Replayer(channel=args.channel, speed=args.speed, codec=args.codec, report_every=100)
+    report = replayer.run(bars)
+    if args.exit:
+        replayer.finish()
+    logging.info(
+        f"minutes: {report['minutes']} rows: {report['rows']} elapsed: {report['elapsed']:.2f}s "
+        f"{report['minutes_per_second']:.1f} minutes/s {report['rows_per_second']:.0f} rows/s "
+        f"publish: {report['publish_ms']:.2f}ms/minute"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -7,13 +7,28 @@ from util.redis_util import redis_pooling
 import pandas as pd
 from requests import get
 from mq.producer import Producer
+from mq.config import get_section_config
+from mq.trace import Trace, tracer
 from util import jquant_util, db_util
 import logging
 from apscheduler.schedulers.blocking import BlockingScheduler
+from util.stage import Stage
+from util.mysql_sink import MinuteBarSink
+from util.bar_cache import write_bars
+import json
 
 logging.basicConfig(level=logging.INFO, format="%(levelname)s:%(message)s")
 jquant_util.auth()
 
+# [INGEST] PUBLISH_QUEUE: 发布队列的最大长度; PERSIST_QUEUE: 持久化队列的最大长度;
+# CATCHUP_MINUTES: 定时任务延迟或服务重启后最多补齐的分钟数;
+# LATE_MINUTES: 单个合约的k线比全市场最后一根k线晚多少分钟以内仍然补齐
+ingest_config = get_section_config(
+    "INGEST", {"PUBLISH_QUEUE": 4, "PERSIST_QUEUE": 1440, "CATCHUP_MINUTES": 1440, "LATE_MINUTES": 5}
+)
+# 每个合约最后一根已经发布的k线时间(hash, 合约代码 -> %Y-%m-%d %H:%M:%S)
+LAST_BAR = "LAST_BAR"
+
 
 def get_codes_in_market():
     """
@@ -55,57 +70,290 @@ def cache_codes_in_market(conn):
     codes = get_codes_in_market()
     conn.set("codes", str(codes))
 
-def get_latest_minute_data(
-    conn, producer: Producer, expire_in_days: int = 7
-):
+class MinuteData(object):
     """
-    从聚宽获取最新分钟级数据
+    一分钟的行情在流水线各阶段之间传递的数据 \n
     Args:
-        pool: 数据库连接池
-        producer: 消息生产者
-        expire_in_days: 数据过期天数
+        mnt_date: 分钟时间, 例如 2022-05-18 14:27:00
+        data: 以合约代码为索引的行情, 发布到消息队列
+        rows: 写入 future_m 的行, 列与 columns 对应
+        columns: future_m 的字段
+        trace: 全链路延迟追踪的时间戳
+    """
+
+    def __init__(self, mnt_date, data, rows, columns, trace=None) -> None:
+        self.mnt_date = mnt_date
+        self.data = data
+        self.rows = rows
+        self.columns = columns
+        self.trace = trace
+
+    def __str__(self) -> str:
+        return f"{self.mnt_date} ({len(self.rows)} rows)"
+
+
+def load_last_bars(conn) -> dict:
+    """
+    读取每个合约最后一根已经发布的k线时间
+    Returns:
+        dict: {合约代码: datetime}
+    """
+    return {
+        code: datetime.strptime(value, "%Y-%m-%d %H:%M:%S")
+        for code, value in conn.hgetall(LAST_BAR).items()
+    }
+
+
+def fetch_minute_data(conn, last_bars: dict = None, catchup_minutes: int = None, late_minutes: int = None):
+    """
+    从聚宽获取每个合约最后一根已经发布的k线之后的所有分钟数据, 定时任务延迟执行或服务重启时补齐缺失的分钟,
+    所有合约在一次请求中获取. 获取的开始时间不早于全市场最后一根已经发布的k线之前late_minutes分钟,
+    没有夜盘、停牌的合约没有新k线, 不会让每次获取都退回到它们的最后一根k线
+    Args:
+        conn: redis连接, 从中读取主力合约代码
+        last_bars: {合约代码: 最后一根k线的时间}, None时从redis的 LAST_BAR 读取, 不会修改
+        catchup_minutes: 最多补齐的分钟数, 默认为配置文件 [INGEST] 中的 CATCHUP_MINUTES,
+            更早的数据通过 init_table.future_m 补齐
+        late_minutes: 单个合约的k线比全市场最后一根k线晚到多少分钟以内仍然补齐, 默认为 LATE_MINUTES
+    Returns:
+        list: 按时间排序的 MinuteData, 没有新数据时为空列表
     """
     codes = eval(conn.get("dominate_codes"))
+    if last_bars is None:
+        last_bars = load_last_bars(conn)
+    now = datetime.now()
+    earliest = now - timedelta(minutes=catchup_minutes or ingest_config["CATCHUP_MINUTES"])
+    # 没有记录的合约(新上市或第一次运行)只取最新一分钟
+    default = now - timedelta(minutes=1)
+    published = [last_bars[code] for code in codes if code in last_bars]
+    if late_minutes is None:
+        late_minutes = ingest_config["LATE_MINUTES"]
+    latest = max(published) - timedelta(minutes=late_minutes) if published else default
+    start = max(min(last_bars.get(code, default) for code in codes), latest, earliest)
+    # 记录获取数据的开始和结束时间, 随消息发送给消费者
+    trace = tracer.start()
     data = jq.get_price(
-        security=codes, 
-        end_date=datetime.now(),
-        count=1,
+        security=codes,
+        start_date=start + timedelta(seconds=1),
+        end_date=now,
         frequency="1m",
         fields=["open", "high", "low", "close", "volume", "money", "open_interest"],
-    )  # 获取所有合约在当前分钟的一条最新数据
-    data: pd.DataFrame = data[datetime.now() - data["time"] < timedelta(minutes=1)]
+    )  # 获取所有合约在start之后的分钟数据
+    tracer.mark(trace, "fetch_end")
     if data is None or len(data) == 0:
-        return None
-    # print('====>',data)
-    logging.info(f"number of data: {len(data)}")
-    # logging.info(data.head())
-    # print(mnt_date)
-    data['time'] = data['time'].astype(str)
-    mnt_date = data["time"].iloc[0]
-    data.rename(columns={"time": "trade_date"}, inplace=True)
-    data_copy = data.copy()
-    data.set_index("code", drop=True, inplace=True)
-    vjson = data.to_json(orient="index")
-    # conn.set(
-    #     mnt_date, vjson, ex=timedelta(days=expire_in_days)
-    # )  # 将数据同步缓存在redis中, 保存`expire_in_days`天  
-    conn.sadd(mnt_date, vjson)  
-    conn.expire(mnt_date, time=timedelta(days=expire_in_days))  
-    # 将数据同步缓存在redis中, 保存`expire_in_days`天
-    # producer.publish("1m", vjson, mnt_date)
-    producer.publish("1m", vjson)
+        return []
+    last = pd.to_datetime(data["code"].map(lambda code: last_bars.get(code, default)))
+    data: pd.DataFrame = data[data["time"] > last.clip(lower=start)]
+    if len(data) == 0:
+        return []
+    data = data.sort_values(["time", "code"])
+    minutes = []
+    for _, bars in data.groupby("time", sort=True):
+        bars = bars.copy()
+        # 00:00 的k线用 astype(str) 会丢掉时间部分
+        bars["time"] = bars["time"].dt.strftime("%Y-%m-%d %H:%M:%S")
+        mnt_date = bars["time"].iloc[0]
+        bars.rename(columns={"time": "trade_date"}, inplace=True)
+        rows = bars.values
+        rows[pd.isna(rows)] = None
+        columns = list(bars.columns)
+        bars.set_index("code", drop=True, inplace=True)
+        # 补齐的分钟各自带有同一次获取的时间戳
+        minute_trace = None if trace is None else Trace(trace.stamps)
+        minutes.append(MinuteData(mnt_date, bars, rows.tolist(), columns, minute_trace))
+    logging.info(f"number of minutes: {len(minutes)}, number of data: {len(data)}")
+    return minutes
+
+
+def publish_minute_data(conn, producer: Producer, minute: MinuteData, expire_in_days: int = 7):
+    """
+    发布到消息队列, 并将消息缓存在redis中, 保存`expire_in_days`天, 同时按合约写入k线的有序集合(util/bar_cache.py)
+    并更新每个合约最后一根k线的时间
+    Returns:
+        MinuteData, 交给持久化阶段
+    """
+    # 按配置编码为json或二进制列式格式, 同时发布按交易所和合约分片的消息
+    message = producer.publish_market("1m", minute.data, trace=minute.trace)
+    pipe = conn.pipeline(transaction=False)
+    pipe.sadd(minute.mnt_date, message)
+    pipe.expire(minute.mnt_date, time=timedelta(days=expire_in_days))
+    write_bars(pipe, minute.data, expire_in_days)
+    pipe.hset(LAST_BAR, mapping={code: minute.mnt_date for code in minute.data.index})
+    pipe.execute()
+    return minute
+
+
+def persist_minute_data(minute: MinuteData, sink: MinuteBarSink = None):
+    """
+    写入 future_m 表
+    Args:
+        minute: 分钟数据
+        sink: 写入缓冲区, 达到行数或时间后批量写入; None 立即写入
+    """
+    if sink is not None:
+        sink.write(minute.rows, minute.columns)
+        return
     db = db_util.get_connection()
-    fields = ",".join(data_copy.columns)
-    values = ",".join(["%s"] * len(data_copy.columns))
+    fields = ",".join(minute.columns)
+    values = ",".join(["%s"] * len(minute.columns))
     sql = f"""insert into future_m ({fields}) 
         values({values})"""
-    data_copy = data_copy.values
-    data_copy[pd.isna(data_copy)] = None
-    db.executemany(sql, data_copy.tolist())
-    
-    return data_copy
+    db.executemany(sql, minute.rows)
+
+
+def get_latest_minute_data(
+    conn, producer: Producer, expire_in_days: int = 7
+):
+    """
+    从聚宽获取缺失的分钟数据, 按时间依次发布、缓存到redis并写入数据库(串行执行, 定时任务使用 IngestPipeline)
+    Args:
+        conn: redis连接
+        producer: 消息生产者
+        expire_in_days: 数据过期天数
+    Returns:
+        list: 写入 future_m 的行
+    """
+    rows = []
+    for minute in fetch_minute_data(conn):
+        publish_minute_data(conn, producer, minute, expire_in_days)
+        persist_minute_data(minute)
+        rows.extend(minute.rows)
+    return rows
+
+
+def describe_minutes(minutes: list) -> str:
+    if len(minutes) == 1:
+        return str(minutes[0])
+    return f"{minutes[0].mnt_date} - {minutes[-1].mnt_date} ({len(minutes)} minutes)"
+
+
+class IngestPipeline(object):
+    """
+    分钟数据的获取 -> 发布 -> 持久化流水线, 阶段之间是有界队列:
+
+    + 获取: 定时任务线程中调用 fetch, 获取上一次获取之后的所有分钟(定时任务延迟时不丢失数据), 放入发布队列后返回,
+      发布队列满时等待(不丢弃), 放入队列后才推进获取的位置
+    + 发布: 按时间依次发布到消息队列并缓存到redis, 更新每个合约最后一根k线的时间, 然后放入持久化队列;
+      发布失败的分钟保留下来, 下一次发布时先发布, 不丢失也不乱序(消息可能重复发布一次)
+    + 持久化: 单独的线程写入 MinuteBarSink, 按行数或时间批量写入 future_m, 数据库变慢或不可用时行留在
+      MinuteBarSink 的缓冲区和本地溢出文件中, 不影响发布, 重启后继续写入; 持久化队列满时发布阶段等待, 不丢弃数据
+
+    各阶段的队列长度、处理数量和耗时每次发布后写入redis的 INGEST_STATS(hash, 阶段 -> json)
+    Args:
+        conn: redis连接
+        producer: 消息生产者
+        expire_in_days: redis中缓存消息的过期天数
+        publish_queue: 发布队列的最大长度(获取次数), 默认为配置文件 [INGEST] 中的 PUBLISH_QUEUE
+        persist_queue: 持久化队列的最大长度(获取次数), 默认为 PERSIST_QUEUE
+        sink: future_m 的写入缓冲区, 默认为 MinuteBarSink()
+    """
+
+    def __init__(
+        self,
+        conn,
+        producer: Producer,
+        expire_in_days: int = 7,
+        publish_queue: int = None,
+        persist_queue: int = None,
+        sink: MinuteBarSink = None,
+    ) -> None:
+        self.conn = conn
+        self.producer = producer
+        self.expire_in_days = expire_in_days
+        self.sink = sink or MinuteBarSink()
+        self.persist = Stage(
+            "persist",
+            self.persist_minutes,
+            maxsize=persist_queue or ingest_config["PERSIST_QUEUE"],
+            describe=describe_minutes,
+            # 持久化的数据不能丢弃, 队列满时发布阶段等待
+            block=True,
+        )
+        self.publish = Stage(
+            "publish",
+            self.publish_and_report,
+            maxsize=publish_queue or ingest_config["PUBLISH_QUEUE"],
+            next_stage=self.persist,
+            describe=describe_minutes,
+            # 丢弃一次获取的数据会丢失这些分钟, 队列满时获取等待
+            block=True,
+        )
+        # 每个合约最后一根已经放入发布队列的k线时间, 第一次获取时从redis读取
+        self.last_bars = None
+        # 发布失败、等待重新发布的分钟
+        self.retry = []
+
+    def start(self):
+        self.sink.start()
+        self.persist.start()
+        self.publish.start()
+        return self
+
+    def stop(self, timeout: float = None):
+        """处理完队列中的数据后结束, 缓冲区中的行写入数据库"""
+        self.publish.stop(timeout)
+        if self.retry:
+            # redis的 LAST_BAR 没有更新, 重启后重新获取
+            logging.warning(f"{describe_minutes(self.retry)} not published")
+        self.persist.stop(timeout)
+        self.sink.close(timeout)
+
+    def fetch(self):
+        """定时任务: 获取上一次获取之后的所有分钟数据, 作为一项放入发布队列"""
+        if self.last_bars is None:
+            self.last_bars = load_last_bars(self.conn)
+        minutes = fetch_minute_data(self.conn, self.last_bars)
+        if not minutes:
+            return
+        self.publish.put(minutes)
+        for minute in minutes:
+            for code in minute.data.index:
+                self.last_bars[code] = datetime.strptime(minute.mnt_date, "%Y-%m-%d %H:%M:%S")
+
+    def publish_and_report(self, minutes: list):
+        """
+        先发布上一次失败的分钟, 再按时间依次发布本次的分钟, 失败时剩下的分钟留到下一次发布
+        Returns:
+            list: 发布成功的分钟, 交给持久化阶段; 没有时为None
+        """
+        minutes = self.retry + minutes
+        self.retry = []
+        published = []
+        for i, minute in enumerate(minutes):
+            try:
+                publish_minute_data(self.conn, self.producer, minute, self.expire_in_days)
+            except Exception:
+                self.retry = minutes[i:]
+                logging.exception(f"publish {minute} failed, retry {len(self.retry)} minutes later")
+                break
+            published.append(minute)
+        stats = self.stats()
+        try:
+            self.conn.hset(
+                "INGEST_STATS", mapping={name: json.dumps(value) for name, value in stats.items()}
+            )
+        except Exception as e:
+            logging.warning(f"write INGEST_STATS failed: {e}")
+        if stats["persist"]["depth"] > 1:
+            logging.warning(f"persist queue depth: {stats['persist']['depth']}")
+        return published or None
+
+    def persist_minutes(self, minutes: list):
+        for minute in minutes:
+            persist_minute_data(minute, self.sink)
+
+    def stats(self) -> dict:
+        """
+        Returns:
+            dict: {阶段: {depth, max_depth, processed, dropped, errors, last_ms}}, publish 另有 retry(等待重新发布的分钟数),
+                sink: {buffered, flushed, flushes, errors, last_ms}
+        """
+        publish = self.publish.stats()
+        publish["retry"] = len(self.retry)
+        return {"publish": publish, "persist": self.persist.stats(), "sink": self.sink.stats()}
 
 
+# 历史行情回放见 replay.py, 支持mysql、redis缓存和本地文件数据源以及回放倍速
 # def simulate(
 #     pool: redis.ConnectionPool,
 #     start_date: datetime,
@@ -151,14 +399,17 @@ def init_scheduler(conn):
     #     host="122.207.108.56", port=12479, decode_responses=True
     # )
     producer = Producer()
+    pipeline = IngestPipeline(conn, producer).start()
     scheduler = BlockingScheduler()
     cache_codes_in_market(conn)  # 测试时直接执行, 不设置为定时任务
     # scheduler.add_job(func=cache_codes_in_market, args=[pool], trigger="cron", hour=8)
     scheduler.add_job(
         func=cache_codes_in_market, args=[conn], trigger="cron", hour=8, minute=50
     )
+    # 定时任务只获取数据, 发布和写入数据库在流水线的工作线程中进行, 上一分钟的任务未结束时不重复执行,
+    # 延迟或跳过的分钟在下一次获取时补齐
     scheduler.add_job(
-        func=get_latest_minute_data, args=[conn, producer], trigger="cron", second=1
+        func=pipeline.fetch, trigger="cron", second=1, max_instances=1, coalesce=True
     )
     scheduler.start()
 
@@ -1,22 +1,22 @@
+import atexit
 import logging
-from pickletools import floatnl
-from time import process_time_ns
+import time
 import numpy as np
-import pytz
-
-import redis
-from sqlalchemy import null
+import pandas as pd
+from collections.abc import Mapping
 from mq.consumer import Consumer
+from mq.trace import fork, tracer
+from model.stop_loss_engine import StopLossEngine
+from model.stop_loss_checkpoint import StopLossCheckpoint
+from util.bar_cache import recent_bars
+from collections import deque
 from datetime import datetime, timedelta
 from util.order import clientAPI
-import tzlocal
 
 logging.basicConfig(
     format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.WARNING
 )
 
-_local_zone = pytz.timezone('Asia/Shanghai')
-
 
 class StopLossStrategy(Consumer):
     """
@@ -28,6 +28,14 @@ class StopLossStrategy(Consumer):
         restrict: 是否限制止损值策略的某些规则往前搜索的天数
         volatile: 是否开启止损值震荡条件
         backtrack: 是否开启止损值回调条件
+        checkpoint_store: 保存止损值检查点的 FileCheckpointStore/RedisCheckpointStore, None不保存;
+            重启时从检查点继续, 已经计算过的k线直接跳过
+        frequency: 订阅的数据周期, 用于区分检查点
+        max_age: 第一根新k线与检查点的间隔超过max_age时丢弃检查点重新开始, None不限制
+        warm_start_bars: 订阅前从redis(不足时从future_m)一次读取的历史k线数量, 批量计算出当前的止损值和主力资金
+            状态后再开始接收实时行情, 0 不加载
+        checkpoint_every: 每处理多少根k线保存一次检查点, 取消订阅和进程退出时也会保存;
+            进程异常退出时最多重新计算这么多根k线(预热时从检查点之后的历史k线补齐)
     """
 
     def __init__(
@@ -38,18 +46,62 @@ class StopLossStrategy(Consumer):
         restrict: bool = False,
         volatile: bool = False,
         backtrack: bool = False,
+        checkpoint_store=None,
+        frequency: str = "1m",
+        max_age: timedelta = None,
+        warm_start_bars: int = 1440,
+        checkpoint_every: int = 10,
     ) -> None:
-        super().__init__(client_id)
+        # Consumer 的第一个参数是channel, client_id 单独设置, 否则所有策略共用默认的 futures 消息队列
+        super().__init__()
+        self.set_client_id(client_id)
         self.code = code
-        self.stop_loss = []
-        self.close_ = []
-        self.open_ = []
-        self.high = []
-        self.low = []
-        self.volume = []
-        self.buy_volume = []
-        self.sell_volume = []
+        # 主力资金只用到最近两根k线, 止损值的状态由engine维护, 内存占用不随运行时间增长
+        self.stop_loss = deque(maxlen=2)
+        self.close_ = deque(maxlen=2)
+        self.open_ = deque(maxlen=2)
+        self.high = deque(maxlen=2)
+        self.low = deque(maxlen=2)
+        self.volume = deque(maxlen=2)
+        self.buy_volume = deque(maxlen=2)
+        self.sell_volume = deque(maxlen=2)
         self.period = period
+        # 前period根k线不计算止损值
+        self.engine = StopLossEngine(
+            period=period,
+            restrict=restrict,
+            volatile=volatile,
+            backtrack=backtrack,
+            warmup=period,
+        )
+        self.checkpoint = None
+        self.resume_from = None
+        if checkpoint_store is not None:
+            self.checkpoint = StopLossCheckpoint(
+                checkpoint_store,
+                code,
+                frequency=frequency,
+                period=period,
+                restrict=restrict,
+                volatile=volatile,
+                backtrack=backtrack,
+                warmup=period,
+                max_age=max_age,
+            )
+            self.resume_from = self.checkpoint.load()
+            if self.resume_from is not None:
+                self.engine = self.resume_from["engine"]
+            atexit.register(self.save_checkpoint)
+        self.checkpoint_every = checkpoint_every
+        # 还没有保存到检查点的k线数量和最后一根k线(trade_date, close)
+        self.unsaved = 0
+        self.last_bar = None
+        # 本次运行收到的k线数量
+        self.bars = 0
+        self.warm_start_bars = warm_start_bars
+        self.warmed = False
+        # 预热加载的最后一根k线的时间, 实时行情中不晚于它的k线已经计算过
+        self.warm_until = None
         self.restrict = restrict
         self.volatile = volatile
         self.backtrack = backtrack
@@ -57,287 +109,52 @@ class StopLossStrategy(Consumer):
         self.sell: bool = False
         self.clientAPI = clientAPI('mt9025296', '15802644191')
 
-    def begin(self):
-        """
-        TODO: 获取指标初始值, 与创新低类似
-        """
-        return self.stop_loss[-1] is None
-
-    def begin_new_lowest(self, cur):
-        if cur < self.period - 1:
-            return False
-        cur_low = self.low[cur]
-        start = max(cur - self.period + 1, 0)
-        lowest = self.low[start : cur + 1].min()
-        cur_low = self.low[cur]
-        if cur_low == lowest:
-            return True
-        return False
-
-    def value_of_begin(self, cur):
-        rank = 0
-        cur_high = self.high[cur]
-        pivot = cur_high
-        for i in range(cur - 1, -1, -1):
-            if pivot < self.high[i]:
-                rank += 1
-                pivot = self.high[i]
-                if rank == 2:
-                    return self.high[i]
-        return pivot
-
-    def below_stop_loss(self, cur: int) -> bool:
+    def process_message(self, message, sig: int = 1):
         """
-        判断今日和昨日k线是否在止损线之下
-        1. 当日收盘价低于昨日止损线
-        2. 昨日收盘价低于昨日止损线
-        3. 昨日开盘价和收盘价等于止损值时, 往前搜索
-        """
-        cur_open = self.open_[cur]
-        cur_close = self.close_[cur]
-        last_stop = self.stop_loss[cur - 1]
-        if cur_close > last_stop:
-            return False
-        if cur_close < last_stop:
-            return True
-        if cur_close == last_stop:
-            if cur_open < cur_close:
-                return True
-            elif cur_open > cur_close:
-                return False
-        for i in range(cur - 1, -1, -1):
-            cur_close = self.close_[i]
-            cur_stop = self.stop_loss[i]
-            if cur_stop is None:
-                return False
-            if cur_close == cur_open == cur_stop:
-                continue
-            if cur_close < cur_stop:
-                return True
-            return cur_close == cur_stop and cur_open < cur_close
-        return False
-
-    def above_stop_loss(self, cur: int) -> bool:
-        """
-        判断今日和昨日k线是否在止损线之上
-        1. 当日收盘价高于昨日止损线
-        2. 昨日收盘价高于昨日止损线
-        3. 昨日开盘价和收盘价等于止损值时, 往前搜索
-        """
-        cur_open = self.open_[cur]
-        cur_close = self.close_[cur]
-        last_stop = self.stop_loss[cur - 1]
-        if cur_close < last_stop:
-            return False
-        if cur_close > last_stop:
-            return True
-        if cur_close == last_stop:
-            if cur_open > cur_close:
-                return True
-            elif cur_open < cur_close:
-                return False
-        for i in range(cur - 1, -1, -1):
-            cur_close = self.close_[i]
-            cur_stop = self.stop_loss[i]
-            if cur_stop is None:
-                return False
-            if cur_close == cur_open == cur_stop:
-                continue
-            if cur_close > cur_stop:
-                return True
-            return cur_close == cur_stop and cur_open > cur_close
-        return False
-
-    def new_lowest(self, cur):
-        """判断是否出现创新低的情况,返回bool类型"""
-        start = max(cur - self.period + 1, 0)
-        lowest = np.min(self.low[start : cur + 1])
-        cur_low = self.low[cur]
-        return cur_low == lowest
-
-    def value_of_new_lowest(self, cur):
-        """当出现创新低的情况时, 返回止损点的值"""
-        rank = 0
-        last_stop = self.stop_loss[cur - 1]
-        cur_high = self.high[cur]
-        pivot = cur_high
-        end = max(cur - 2 * (self.period) + 1, -1) if self.restrict else -1
-        for i in range(cur - 1, end, -1):
-            # 止损值取比当前最高价高的第二连续最高价
-            if pivot < self.high[i]:
-                rank += 1
-                pivot = self.high[i]
-                if rank == 2:
-                    return self.high[i]
-        return last_stop
-
-    def new_highest(self, cur):
-        """判断是否出现创新高的情况, 返回bool类型"""
-        start = max(cur - self.period + 1, 0)
-        highest = np.max(self.high[start : cur + 1])
-        cur_high = self.high[cur]
-        return cur_high == highest
-
-    def value_of_new_highest(self, cur):
-        """当出现创新高的情况时, 返回止损点的值"""
-        rank = 0
-        cur_low = self.low[cur]
-        last_stop = self.stop_loss[cur - 1]
-        pivot = cur_low
-        end = max(cur - 2 * (self.period) + 1, -1) if self.restrict else -1
-        for i in range(cur - 1, end, -1):
-            # 止损值取比当前最低价低的第二连续最低价
-            if pivot > self.low[i]:
-                rank += 1
-                pivot = self.low[i]
-                if rank == 2:
-                    return self.low[i]
-        return last_stop
-
-    def rise_above_stop_loss(self, cur):
-        """
-        判断是否涨破止损线, 返回bool类型
+        Consumer 收到的一条行情消息, 解码后交给 on_market
+        Args:
+            message: 消息内容(json或二进制), 或者已经解码的行情 {合约代码: k线}
+            sig: 0 只计算止损值和主力资金, 不下单
         """
-        assert cur > 0
-        cur_close = self.close_[cur]
-        last_stop = self.stop_loss[cur - 1]
-        if last_stop is None:
-            return False
-        last_close = self.close_[cur - 1]
-        last_open = self.open_[cur - 1]
-        if cur_close > last_stop:
-            if (
-                last_close >= last_stop
-                and last_close == last_stop
-                and last_open < last_close
-                or last_close < last_stop
-            ):
-                return True
-            elif last_close == last_stop and last_open == last_close:
-                for i in range(cur - 2, -1, -1):
-                    pre_stop = self.stop_loss[i]
-                    if pre_stop is None:
-                        return False
-                    pre_close = self.close_[i]
-                    pre_open = self.open_[i]
-                    if (
-                        pre_close >= pre_stop
-                        and pre_close == pre_stop
-                        and pre_open < pre_close
-                        or pre_close < pre_stop
-                    ):
-                        return True
-                    elif pre_close == pre_stop and pre_open == pre_close:
-                        continue
-                    else:
-                        return False
-        return False
+        if not isinstance(message, Mapping):
+            # 解码并记录接收和解码的时间
+            super().process_message(message)
+            message = self.latest_data
+        self.on_market(message, sig)
 
-    def fall_below_stop_loss(self, cur):
+    def on_market(self, market, sig: int = 1):
         """
-        判断是否跌破止损线,返回bool类型
-        """
-        assert cur > 0
-        cur_close = self.close_[cur]
-        last_stop = self.stop_loss[cur - 1]
-        if last_stop is None:
-            return False
-        last_open = self.open_[cur - 1]
-        last_close = self.close_[cur - 1]
-        if cur_close < last_stop:
-            if (
-                last_close <= last_stop
-                and last_close == last_stop
-                and last_open > last_close
-                or last_close > last_stop
-            ):
-                return True
-            elif last_close == last_stop and last_open == last_close:
-                for i in range(cur - 2, -1, -1):
-                    pre_stop = self.stop_loss[i]
-                    if pre_stop is None:
-                        return False
-                    pre_close = self.close_[i]
-                    pre_open = self.open_[i]
-                    if (
-                        pre_close <= pre_stop
-                        and pre_close == pre_stop
-                        and pre_open == pre_close
-                    ):
-                        continue
-                    elif (
-                        pre_close <= pre_stop
-                        and pre_close == pre_stop
-                        and pre_open > pre_close
-                        or pre_close > pre_stop
-                    ):
-                        return True
-                    else:
-                        return False
-        return False
-
-    def index_of_last_rise_above(self, cur):
-        return next(
-            (i for i in range(cur - 1, 1, -1) if not self.above_stop_loss(i)), -1
-        )
-
-    def index_of_last_fall_below(self, cur):
-        return next(
-            (i for i in range(cur - 1, 1, -1) if not self.below_stop_loss(i)), -1
-        )
-
-    def value_of_fall_below(self, cur):
-        rank = 0
-        cur_high = self.high[cur]
-        pivot = cur_high
-        end = max(cur - 2 * (self.period) + 1, -1) if self.restrict else -1
-        for i in range(cur - 1, end, -1):
-            if pivot < self.high[i]:
-                rank += 1
-                pivot = self.high[i]
-                if rank == 2:
-                    return self.high[i]
-        return pivot
-
-    def value_of_rise_above(self, cur):
-        """
-        返回涨破条件下的止损值
+        Args:
+            market: 解码后的行情 {合约代码: k线}, k线的时间为 trade_date
+            sig: 0 只计算止损值和主力资金, 不下单
         """
-        rank = 0
-        cur_low = self.low[cur]
-        pivot = cur_low
-        end = max(cur - 2 * (self.period) + 1, -1) if self.restrict else -1
-        for i in range(cur - 1, end, -1):
-            if pivot > self.low[i]:
-                rank += 1
-                pivot = self.low[i]
-                if rank == 2:
-                    return self.low[i]
-        return pivot
-
-    def process_message(self, channel, message, sig=1):
-        print(
-            f"callback function client: {self.client_id} recieve message from channel: {channel}"
-        )
         # min_stop_period = 5
         min_stop_period = 0
-        if self.code in message:
-            pass
-        else:
+        data = market.get(self.code)
+        if data is None:
             return
-        data = message.get(self.code)
+        print(
+            f"callback function client: {self.client_id} recieve message from channel: {self.channel}"
+        )
+        date_time = str(data["trade_date"])
+        if self.warm_until is not None:
+            if pd.Timestamp(date_time) <= self.warm_until:
+                return
+            self.warm_until = None
         value = self.cal_stop_loss(data=data)
-        date_time = data['time']
-        if len(self.open_) <= 2:
+        if self.bars <= 2:
             return
         if date_time[-8:] == "21:00:00":
-            self.buy_volume = []
-            self.sell_volume = []
+            self.buy_volume.clear()
+            self.sell_volume.clear()
             return
             
         main_funds_sig =  self.cal_main_funds(data=data)
+        # 行情消息带有trace时记录信号计算完成和下单的时间
+        trace = fork(market)
+        tracer.mark(trace, "decision")
         
-        if main_funds_sig == null:
+        if main_funds_sig is None:
             return
         
         print(
@@ -352,14 +169,104 @@ class StopLossStrategy(Consumer):
                 self.buy = True
                 self.buy_price = data["close"]
                 self.clientAPI.handleOrder(code=self.code, buyOrSell=0, lot=10, price=self.buy_price)
+                tracer.mark(trace, "order")
                 return
-            if self.buy and self.buy_price > data["close"] and (date_time - self.buy_time - min_stop_period*60):
+            if (
+                self.buy
+                and self.buy_price > data["close"]
+                and pd.Timestamp(date_time) - pd.Timestamp(self.buy_time) >= timedelta(minutes=min_stop_period)
+            ):
                 print(
                     f"sell at time: {date_time}"
                 )
                 self.buy = False
                 self.sell_price = data["close"]
                 self.clientAPI.handleOrder(code=self.code, buyOrSell=1, EntryOrExit = 1, lot=10, price=self.sell_price)
+                tracer.mark(trace, "order")
+
+    def subscribe(self, channel, codes: list = None, block: bool = True):
+        """第一次订阅前预热历史k线, 预热失败时从空状态开始"""
+        if not self.warmed:
+            self.warmed = True
+            try:
+                self.warm_start()
+            except Exception:
+                logging.exception(f"{self.code} warm start failed, start from empty state")
+        return super().subscribe(channel, codes=codes, block=block)
+
+    def warm_start(self, count: int = None, conn=None, bars: pd.DataFrame = None) -> int:
+        """
+        一次读取最近count根k线, 用 StopLossEngine.run 批量计算到最后一根k线的止损值状态, 并恢复主力资金的状态,
+        重启后不需要等待period根实时k线. 有检查点且检查点的k线在读取的k线中时, 只计算检查点之后的k线
+        Args:
+            count: k线数量, 默认为 warm_start_bars
+            conn: redis连接, 默认为 redis_pooling().get_conn(2)
+            bars: 直接使用的历史k线(trade_date, open, high, low, close, volume), None时通过 recent_bars 读取
+        Returns:
+            int: 加载的k线数量
+        """
+        count = count or self.warm_start_bars
+        if bars is None:
+            if not count:
+                return 0
+            bars = recent_bars(self.code, count, conn)
+        n = len(bars)
+        if n == 0:
+            return 0
+        begin = time.perf_counter()
+        dates = pd.DatetimeIndex(pd.to_datetime(bars["trade_date"]))
+        o = bars["open"].to_numpy(dtype=float)
+        c = bars["close"].to_numpy(dtype=float)
+        h = bars["high"].to_numpy(dtype=float)
+        l = bars["low"].to_numpy(dtype=float)
+        v = bars["volume"].to_numpy(dtype=float)
+
+        # 止损值: 从检查点继续, 检查点不可用时从第一根k线开始
+        engine, start = None, 0
+        if self.checkpoint is not None:
+            engine, start = self.checkpoint.locate(dates, c)
+        if engine is None:
+            engine = StopLossEngine(
+                period=self.period,
+                restrict=self.restrict,
+                volatile=self.volatile,
+                backtrack=self.backtrack,
+                warmup=self.period,
+            )
+        engine.run(o[start:], c[start:], h[start:], l[start:])
+        self.engine = engine
+        self.resume_from = None
+        self.stop_loss.clear()
+        for value in [engine.last_stop_loss, engine.stop_loss]:
+            self.stop_loss.append(None if value != value else value)
+        if self.checkpoint is not None and start < n:
+            self.checkpoint.save(engine, dates[-1], c[-1])
+            self.unsaved = 0
+
+        # 主力资金: 每天21:00清空, 只需要重放最后一次清空之后的k线
+        resets = np.flatnonzero((dates.hour == 21) & (dates.minute == 0) & (dates.second == 0))
+        first = int(resets[-1]) + 1 if len(resets) else 0
+        self.buy_volume.clear()
+        self.sell_volume.clear()
+        for deque_ in [self.open_, self.close_, self.high, self.low, self.volume]:
+            deque_.clear()
+        for i in range(max(first - 1, 0), n):
+            self.open_.append(o[i])
+            self.close_.append(c[i])
+            self.high.append(h[i])
+            self.low.append(l[i])
+            self.volume.append(v[i])
+            # 与 on_market 相同, 前两根k线不计算
+            if i >= max(first, 2):
+                self.cal_main_funds()
+
+        self.bars += n
+        self.warm_until = dates[-1]
+        logging.info(
+            f"{self.code} warm start: {n} bars until {dates[-1]}, "
+            f"{n - start} computed, {(time.perf_counter() - begin) * 1000:.1f}ms"
+        )
+        return n
 
     def cal_stop_loss(
         self,
@@ -377,8 +284,16 @@ class StopLossStrategy(Consumer):
             cur_high
             cur_low
         Retures:
-            stop_loss (list): 止损值
+            stop_loss (float): 当前k线的止损值, 没有止损值时为None
         """
+        if data is not None and self.resume_from is not None:
+            if self.checkpoint.is_processed(self.resume_from, data["trade_date"]):
+                # 检查点中已经包含这根k线
+                return None
+            if self.checkpoint.is_stale(self.resume_from, data["trade_date"]):
+                self.engine = self.checkpoint.new_engine()
+            self.resume_from = None
+        self.bars += 1
         if data is not None:
             self.close_.append(data["close"])
             self.open_.append(data["open"])
@@ -391,54 +306,36 @@ class StopLossStrategy(Consumer):
             self.high.append(cur_high)
             self.low.append(cur_low)
             self.volume.append(cur_vol)
-        if len(self.stop_loss) < self.period:
-            self.stop_loss.append(None)
-            return None
-        i = len(self.stop_loss)
-        if self.stop_loss[-1] is None:
-            value = self.value_of_begin(i) if self.new_lowest(i) else None
-        elif self.fall_below_stop_loss(i) and not self.new_highest(i):
-            # 跌破且没有创新高
-            if self.volatile and i > 1 and self.rise_above_stop_loss(i - 1):
-                # 震荡: 昨日涨破, 今日跌破, 出现震荡, 止损值取昨日的前一天
-                value = self.stop_loss[i - 1 - 1]
-            elif self.backtrack and self.new_highest(i - 1):
-                # 回调: 昨日创新高, 取上一次涨破日的前一天的止损值
-                index = self.index_of_last_rise_above(i)
-                if index != -1:
-                    value = self.stop_loss[index - 1]
-            else:
-                value = self.value_of_fall_below(i)
-        elif self.rise_above_stop_loss(i) and not self.new_lowest(i):
-            # 涨破且没有创新低
-            if self.volatile and i > 1 and self.fall_below_stop_loss(i - 1):
-                # 震荡: 昨日跌破, 今日涨破, 出现震荡, 止损值取昨日的前一天
-                value = self.stop_loss[i - 1 - 1]
-            elif self.backtrack and self.new_lowest(i - 1):
-                # 回调: 昨日创新低, 取上一次跌破日的前一天的止损值
-                index = self.index_of_last_fall_below(i)
-                if index != -1:
-                    value = self.stop_loss[index - 1]
-            else:
-                value = self.value_of_rise_above(i)
-        elif self.fall_below_stop_loss(i) and self.new_highest(i):
-            # 跌破且创新高
-            value = self.value_of_new_highest(i)
-        elif self.rise_above_stop_loss(i) and self.new_lowest(i):
-            # 涨破且创新低
-            value = self.value_of_new_lowest(i)
-        elif self.above_stop_loss(i) and self.new_highest(i):
-            # 止损线之上且创新高
-            value = self.value_of_new_highest(i)
-        elif self.below_stop_loss(i) and self.new_lowest(i):
-            # 止损线之下且创新低
-            value = self.value_of_new_lowest(i)
-        else:
-            # 不符合上述条件取前一天的止损值
-            value = self.stop_loss[-1]
+        value = self.engine.update(
+            self.open_[-1], self.close_[-1], self.high[-1], self.low[-1]
+        )
+        if value != value:
+            # engine中缺失的止损值为NaN, 统一用None表示
+            value = None
         self.stop_loss.append(value)
+        if data is not None and self.checkpoint is not None:
+            self.last_bar = (data["trade_date"], data["close"])
+            self.unsaved += 1
+            if self.unsaved >= self.checkpoint_every:
+                self.save_checkpoint()
         return value
 
+    def save_checkpoint(self):
+        """把还没有保存的k线之后的引擎状态保存为检查点"""
+        if self.checkpoint is None or not self.unsaved:
+            return
+        trade_date, close = self.last_bar
+        self.checkpoint.save(self.engine, trade_date, close)
+        self.unsaved = 0
+
+    def close(self, channel=None, timeout: float = None):
+        """取消订阅前保存检查点"""
+        try:
+            self.save_checkpoint()
+        except Exception:
+            logging.exception(f"{self.code} save checkpoint failed")
+        super().close(channel, timeout)
+
     def cal_main_funds(
             self,
             data: dict = None,
@@ -504,10 +401,10 @@ class StopLossStrategy(Consumer):
                 elif self.buy_volume[-1] >= self.sell_volume[-1]:
                     return 1
 
-        return null
+        return None
     
 if __name__ == "__main__":
     stoploss_strategy = StopLossStrategy(
         client_id="stoploss-client", code="A2203.XDCE"
     )
-    stoploss_strategy.subscribe("1m", stoploss_strategy.process_message)
+    stoploss_strategy.subscribe("1m")
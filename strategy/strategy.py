@@ -1,4 +1,6 @@
 from mq.consumer import get_latest_data
+from util.bar_cache import last_bars
+from util.redis_util import redis_pooling
 
 class Strategy(object):
     def __init__(self, strategy_id, strategy_name):
@@ -7,5 +9,31 @@ class Strategy(object):
         self.latest_data = None
         self.code : str = None
         
-    def refresh_data(self):
-        self.latest_data = get_latest_data(self.code)
\ No newline at end of file
+    def refresh_data(self, data: dict = None):
+        """
+        :param data: 消费者收到的行情, 为None时从默认消费者获取最新数据
+        """
+        if data is None:
+            self.latest_data = get_latest_data(self.code)
+        elif self.code:
+            self.latest_data = data.get(self.code)
+        else:
+            self.latest_data = data
+
+    def on_market(self, data: dict):
+        """
+        AsyncConsumer 收到的行情, 与 refresh_data 相同
+        :param data: 解码后的行情 {合约代码: k线}
+        """
+        self.refresh_data(data)
+
+    def history(self, count: int, conn=None):
+        """
+        从redis读取self.code最近count根分钟k线, 一次往返
+        :param count: k线数量
+        :param conn: redis连接, 默认为 redis_pooling().get_conn(2)
+        :return: DataFrame, trade_date 和 open, high, low, close, volume, money, open_interest, 按时间排序
+        """
+        if conn is None:
+            conn = redis_pooling().get_conn(2)
+        return last_bars(conn, self.code, count)
@@ -0,0 +1,183 @@
+"""
+按合约缓存在redis中的分钟k线
+
+服务端每分钟发布行情时, 除了以分钟时间为key的全市场消息集合外, 每个合约的k线写入一个有序集合:
+
++ key: BARS:{合约代码}, 例如 BARS:IH2206.CCFX
++ score: k线时间的整数形式 YYYYmmddHHMM, 例如 202205181427, 与时区无关且按时间递增
++ member: "trade_date,open,high,low,close,volume,money,open_interest", 空值为空字符串
+
+同一分钟重复写入时先删除该分钟的旧值. 每次写入删除 keep_days 天之前的k线, 并设置key的过期时间,
+退市合约的key自动删除
+
+读取一个合约最近N根k线(ZREVRANGE)或一段时间的k线(ZRANGEBYSCORE)只需要一次往返, 不需要解码全市场消息:
+
+last_bars(conn, "IH2206.CCFX", 240)
+range_bars(conn, "IH2206.CCFX", "2022-05-18 09:00:00", "2022-05-18 15:00:00")
+
+recent_bars 在redis中的k线不足时从 future_m 表补齐, 用于策略启动时加载历史
+"""
+import logging
+from datetime import datetime, timedelta
+import numpy as np
+import pandas as pd
+from util.redis_util import redis_pooling
+
+logger = logging.getLogger(__name__)
+
+KEY_PREFIX = "BARS:"
+FIELDS = ["open", "high", "low", "close", "volume", "money", "open_interest"]
+
+
+def bar_key(code: str) -> str:
+    return f"{KEY_PREFIX}{code}"
+
+
+def bar_score(trade_date) -> int:
+    """k线时间(str或datetime)转为score, 精确到分钟"""
+    if isinstance(trade_date, str):
+        trade_date = pd.Timestamp(trade_date)
+    return int(trade_date.strftime("%Y%m%d%H%M"))
+
+
+def _format(value) -> str:
+    if value is None or value != value:
+        return ""
+    return str(float(value))
+
+
+def write_bars(pipe, data: pd.DataFrame, keep_days: int = 7):
+    """
+    把一分钟的行情按合约写入有序集合
+    Args:
+        pipe: redis pipeline, 由调用者执行, 可以与其他命令在同一次往返中发送
+        data: 以合约代码为索引的行情, 包含 trade_date 和 FIELDS 中的列(缺少的列为空值)
+        keep_days: 保留的天数, 同时为key的过期时间
+    """
+    values = data.reindex(columns=FIELDS).to_numpy(dtype=float)
+    for code, trade_date, row in zip(data.index, data["trade_date"], values):
+        # 统一为 %Y-%m-%d %H:%M:%S, 00:00 的k线转为字符串时可能没有时间部分
+        trade_date = pd.Timestamp(trade_date)
+        score = bar_score(trade_date)
+        cutoff = bar_score(trade_date - timedelta(days=keep_days))
+        trade_date = trade_date.strftime("%Y-%m-%d %H:%M:%S")
+        member = ",".join([trade_date] + [_format(value) for value in row])
+        key = bar_key(code)
+        pipe.zremrangebyscore(key, score, score)
+        pipe.zadd(key, {member: score})
+        pipe.zremrangebyscore(key, "-inf", f"({cutoff}")
+        pipe.expire(key, timedelta(days=keep_days))
+
+
+def parse_bars(members: list) -> pd.DataFrame:
+    """
+    Args:
+        members: 有序集合中的k线, 按时间排序
+    Returns:
+        DataFrame: trade_date(datetime64) 和 FIELDS 中的列(float)
+    """
+    if not members:
+        return pd.DataFrame(columns=["trade_date"] + FIELDS)
+    trade_dates = []
+    values = np.empty((len(members), len(FIELDS)))
+    for i, member in enumerate(members):
+        if isinstance(member, bytes):
+            member = member.decode("utf-8")
+        parts = member.split(",")
+        trade_dates.append(parts[0])
+        values[i] = [float(part) if part else np.nan for part in parts[1:]]
+    data = pd.DataFrame(values, columns=FIELDS)
+    data.insert(0, "trade_date", pd.to_datetime(trade_dates))
+    return data
+
+
+def last_bars(conn, code: str, count: int) -> pd.DataFrame:
+    """
+    一个合约最近count根k线, 按时间排序
+    Args:
+        conn: redis连接, 解码或不解码返回值均可
+        code: 合约代码
+        count: k线数量
+    """
+    members = conn.zrevrange(bar_key(code), 0, count - 1)
+    return parse_bars(members[::-1])
+
+
+def range_bars(conn, code: str, start=None, end=None) -> pd.DataFrame:
+    """
+    一个合约在[start, end]之间的k线, 按时间排序
+    Args:
+        conn: redis连接
+        code: 合约代码
+        start: 开始时间(str或datetime), None为最早
+        end: 结束时间, None为最新; 只有日期时包括当天所有k线
+    """
+    if isinstance(end, str) and len(end) == 10:
+        end = datetime.strptime(end, "%Y-%m-%d") + timedelta(days=1) - timedelta(minutes=1)
+    low = "-inf" if start is None else bar_score(start)
+    high = "+inf" if end is None else bar_score(end)
+    return parse_bars(conn.zrangebyscore(bar_key(code), low, high))
+
+
+def last_bars_of(conn, codes: list, count: int) -> dict:
+    """
+    多个合约最近count根k线, 一次pipeline往返
+    Returns:
+        dict: {合约代码: DataFrame}
+    """
+    pipe = conn.pipeline(transaction=False)
+    for code in codes:
+        pipe.zrevrange(bar_key(code), 0, count - 1)
+    return {code: parse_bars(members[::-1]) for code, members in zip(codes, pipe.execute())}
+
+
+def mysql_last_bars(code: str, count: int, connect=None) -> pd.DataFrame:
+    """
+    从 future_m 表读取一个合约最近count根k线, 按时间排序, 列与 parse_bars 相同
+    Args:
+        code: 合约代码
+        count: k线数量
+        connect: 创建数据库连接的函数, 默认为 util.mysql_sink.mysql_connect(单独的连接, 读取后关闭,
+            不影响 db_util 共用的连接)
+    """
+    if connect is None:
+        # 导入时会读取数据库配置, 只在需要时导入
+        from util.mysql_sink import mysql_connect as connect
+
+    fields = ",".join(["trade_date"] + FIELDS)
+    sql = f"select {fields} from future_m where code = %s order by trade_date desc limit %s"
+    conn = connect()
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute(sql, (code, int(count)))
+            rows = cursor.fetchall()
+    finally:
+        conn.close()
+    data = pd.DataFrame([list(row) for row in rows[::-1]], columns=["trade_date"] + FIELDS)
+    data["trade_date"] = pd.to_datetime(data["trade_date"])
+    data[FIELDS] = data[FIELDS].astype(float)
+    return data
+
+
+def recent_bars(code: str, count: int, conn=None) -> pd.DataFrame:
+    """
+    一个合约最近count根k线: 先读redis, 不足count根时再读 future_m 表, 两者合并(同一分钟以redis为准),
+    数据库不可用时只返回redis中的k线
+    Args:
+        code: 合约代码
+        count: k线数量
+        conn: redis连接, 默认为 redis_pooling().get_conn(2)
+    """
+    if conn is None:
+        conn = redis_pooling().get_conn(2)
+    data = last_bars(conn, code, count)
+    if len(data) >= count:
+        return data
+    try:
+        history = mysql_last_bars(code, count)
+    except Exception as e:
+        logger.warning(f"read {code} from future_m failed: {e}")
+        return data
+    data = pd.concat([history, data], ignore_index=True)
+    data = data.drop_duplicates("trade_date", keep="last").sort_values("trade_date")
+    return data.tail(count).reset_index(drop=True)
@@ -6,7 +6,8 @@ from jqdatasdk import auth
 from jqdatasdk.utils import query
 from tqdm import tqdm
 from util.db_util import get_connection
-from model.stop_loss import StopLossIndicator
+from util.mysql_sink import MinuteBarSink
+from model.stop_loss import predict_stop_loss_by_code
 import numpy as np
 
 
@@ -107,6 +108,7 @@ def get_daily_info(
     end_date,
     skip_paused=True,
     extra_fields=None,
+    workers=1,
 ) -> pd.DataFrame:
     """
     jquant的pre_close在获取期货数据时, 是前一个周期的结算价(pre_settle)
@@ -115,6 +117,7 @@ def get_daily_info(
         skip_paused: True 跳过停盘日期 False 若当前周期停盘, 则用前一个周期的值替代
         cal_pre_close: True 按合约code分组计算pre_close False 不计算pre_close
         extra_fields: options = ["pre_close", "stop_loss"]
+        workers: 计算stop_loss的进程数, None为cpu核数
     """
     if type(codes) != list:
         codes = [codes]
@@ -154,21 +157,34 @@ def get_daily_info(
     data["trade_date"] = data["trade_date"].astype("str")
     data["underlying"] = list(map(lambda x: x[:-9], data["code"]))
     if extra_fields:
-        df = pd.DataFrame(columns=output_fields.extend(extra_fields))
-        groups = data.groupby("code")
-        for code in tqdm(codes):
-            group = groups.get_group(code).copy()
-            if "pre_close" in extra_fields:
-                group.loc[:, "pre_close"] = group.loc[:, "close"].shift(periods=1)
-            if "stop_loss" in extra_fields:
-                indicator = StopLossIndicator(data=data, code=code)
-                stop_loss = indicator.predict_stop_loss(start=0)
-                group.loc[:, "stop_loss"] = stop_loss
-            df = df.append(group)
-        return df
+        data = add_extra_fields(data, codes, extra_fields, workers)
+        return data[output_fields + extra_fields]
     return data[output_fields]
 
 
+def add_extra_fields(
+    data: pd.DataFrame, codes, extra_fields, workers=1
+) -> pd.DataFrame:
+    """
+    按合约计算额外的列, 所有合约一起计算, 不再逐个合约分组拼接
+    Args:
+        data: jq.get_price返回的多个合约的数据
+        codes: 合约列表, 结果按codes的顺序排列, 同一合约内按trade_date排序
+        extra_fields: options = ["pre_close", "stop_loss"]
+        workers: 计算stop_loss的进程数, 大于1时合约分给多个进程计算, None为cpu核数
+    """
+    order = {code: i for i, code in enumerate(codes)}
+    data = data[data["code"].isin(order)].copy()
+    data["code_order"] = data["code"].map(order)
+    data.sort_values(["code_order", "trade_date"], kind="mergesort", inplace=True)
+    data.drop(columns="code_order", inplace=True)
+    if "pre_close" in extra_fields:
+        data["pre_close"] = data.groupby("code", sort=False)["close"].shift(periods=1)
+    if "stop_loss" in extra_fields:
+        data["stop_loss"] = predict_stop_loss_by_code(data, workers=workers)
+    return data
+
+
 def get_codes(start_date, end_date):
     db = get_connection()
     sql = f"select distinct mapping_code from future_mapping where trade_date between '{start_date}' and '{end_date}'"
@@ -177,7 +193,11 @@ def get_codes(start_date, end_date):
 
 
 def future_daily(
-    start_date="2021-01-01", end_date="2021-12-31", skip_paused=True, extra_fields=None
+    start_date="2021-01-01",
+    end_date="2021-12-31",
+    skip_paused=True,
+    extra_fields=None,
+    workers=1,
 ):
     """初始化future_daily表
     Args:
@@ -185,11 +205,14 @@ def future_daily(
         end_date (str|datetime):  从聚宽获取日期的结束日期
         skip_paused (bool): 是否跳过停盘日期
         extra_fields (list): ["pre_close","stop_loss"]
+        workers (int): 计算stop_loss的进程数, None为cpu核数
     """
     codes = get_codes(start_date, end_date)
     db = get_connection()
     db.truncate("future_daily")
-    data = get_daily_info(codes, start_date, end_date, skip_paused, extra_fields)
+    data = get_daily_info(
+        codes, start_date, end_date, skip_paused, extra_fields, workers=workers
+    )
     fields = ",".join(data.columns)
     values = ",".join(["%s"] * len(data.columns))
     sql = f"""insert into future_daily ({fields}) 
@@ -201,7 +224,9 @@ def future_daily(
     db.executemany(sql, data.tolist())
 
 
-def get_minute_info(codes, start_date, end_date, skip_paused=True, extra_fields=None):
+def get_minute_info(
+    codes, start_date, end_date, skip_paused=True, extra_fields=None, workers=1
+):
     if type(codes) != list:
         codes = [codes]
     data: pd.DataFrame = jq.get_price(
@@ -239,22 +264,19 @@ def get_minute_info(codes, start_date, end_date, skip_paused=True, extra_fields=
     # data["trade_date"] = pd.to_datetime(data["trade_date"], infer_datetime_format=True)
     # data["trade_date"] = data["trade_date"].dt.date
     if extra_fields:
-        df = pd.DataFrame(columns=output_fields.extend(extra_fields))
-        groups = data.groupby("code")
-        for code in tqdm(codes):
-            group = groups.get_group(code).copy()
-            if "stop_loss" in extra_fields:
-                indicator = StopLossIndicator(data=group, code=code)
-                # start_index = group.iloc[0].name
-                stop_loss = indicator.predict_stop_loss(start=0)
-                group.loc[:, "stop_loss"] = stop_loss
-            df = df.append(group)
-        return df
+        data = add_extra_fields(data, codes, extra_fields, workers)
+        return data[output_fields + extra_fields]
     return data[output_fields]
 
 
 def future_m(
-    start_date="2021-01-01", end_date="2021-12-31", skip_paused=True, extra_fields=None
+    start_date="2021-01-01",
+    end_date="2021-12-31",
+    skip_paused=True,
+    extra_fields=None,
+    workers=1,
+    mode="load",
+    batch_rows=200000,
 ):
     """初始化future_m表
     Args:
@@ -262,21 +284,33 @@ def future_m(
      end_date (str|datetime):  从聚宽获取日期的结束日期
      skip_paused (bool): 是否跳过停盘日期
      extra_fields (list): ["pre_close","stop_loss"]
+     workers (int): 计算stop_loss的进程数, None为cpu核数
+     mode (str): 写入方式, load 批量导入文件(服务端未开启local_infile时退回insert), insert 多行insert语句
+     batch_rows (int): 每次写入数据库的行数
     """
     codes = get_codes(start_date, end_date)
     db = get_connection()
     db.truncate("future_m")
     data: pd.DataFrame = get_minute_info(
-        codes, start_date, end_date, skip_paused=skip_paused, extra_fields=extra_fields
+        codes,
+        start_date,
+        end_date,
+        skip_paused=skip_paused,
+        extra_fields=extra_fields,
+        workers=workers,
     )
     # print(len(data))
-    fields = ",".join(data.columns)
-    values = ",".join(["%s"] * len(data.columns))
-    sql = f"""insert into future_m ({fields}) 
-        values({values})"""
+    columns = list(data.columns)
     data = data.values
     data[pd.isna(data)] = None
-    db.executemany(sql, data.tolist())
+    # 与实时服务使用同一个写入缓冲区, 历史数据可以重新获取, 不使用溢出文件
+    sink = MinuteBarSink(batch_rows=batch_rows, flush_seconds=0, mode=mode, spill_path="")
+    rows = data.tolist()
+    for i in range(0, len(rows), batch_rows):
+        sink.write(rows[i : i + batch_rows], columns)
+    # 写入失败时抛出异常
+    sink.flush()
+    sink.close()
 
 
 def future_warehouse_receipt(start_date, end_date):
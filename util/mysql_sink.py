@@ -0,0 +1,325 @@
+"""
+分钟k线写入mysql的缓冲区(write-behind)
+
+写入的行先追加到本地的溢出文件(json lines), 再放入内存缓冲区, 缓冲的行数达到 batch_rows 或距上一次写入数据库超过
+flush_seconds 秒时一次性写入:
+
++ insert: 多行 insert 语句, 每条语句 statement_rows 行, 一次写入只使用一个连接和一个事务
++ load: 写入临时文件后 LOAD DATA LOCAL INFILE, 需要mysql服务端开启 local_infile, 失败时退回 insert
+
+写入数据库成功后清空溢出文件. 进程退出或数据库不可用时, 没有写入的行保存在溢出文件中, 下次创建时重新读入缓冲区.
+提交成功后、清空溢出文件前进程退出时, 这部分行会重复写入一次(future_m 没有唯一键)
+
+sink = MinuteBarSink().start()
+sink.write(rows, columns)
+sink.close()
+"""
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+from mq.config import get_section_config
+
+logger = logging.getLogger(__name__)
+
+# [SINK] BATCH_ROWS: 缓冲多少行后写入; FLUSH_SECONDS: 最长缓冲时间(秒); STATEMENT_ROWS: 每条insert语句的行数;
+# MODE: insert 或 load; SPILL_PATH: 溢出文件, 相对路径相对于项目目录, 为空时不使用
+DEFAULT_SINK_CONFIG = {
+    "BATCH_ROWS": 20000,
+    "FLUSH_SECONDS": 300,
+    "STATEMENT_ROWS": 1000,
+    "MODE": "insert",
+    "SPILL_PATH": "data/future_m.spill",
+}
+sink_config = get_section_config("SINK", DEFAULT_SINK_CONFIG)
+# 写入数据库失败后等待多少秒再重试
+RETRY_SECONDS = 10
+
+
+def _spill_path(path: str):
+    if not path:
+        return None
+    if not os.path.isabs(path):
+        path = os.path.join(os.path.dirname(os.path.dirname(__file__)), path)
+    return path
+
+
+def _load_value(value) -> str:
+    """LOAD DATA 文件中的一个值: 空值为 \\N, 反斜杠、制表符和换行转义"""
+    if value is None or (isinstance(value, float) and value != value):
+        return "\\N"
+    value = str(value)
+    if "\\" in value or "\t" in value or "\n" in value:
+        value = value.replace("\\", "\\\\").replace("\t", "\\t").replace("\n", "\\n")
+    return value
+
+
+def write_load_file(f, rows: list):
+    """
+    写入 LOAD DATA LOCAL INFILE 使用的文件, 字段以制表符分隔, 每行以换行结束, 转义字符为反斜杠
+    Args:
+        f: 以文本方式打开的文件
+        rows: 行, 空值为None
+    """
+    for row in rows:
+        f.write("\t".join([_load_value(value) for value in row]) + "\n")
+
+
+def mysql_connect(local_infile: bool = False):
+    """
+    按配置文件 [MYSQL] 创建一个单独的pymysql连接, 不使用 DBUtil 的连接池
+    Args:
+        local_infile: 是否允许 LOAD DATA LOCAL INFILE
+    """
+    import pymysql
+    from util import db_util
+
+    config = db_util.config
+    return pymysql.connect(
+        host=config["HOST"],
+        port=int(config["PORT"]),
+        user=config["USER"],
+        password=str(config["PASSWORD"]),
+        database=config["DATABASE"],
+        charset=config["CHARSET"],
+        local_infile=local_infile,
+    )
+
+
+class MinuteBarSink(object):
+    """
+    Args:
+        table: 表名
+        batch_rows: 缓冲多少行后写入, 默认为配置文件 [SINK] 中的 BATCH_ROWS
+        flush_seconds: 最长缓冲时间(秒), 0 只按行数写入, 默认为 FLUSH_SECONDS
+        statement_rows: insert方式每条语句的行数, 默认为 STATEMENT_ROWS
+        mode: insert 或 load, 默认为 MODE
+        spill_path: 溢出文件路径, 默认为 SPILL_PATH, 空字符串不使用溢出文件(例如可以重新获取的历史数据)
+        connect: 创建数据库连接的函数, 参数为 local_infile, 默认为 mysql_connect
+    """
+
+    def __init__(
+        self,
+        table: str = "future_m",
+        batch_rows: int = None,
+        flush_seconds: float = None,
+        statement_rows: int = None,
+        mode: str = None,
+        spill_path: str = None,
+        connect=None,
+    ) -> None:
+        self.table = table
+        self.batch_rows = batch_rows or sink_config["BATCH_ROWS"]
+        self.flush_seconds = sink_config["FLUSH_SECONDS"] if flush_seconds is None else flush_seconds
+        self.statement_rows = statement_rows or sink_config["STATEMENT_ROWS"]
+        self.mode = mode or sink_config["MODE"]
+        if self.mode not in ("insert", "load"):
+            raise ValueError(f"unknown sink mode: {self.mode}")
+        self.spill_path = _spill_path(sink_config["SPILL_PATH"] if spill_path is None else spill_path)
+        self.connect = connect or mysql_connect
+        # 字段(tuple) -> 行, 不同字段的行分别写入
+        self.buffer = {}
+        self.buffered = 0
+        self.flushed = 0
+        self.flushes = 0
+        self.errors = 0
+        self.last_time = 0.0
+        self.last_flush = time.monotonic()
+        self.retry_at = 0.0
+        self.__conn = None
+        self.__lock = threading.RLock()
+        self.__closed = threading.Event()
+        self.__wake = threading.Event()
+        self.__thread = None
+        self.__spill = None
+        self.__restore()
+
+    def __restore(self):
+        """读入上次没有写入数据库的行"""
+        if self.spill_path is None:
+            return
+        os.makedirs(os.path.dirname(self.spill_path), exist_ok=True)
+        if os.path.exists(self.spill_path):
+            restored = 0
+            with open(self.spill_path, encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # 写入一半时进程退出的最后一行
+                        logger.warning(f"skip broken line in {self.spill_path}")
+                        continue
+                    self.__append(record["columns"], record["rows"])
+                    restored += len(record["rows"])
+            if restored:
+                logger.info(f"restored {restored} rows from {self.spill_path}")
+        self.__spill = open(self.spill_path, "a", encoding="utf-8")
+
+    def __append(self, columns, rows):
+        self.buffer.setdefault(tuple(columns), []).extend(rows)
+        self.buffered += len(rows)
+
+    def start(self):
+        """启动后台线程写入数据库, write 只写入缓冲区和溢出文件, 没有新数据时也按 flush_seconds 写入"""
+        if self.__thread is None:
+            self.__thread = threading.Thread(target=self.__run, name="mysql-sink", daemon=True)
+            self.__thread.start()
+        return self
+
+    def __run(self):
+        while not self.__closed.is_set():
+            self.__wake.wait(min(self.flush_seconds, 1) if self.flush_seconds else None)
+            self.__wake.clear()
+            if not self.__closed.is_set() and self.due():
+                self.try_flush()
+
+    def try_flush(self) -> int:
+        """
+        与 flush 相同, 失败时只输出日志, 行保留在缓冲区和溢出文件中, 下次写入时重试
+        Returns:
+            int: 写入的行数, 失败时为0
+        """
+        try:
+            return self.flush()
+        except Exception:
+            logger.exception(f"flush {self.table} failed, {self.buffered} rows kept")
+            return 0
+
+    def due(self) -> bool:
+        """是否达到写入的行数或时间, 写入失败后 RETRY_SECONDS 秒内不重试"""
+        if not self.buffered or time.monotonic() < self.retry_at:
+            return False
+        if self.buffered >= self.batch_rows:
+            return True
+        return bool(self.flush_seconds) and time.monotonic() - self.last_flush >= self.flush_seconds
+
+    def write(self, rows: list, columns: list):
+        """
+        写入溢出文件和缓冲区, 达到行数或时间时写入数据库: 启动了后台线程时由后台线程写入,
+        否则在当前线程写入. 数据库的错误不会抛出, 行保留到下次写入
+        Args:
+            rows: 行, 每行的值与columns对应, 空值为None
+            columns: 字段
+        """
+        if not rows:
+            return
+        with self.__lock:
+            if self.__spill is not None:
+                self.__spill.write(json.dumps({"columns": list(columns), "rows": rows}, default=str) + "\n")
+                self.__spill.flush()
+            self.__append(columns, rows)
+            due = self.due()
+        if not due:
+            return
+        if self.__thread is not None:
+            self.__wake.set()
+        else:
+            self.try_flush()
+
+    def flush(self) -> int:
+        """
+        把缓冲区的行写入数据库, 失败时保留在缓冲区和溢出文件中, 下次重试
+        Returns:
+            int: 写入的行数
+        """
+        with self.__lock:
+            if not self.buffered:
+                self.last_flush = time.monotonic()
+                return 0
+            begin = time.perf_counter()
+            try:
+                conn = self.__connection()
+                with conn.cursor() as cursor:
+                    for columns, rows in self.buffer.items():
+                        if self.mode == "load":
+                            self.__load(cursor, columns, rows)
+                        else:
+                            self.__insert(cursor, columns, rows)
+                conn.commit()
+            except Exception:
+                self.errors += 1
+                self.retry_at = time.monotonic() + RETRY_SECONDS
+                self.__reset_connection()
+                raise
+            count = self.buffered
+            self.buffer = {}
+            self.buffered = 0
+            if self.__spill is not None:
+                self.__spill.truncate(0)
+            self.flushed += count
+            self.flushes += 1
+            self.last_time = time.perf_counter() - begin
+            self.last_flush = time.monotonic()
+            logger.info(f"flush {count} rows into {self.table}: {self.last_time * 1000:.0f}ms")
+            return count
+
+    def __connection(self):
+        if self.__conn is None:
+            self.__conn = self.connect(local_infile=self.mode == "load")
+        return self.__conn
+
+    def __reset_connection(self):
+        if self.__conn is None:
+            return
+        try:
+            self.__conn.rollback()
+            self.__conn.close()
+        except Exception:
+            pass
+        self.__conn = None
+
+    def __insert(self, cursor, columns, rows):
+        fields = ",".join(columns)
+        placeholder = "(" + ",".join(["%s"] * len(columns)) + ")"
+        for i in range(0, len(rows), self.statement_rows):
+            chunk = rows[i : i + self.statement_rows]
+            sql = f"insert into {self.table} ({fields}) values " + ",".join([placeholder] * len(chunk))
+            cursor.execute(sql, [value for row in chunk for value in row])
+
+    def __load(self, cursor, columns, rows):
+        f = tempfile.NamedTemporaryFile("w", suffix=".tsv", delete=False, newline="", encoding="utf-8")
+        try:
+            with f:
+                write_load_file(f, rows)
+            path = f.name.replace("\\", "/")
+            sql = (
+                f"load data local infile '{path}' into table {self.table} "
+                f"fields terminated by '\\t' escaped by '\\\\' lines terminated by '\\n' ({','.join(columns)})"
+            )
+            try:
+                cursor.execute(sql)
+            except Exception as e:
+                # 服务端没有开启 local_infile 等
+                logger.warning(f"load data failed ({e}), fall back to insert")
+                self.mode = "insert"
+                self.__insert(cursor, columns, rows)
+        finally:
+            os.remove(f.name)
+
+    def close(self, timeout: float = None):
+        """写入剩余的行并关闭连接, 写入失败时保留在溢出文件中"""
+        self.__closed.set()
+        self.__wake.set()
+        if self.__thread is not None:
+            self.__thread.join(timeout)
+            self.__thread = None
+        try:
+            self.flush()
+        except Exception:
+            logger.exception(f"flush {self.table} failed, {self.buffered} rows kept in {self.spill_path}")
+        finally:
+            self.__reset_connection()
+            if self.__spill is not None:
+                self.__spill.close()
+                self.__spill = None
+
+    def stats(self) -> dict:
+        return {
+            "buffered": self.buffered,
+            "flushed": self.flushed,
+            "flushes": self.flushes,
+            "errors": self.errors,
+            "last_ms": round(self.last_time * 1000, 3),
+        }
@@ -1,15 +1,29 @@
 import redis
+import redis.asyncio
 
 from util.mysingleton import singleton
 
+REDIS_HOST = "122.207.108.56"
+REDIS_PORT = 12479
+
 @singleton
 class redis_pooling:
-    
+
     def __init__(self):
-        self.pool = redis.ConnectionPool(host="122.207.108.56", port=12479, decode_responses=True)
+        self.pool = redis.ConnectionPool(host=REDIS_HOST, port=REDIS_PORT, decode_responses=True)
         self.conn = [redis.Redis(connection_pool=self.pool) for _ in range(3)]
-        
-    def get_conn(self, index):
+        # 不解码返回值的连接, 用于接收二进制消息
+        self.binary_pool = redis.ConnectionPool(host=REDIS_HOST, port=REDIS_PORT, decode_responses=False)
+        self.binary_conn = [redis.Redis(connection_pool=self.binary_pool) for _ in range(3)]
+
+    def get_conn(self, index, binary=False):
+        if binary:
+            return self.binary_conn[index]
         return self.conn[index]
 
 
+def get_async_conn():
+    """
+    asyncio的redis连接, 不解码返回值. 连接池绑定在创建它的事件循环上, 需要在事件循环中调用
+    """
+    return redis.asyncio.Redis(host=REDIS_HOST, port=REDIS_PORT, decode_responses=False)
@@ -0,0 +1,133 @@
+"""
+流水线的一个阶段: 有界队列 + 一个工作线程
+
+上一个阶段把数据 put 到队列中, 工作线程依次取出并调用 handler, handler 的返回值不为None时交给下一个阶段.
+队列满时:
+
++ block=False: 丢弃最早的数据并输出错误日志, 上一个阶段不会因为下游变慢而阻塞, 用于可以丢弃数据的场景(如实时行情分发)
++ block=True: 等待队列有空位(反压), 数据不会丢失, 用于写入数据库等不能丢弃数据的阶段
+"""
+import logging
+import queue
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+_STOP = object()
+
+
+class Stage(object):
+    """
+    Args:
+        name: 阶段名, 用于日志和统计
+        handler: 处理一条数据的函数, 返回值交给 next_stage
+        maxsize: 队列的最大长度
+        next_stage: 下一个阶段, None为最后一个阶段
+        describe: 数据的描述函数, 丢弃数据时输出到日志, 默认为 str
+        block: 队列满时 put 是否等待, False 丢弃最早的数据
+    """
+
+    def __init__(
+        self, name: str, handler, maxsize: int = 16, next_stage=None, describe=str, block: bool = False
+    ) -> None:
+        self.name = name
+        self.block = block
+        self.handler = handler
+        self.next_stage = next_stage
+        self.describe = describe
+        self.queue = queue.Queue(maxsize=maxsize)
+        self.processed = 0
+        self.dropped = 0
+        self.errors = 0
+        # 最近一次处理的耗时(秒)
+        self.last_time = 0.0
+        self.max_depth = 0
+        self.__thread = None
+
+    def start(self):
+        if self.__thread is None:
+            self.__thread = threading.Thread(target=self.__run, name=f"stage-{self.name}", daemon=True)
+            self.__thread.start()
+        return self
+
+    def put(self, item) -> bool:
+        """
+        放入队列, block=False时不阻塞, block=True时队列满则等待
+        :return: 队列满并丢弃了最早的数据时为False
+        """
+        dropped = False
+        if self.block:
+            while True:
+                try:
+                    self.queue.put(item, timeout=1)
+                    break
+                except queue.Full:
+                    logger.warning(f"{self.name} 队列已满, 等待: {self.describe(item)}")
+        else:
+            while True:
+                try:
+                    self.queue.put_nowait(item)
+                    break
+                except queue.Full:
+                    try:
+                        oldest = self.queue.get_nowait()
+                    except queue.Empty:
+                        continue
+                    self.queue.task_done()
+                    self.dropped += 1
+                    dropped = True
+                    logger.error(f"{self.name} 队列已满, 丢弃: {self.describe(oldest)}")
+        depth = self.queue.qsize()
+        if depth > self.max_depth:
+            self.max_depth = depth
+        return not dropped
+
+    def __run(self):
+        while True:
+            item = self.queue.get()
+            try:
+                if item is _STOP:
+                    return
+                begin = time.perf_counter()
+                result = self.handler(item)
+                self.last_time = time.perf_counter() - begin
+                self.processed += 1
+                if result is not None and self.next_stage is not None:
+                    self.next_stage.put(result)
+            except Exception:
+                self.errors += 1
+                logger.exception(f"{self.name} 处理出错: {self.describe(item)}")
+            finally:
+                self.queue.task_done()
+
+    def join(self, timeout: float = None) -> bool:
+        """
+        等待队列中的数据处理完成
+        :return: 超时为False
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while self.queue.unfinished_tasks:
+            if deadline is not None and time.monotonic() > deadline:
+                return False
+            time.sleep(0.01)
+        return True
+
+    def stop(self, timeout: float = None):
+        """处理完队列中的数据后结束工作线程"""
+        if self.__thread is None:
+            return
+        self.join(timeout)
+        self.queue.put(_STOP)
+        self.__thread.join(timeout)
+        self.__thread = None
+
+    def stats(self) -> dict:
+        return {
+            "depth": self.queue.qsize(),
+            "max_depth": self.max_depth,
+            "processed": self.processed,
+            "dropped": self.dropped,
+            "errors": self.errors,
+            "last_ms": round(self.last_time * 1000, 3),
+        }